@@ -8,6 +8,9 @@ CREATE DATABASE reimaginaurbano;
 DROP TABLE IF EXISTS blocks;
 DROP TABLE IF EXISTS lots;
 DROP TABLE IF EXISTS accessibility_trips;
+DROP TABLE IF EXISTS rollups;
+DROP TABLE IF EXISTS rollup_geometries;
+DROP TABLE IF EXISTS regions;
 
 -- Create the 'blocks' table
 CREATE TABLE blocks (
@@ -133,6 +136,9 @@ CREATE TABLE lots (
     num_establishments INTEGER,
     num_properties INTEGER,
     mean_slope FLOAT,
+    min_slope FLOAT,
+    max_slope FLOAT,
+    p90_slope FLOAT,
     geometry TEXT
 );
 
@@ -152,3 +158,33 @@ CREATE TABLE accessibility_trips (
 );
 
 CREATE INDEX id ON accessibility_trips (origin_id, destination_id, num_amenity);
+
+-- Sum and count of every metric per cvegeo prefix, filled by populate_db
+CREATE TABLE rollups (
+    level VARCHAR(255),
+    code VARCHAR(255),
+    metric VARCHAR(255),
+    sum FLOAT,
+    count INTEGER
+);
+
+CREATE INDEX rollups_level ON rollups (level, code);
+
+CREATE TABLE rollup_geometries (
+    level VARCHAR(255),
+    code VARCHAR(255),
+    num_blocks INTEGER,
+    geometry TEXT,
+    updated_at TIMESTAMP,
+    PRIMARY KEY (level, code)
+);
+
+-- Named polygons with their selected ids and baseline aggregates as JSON
+CREATE TABLE regions (
+    name VARCHAR(255) PRIMARY KEY,
+    geometry TEXT,
+    ids TEXT,
+    aggregates TEXT,
+    layers_version VARCHAR(255),
+    updated_at TIMESTAMP
+);
@@ -38,10 +38,12 @@ mkdir -p "$FOLDER/final"
 # echo "Assigning establishments"
 # time poetry run python3 -m src.scripts.assign_establishments "$original_dir" "$tmp_dir" $VERBOSE_OPTION
 # echo "Assigning landuse"
-# time poetry run python3 -m src.scripts.landuse "$original_dir" "$tmp_dir" $VERBOSE_OPTION
+# time poetry run python3 -m src.scripts.landuse "$original_dir" "$tmp_dir" -f $VERBOSE_OPTION
 # OUTSIDE: Run notebook visits
 # echo "Calculating accessibility"
 # time poetry run python3 -m src.scripts.accessibility "$original_dir" "$tmp_dir" $VERBOSE_OPTION
+# echo "Estimating building heights"
+# time poetry run python3 -m src.scripts.building_heights "$original_dir" "$tmp_dir" $VERBOSE_OPTION
 # echo "Calculating utilization"
 # time poetry run python3 -m src.scripts.utilization "$original_dir" "$tmp_dir" $VERBOSE_OPTION
 
@@ -52,6 +54,11 @@ mkdir -p "$FOLDER/final"
 # cp "$tmp_dir/amenities.fgb" "$final_dir/amenities.fgb"
 # cp "$tmp_dir/accessibility_points.fgb" "$final_dir/accessibility_points.fgb"
 
+# echo "Optimizing layers"
+# time poetry run python3 -m src.scripts.optimize_layers "$final_dir" $VERBOSE_OPTION
+# echo "Simplifying layers"
+# time poetry run python3 -m src.scripts.simplify_layers "$final_dir" $VERBOSE_OPTION
+
 # OUTSIDE: Run notebook slope
 # OUTSIDE: Run notebook final
 # OUTSIDE: Run notebook ideal buildings
@@ -1,5 +1,6 @@
 import io
 import json
+import logging
 import os
 import sqlite3
 import tempfile
@@ -11,11 +12,12 @@ import pandana as pdna
 import pandas as pd
 import pyogrio
 import requests
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, Response
 from osmnx.distance import nearest_nodes
 from pydantic import BaseModel
+import shapely
 from shapely import Point, Polygon
 from shapely.geometry import box
 import time
@@ -26,10 +28,15 @@ from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from shapely.geometry import shape
 
-from src.utils.files import get_file, get_blob_url
-from src.utils.db import query_metrics, select_minutes, select_accessibility_score, MAPPING_REDUCE_FUNCS, METRIC_MAPPING, get_metrics_info, select_furthest_amenity
+from src.utils.files import get_file, get_blob_url, get_local_path
+from src.utils.store import LayerIndex, LayerStore, get_layer_store, get_store_dir
+from src.utils.fgb import FlatGeobufError, OffsetIndex
+from src.utils.lod import get_lod_layer
+from src.utils.projects import DEFAULT_PROJECT, PROJECTS, get_area_project, get_project, has_layer, project_cache
+from src.utils.db import ROLLUP_LEVELS, select_rollups, select_rollups_updated_at, select_region, select_region_updated_at, select_regions, save_region, delete_region, query_metrics, select_minutes, select_accessibility_score, MAPPING_REDUCE_FUNCS, METRIC_MAPPING, get_metrics_info, select_furthest_amenity
 
 app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
 
 allowed_origins_env = os.getenv("ALLOWED_ORIGINS", "")
 allowed_origins = [origin.strip()
@@ -44,13 +51,16 @@ app.add_middleware(
 pool = ThreadPoolExecutor()
 
 
-def read_gdf_sync(filepath, bbox=None):
-    return gpd.read_file(filepath, bbox=bbox, engine="pyogrio")
+def read_gdf_sync(filepath, bbox=None, columns=None):
+    # Arrow reads hand the geometries over as a single WKB buffer
+    if bbox is not None and hasattr(bbox, "bounds"):
+        bbox = bbox.bounds
+    return pyogrio.read_dataframe(filepath, bbox=bbox, columns=columns, use_arrow=True)
 
 
-async def read_gdf_async(filepath, bbox=None):
+async def read_gdf_async(filepath, bbox=None, columns=None):
     loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(pool, read_gdf_sync, filepath, bbox)
+    result = await loop.run_in_executor(pool, read_gdf_sync, filepath, bbox, columns)
     return result
 
 
@@ -60,20 +70,212 @@ def gdf_from_coords(coords: List[List[float]]) -> gpd.GeoDataFrame:
     )
 
 
-async def load_gdf(layer: str, polygon_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    bbox = box(*polygon_gdf.total_bounds)
-    gdf = await read_gdf_async(get_file(get_blob_url(layer)), bbox)
-    gdf = gdf[gdf.intersects(polygon_gdf.unary_union)]
-    return gdf
+def resolve_project(project: str = None) -> str:
+    project = project or DEFAULT_PROJECT
+    try:
+        get_project(project)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return project
 
 
-async def get_ids(coordinates: List[List[float]], level: str) -> List[str]:
-    if not coordinates or len(coordinates) == 0:
-        return []
+def get_layer_file(layer: str, project: str = None) -> str:
+    if not has_layer(project, layer):
+        raise HTTPException(
+            status_code=404, detail=f"Layer {layer} not found in project {project}")
+    return get_file(get_blob_url(f"{layer}.fgb", project))
+
+
+def get_layer_version(layer: str, project: str = None):
+    """Modification time of the local copy of a layer, None until it is fetched"""
+    filepath = get_local_path(get_blob_url(f"{layer}.fgb", project))
+    return os.path.getmtime(filepath) if os.path.exists(filepath) else None
+
+
+def has_lod_file(lod_layer: str, project: str = None) -> bool:
+    try:
+        get_file(get_blob_url(f"{lod_layer}.fgb", project))
+    except FileNotFoundError:
+        return False
+    except requests.HTTPError as e:
+        # Only a missing variant falls back, auth or server errors are real failures
+        if e.response is None or e.response.status_code != 404:
+            raise
+        return False
+    return True
+
+
+def get_lod_file(layer: str, project: str = None, zoom: float = None, tolerance: float = None) -> str:
+    lod_layer = get_lod_layer(layer, zoom, tolerance)
+    if lod_layer != layer:
+        # A missing variant is remembered until the full layer is fetched again
+        available = project_cache.get(
+            project or DEFAULT_PROJECT,
+            f"lod:{lod_layer}",
+            lambda: has_lod_file(lod_layer, project),
+            version=get_layer_version(layer, project),
+        )
+        if available:
+            return get_file(get_blob_url(f"{lod_layer}.fgb", project))
+        logger.info(f"Variant {lod_layer} not available, serving {layer}")
+    return get_layer_file(layer, project)
+
+
+def get_schema(project: str = None) -> str:
+    return get_project(project).get("schema")
+
+
+def get_store(level: str, project: str = None) -> LayerStore:
     id = "cvegeo" if level == "blocks" else "lot_id"
+    filepath = get_layer_file(level, project)
+    return project_cache.get(
+        project or DEFAULT_PROJECT,
+        f"store:{level}",
+        lambda: get_layer_store(filepath, id, columns=[id]),
+        version=get_store_dir(filepath, [id]),
+        sizeof=lambda store: store.nbytes,
+    )
+
+
+def get_layer_index(level: str, project: str = None) -> LayerIndex:
+    store = get_store(level, project)
+    return project_cache.get(
+        project or DEFAULT_PROJECT,
+        f"index:{level}",
+        lambda: LayerIndex(store),
+        version=store.store_dir,
+        sizeof=lambda index: index.nbytes,
+    )
+
+
+def get_offset_index(layer: str, id_column: str, project: str = None) -> OffsetIndex:
+    filepath = get_layer_file(layer, project)
+    return project_cache.get(
+        project or DEFAULT_PROJECT,
+        f"offsets:{layer}:{id_column}",
+        lambda: OffsetIndex(filepath, id_column),
+        version=os.path.getmtime(filepath),
+        sizeof=lambda index: index.nbytes,
+    )
+
+
+def read_rollup_sync(level: str, project: str = None) -> bytes:
+    """
+    GeoJSON of a rollup level, encoded once and kept with the project until
+    populate_db rebuilds the rollups.
+    """
+    schema = get_schema(project)
+
+    def load():
+        df = select_rollups(level, schema=schema)
+        gdf = gpd.GeoDataFrame(
+            df.drop(columns=["geometry"]),
+            geometry=gpd.GeoSeries.from_wkt(df["geometry"]),
+            crs="EPSG:4326",
+        )
+        return gdf.to_json(na="null").encode()
+
+    return project_cache.get(
+        project or DEFAULT_PROJECT,
+        f"rollup:{level}",
+        load,
+        version=select_rollups_updated_at(level, schema=schema),
+        sizeof=len,
+    )
+
+
+def read_features_sync(layer: str, id_column: str, ids: List[str], project: str = None) -> bytes:
+    return get_offset_index(layer, id_column, project).read(ids)
+
+
+def select_geometry_ids(geometry, level: str, project: str = None) -> List[str]:
+    store = get_store(level, project)
+    indices = store.select(geometry)
+    return store.ids[indices].tolist()
+
+
+def select_ids_sync(coordinates: List[List[float]], level: str, project: str = None) -> List[str]:
     polygon_gdf = gdf_from_coords(coordinates)
-    gdf = await load_gdf(level + ".fgb", polygon_gdf)
-    return gdf[id].astype(str).tolist()
+    return select_geometry_ids(polygon_gdf.unary_union, level, project)
+
+
+async def get_ids(coordinates: List[List[float]], level: str, project: str = None) -> List[str]:
+    if not coordinates or len(coordinates) == 0:
+        return []
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, select_ids_sync, coordinates, level, project)
+
+
+def get_layers_version(project: str = None) -> str:
+    """Identifies the lots and blocks files a region selection was made from"""
+    return ",".join(
+        os.path.basename(get_store_dir(get_layer_file(level, project)))
+        for level in REGION_LEVELS
+    )
+
+
+def build_region(name: str, geometry, project: str = None) -> Dict[str, Any]:
+    """Selects the lots and blocks of a region and their baseline aggregates"""
+    region = {
+        "name": name,
+        "geometry": geometry.wkt,
+        "ids": {},
+        "aggregates": {},
+        "layers_version": get_layers_version(project),
+    }
+    for level in REGION_LEVELS:
+        ids = select_geometry_ids(geometry, level, project)
+        region["ids"][level] = ids
+        if not ids:
+            # query_metrics reads no ids as the whole city
+            region["aggregates"][level] = empty_aggregates()
+            continue
+        region["aggregates"][level] = aggregate_info(
+            level, ids, {"group_ages": []}, schema=get_schema(project))
+    return region
+
+
+def get_region_sync(name: str, project: str = None) -> Dict[str, Any]:
+    """
+    Stored selection of a region, kept with the project while the layers and
+    the region stay the same. It is selected again when the layers changed.
+    """
+    schema = get_schema(project)
+    layers_version = get_layers_version(project)
+    updated_at = select_region_updated_at(name, schema=schema)
+    if updated_at is None:
+        raise ValueError(f"Unknown region: {name}")
+
+    def load():
+        region = select_region(name, schema=schema)
+        if region["layers_version"] != layers_version:
+            logger.info(f"Layers changed, selecting region {name} again")
+            region = build_region(
+                name, shapely.from_wkt(region["geometry"]), project)
+            region = save_region(region, schema=schema)
+        return region
+
+    return project_cache.get(
+        project or DEFAULT_PROJECT,
+        f"region:{name}",
+        load,
+        version=(layers_version, updated_at),
+        sizeof=lambda region: 64 * sum(len(ids) for ids in region["ids"].values()),
+    )
+
+
+async def get_region(name: str, project: str = None) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, get_region_sync, name, project)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def check_region_level(level: str):
+    if level not in REGION_LEVELS:
+        raise HTTPException(
+            status_code=400, detail=f"Regions are selected by {', '.join(REGION_LEVELS)}, not {level}")
 
 
 @app.get("/")
@@ -81,12 +283,27 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/projects")
+async def get_projects():
+    return {
+        "default": DEFAULT_PROJECT,
+        "projects": list(PROJECTS),
+        "cache": project_cache.stats(),
+    }
+
+
 @app.get("/coords")
 async def get_coordinates(project: str = None):
-    if not project:
-        project = "primavera"
+    area_project = get_area_project(project) if project not in PROJECTS else None
+    if area_project:
+        # Bounds of sub-areas are stored as <area>_bounds.fgb in their project
+        filepath = get_file(get_blob_url(f"{project}_bounds.fgb", area_project))
+    else:
+        project = resolve_project(project)
+        bounds = get_project(project).get("bounds", "bounds.fgb")
+        filepath = get_file(get_blob_url(bounds, project))
 
-    gdf_bounds = await read_gdf_async(get_file(get_blob_url(f"{project}_bounds.fgb")), None)
+    gdf_bounds = await read_gdf_async(filepath, None, columns=[])
     geom = gdf_bounds.unary_union
     return {"latitude": geom.centroid.y, "longitude": geom.centroid.x}
 
@@ -100,22 +317,32 @@ async def custom_query(payload: Dict[Any, Any]):
     payload['group_ages'] = [POB_AGES_METRICS_MAPPING[age]
                              for age in payload['group_ages']]
     level = payload.get("level", "blocks")
+    project = resolve_project(payload.get("project"))
+    schema = get_schema(project)
 
     id = "cvegeo" if level == "blocks" else "lot_id"
-    ids = await get_ids(coordinates, level)
+    if payload.get("region"):
+        check_region_level(level)
+        region = await get_region(payload["region"], project)
+        ids = region["ids"][level]
+        if not ids:
+            return {"stats_info": {}, "data": []}
+    else:
+        ids = await get_ids(coordinates, level, project)
 
     # TODO: Integrate so that it includes all selected metrics (including minutes and accessibility_score)
     if "minutes" in metrics:
-        df = select_minutes(level, ids, proximity_mapping)
+        df = select_minutes(level, ids, proximity_mapping, schema=schema)
         df = df[[id, "minutes"]]
         df = df.rename(columns={"minutes": "value"})
     elif "accessibility_score" in metrics:
-        df = select_accessibility_score(level, ids, proximity_mapping)
+        df = select_accessibility_score(
+            level, ids, proximity_mapping, schema=schema)
         df['accessibility_score'] = np.log(df['accessibility_score'] + 1) * 17
         df = df[[id, "accessibility_score"]]
         df = df.rename(columns={"accessibility_score": "value"})
     else:
-        df = query_metrics(level, metrics, ids, payload)
+        df = query_metrics(level, metrics, ids, payload, schema=schema)
     df = df.fillna(0)
     df_dict = df.to_dict(orient="records")
     quantiles = df["value"].quantile([0, 0.2, 0.4, 0.6, 0.8, 1])
@@ -138,49 +365,56 @@ POB_AGES_METRICS_MAPPING = {
 }
 
 
-@app.post("/predios")
-async def get_info(payload: Dict[Any, Any]):
-    coordinates = payload.get("coordinates")
-    level = payload.get("type", "blocks")
-    ids = await get_ids(coordinates, level)
+REGION_LEVELS = ["blocks", "lots"]
+# Columns /features can look features up by, the first one is the default
+FEATURE_ID_COLUMNS = {"lots": ["lot_id"], "blocks": ["cvegeo"]}
+FEATURE_FORMATS = ["fgb", "geojson"]
+LOOKUP_LEVELS = ["lots", "blocks"]
+INFO_METRICS = [
+    "poblacion",
+    "viviendas_habitadas",
+    "viviendas_habitadas_percent",
+    "viviendas_deshabitadas",
+    "viviendas_deshabitadas_percent",
+    "grado_escuela",
+    "area",
+    "indice_bienestar",
+    "viviendas_tinaco",
+    "viviendas_pc",
+    "viviendas_auto",
+    "accessibility_score",
+    "minutes",
+    "density",
+    "cos",
+    "max_cos",
+    "cus",
+    "max_cus",
+    "max_density",
+    "max_num_levels",
+    "home_units",
+    "max_home_units",
+    "subutilizacion",
+    "subutilizacion_type",
+    "num_levels",
+    "per_female_group_ages",
+    "per_male_group_ages",
+    "per_group_ages",
+    "slope",
+]
+
+
+def empty_aggregates() -> Dict[str, Any]:
+    return {col: 0 for col in INFO_METRICS}
+
+
+def aggregate_info(level: str, ids: List[str], payload: Dict[Any, Any], schema: str = None) -> Dict[str, Any]:
     proximity_mapping = payload.get("accessibility_info")
-    payload['group_ages'] = [POB_AGES_METRICS_MAPPING[age]
-                             for age in payload['group_ages']]
     # TODO: Pass cols instead of hardcoded
-    cols = [
-        "poblacion",
-        "viviendas_habitadas",
-        "viviendas_habitadas_percent",
-        "viviendas_deshabitadas",
-        "viviendas_deshabitadas_percent",
-        "grado_escuela",
-        "area",
-        "indice_bienestar",
-        "viviendas_tinaco",
-        "viviendas_pc",
-        "viviendas_auto",
-        "accessibility_score",
-        "minutes",
-        "density",
-        "cos",
-        "max_cos",
-        "cus",
-        "max_cus",
-        "max_density",
-        "max_num_levels",
-        "home_units",
-        "max_home_units",
-        "subutilizacion",
-        "subutilizacion_type",
-        "num_levels",
-        "per_female_group_ages",
-        "per_male_group_ages",
-        "per_group_ages",
-        "slope",
-    ]
+    cols = INFO_METRICS
     try:
-        df = query_metrics(level, {col: col for col in cols}, ids, payload)
-        new_cols = get_metrics_info(cols)
+        df = query_metrics(
+            level, {col: col for col in cols}, ids, payload, schema=schema)
+        new_cols = get_metrics_info(cols, schema=schema)
         new_cols = {k: v for k, v in zip(cols, new_cols)}
         if level == "lots":
             df = df.groupby("cvegeo").aggregate(
@@ -192,13 +426,14 @@ async def get_info(payload: Dict[Any, Any]):
         # TODO: Implement accessibility_score part
         if "minutes" in cols:
             id = "cvegeo" if level == "blocks" else "lot_id"
-            df = select_minutes(level, ids, proximity_mapping)
+            df = select_minutes(level, ids, proximity_mapping, schema=schema)
             df = df[[id, "minutes"]]
             df = df.aggregate({"minutes": "mean"})
             df = df.fillna(0)
             results["minutes"] = df["minutes"].item()
 
-            df = select_furthest_amenity(level, ids, proximity_mapping)
+            df = select_furthest_amenity(
+                level, ids, proximity_mapping, schema=schema)
             df = df[[id, "amenity"]]
             df = df.aggregate({"amenity": lambda x: x.value_counts().idxmax()})
             results["amenity"] = df["amenity"]
@@ -215,20 +450,46 @@ async def get_info(payload: Dict[Any, Any]):
     return results
 
 
+@app.post("/predios")
+async def get_info(payload: Dict[Any, Any]):
+    coordinates = payload.get("coordinates")
+    level = payload.get("type", "blocks")
+    project = resolve_project(payload.get("project"))
+    schema = get_schema(project)
+    payload['group_ages'] = [POB_AGES_METRICS_MAPPING[age]
+                             for age in payload['group_ages']]
+    if payload.get("region"):
+        check_region_level(level)
+        region = await get_region(payload["region"], project)
+        # The stored aggregates were computed for the default request
+        if not payload['group_ages'] and not payload.get("accessibility_info"):
+            return region["aggregates"][level]
+        ids = region["ids"][level]
+        if not ids:
+            return empty_aggregates()
+    else:
+        ids = await get_ids(coordinates, level, project)
+    return aggregate_info(level, ids, payload, schema=schema)
+
+
 @app.get("/polygon/{layer}")
-async def get_polygon(layer: str):
-    return FileResponse(get_file(get_blob_url(f"{layer}.fgb")))
+async def get_polygon(layer: str, project: str = None, zoom: float = None, tolerance: float = None):
+    project = resolve_project(project)
+    return FileResponse(get_lod_file(layer, project, zoom, tolerance))
 
 
 @app.post("/polygon")
 async def get_polygon_segment(payload: Dict[Any, Any]):
     layer = payload.get("layer")
     coordinates = payload.get("coordinates")
+    project = resolve_project(payload.get("project"))
+    zoom = payload.get("zoom")
+    tolerance = payload.get("tolerance")
 
     if not coordinates or len(coordinates) == 0:
-        return FileResponse(get_file(get_blob_url(f"{layer}.fgb")))
+        return FileResponse(get_lod_file(layer, project, zoom, tolerance))
 
-    layerFile = get_file(get_blob_url(f"{layer}.fgb"))
+    layerFile = get_lod_file(layer, project, zoom, tolerance)
     polygon_gdf = gpd.GeoDataFrame(
         geometry=[Polygon(x) for x in coordinates], crs="EPSG:4326"
     )
@@ -240,3 +501,130 @@ async def get_polygon_segment(payload: Dict[Any, Any]):
         pyogrio.write_dataframe(gdf, output, driver="FlatGeobuf")
         contents = output.getvalue()
         return Response(content=contents, media_type="application/octet-stream")
+
+
+@app.post("/features")
+async def get_features(payload: Dict[Any, Any]):
+    layer = payload.get("layer", "lots")
+    ids = [str(id) for id in payload.get("ids", [])]
+    output_format = payload.get("format", "fgb")
+    project = resolve_project(payload.get("project"))
+    if layer not in FEATURE_ID_COLUMNS:
+        raise HTTPException(
+            status_code=400, detail=f"Features are fetched from {', '.join(FEATURE_ID_COLUMNS)}, not {layer}")
+    id_column = payload.get("id_column", FEATURE_ID_COLUMNS[layer][0])
+    if id_column not in FEATURE_ID_COLUMNS[layer]:
+        raise HTTPException(
+            status_code=400, detail=f"Features of {layer} are fetched by {', '.join(FEATURE_ID_COLUMNS[layer])}, not {id_column}")
+    if output_format not in FEATURE_FORMATS:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown format: {output_format}")
+
+    loop = asyncio.get_running_loop()
+    try:
+        contents = await loop.run_in_executor(pool, read_features_sync, layer, id_column, ids, project)
+    except FlatGeobufError as e:
+        # The layer file itself is broken, not the request
+        raise HTTPException(status_code=500, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if output_format == "geojson":
+        gdf = pyogrio.read_dataframe(io.BytesIO(contents))
+        return Response(content=gdf.to_json(), media_type="application/geo+json")
+    return Response(content=contents, media_type="application/octet-stream")
+
+
+@app.get("/lookup")
+async def lookup(lat: float, lon: float, level: str = "lots", project: str = None):
+    if level not in LOOKUP_LEVELS:
+        raise HTTPException(
+            status_code=400, detail=f"Lookups are made on {', '.join(LOOKUP_LEVELS)}, not {level}")
+    project = resolve_project(project)
+    loop = asyncio.get_running_loop()
+    index = await loop.run_in_executor(pool, get_layer_index, level, project)
+    match = index.lookup(lon, lat)
+    if match is None:
+        raise HTTPException(
+            status_code=404, detail=f"Layer {level} has no features in project {project}")
+    position, distance = match
+    id = str(index.store.ids[position])
+
+    payload = {"group_ages": []}
+    df = await loop.run_in_executor(
+        pool, query_metrics, level, {col: col for col in INFO_METRICS}, [id], payload, get_schema(project))
+    df = df.fillna(0)
+    metrics = df.to_dict(orient="records")[0] if not df.empty else {}
+    return {
+        "id": id,
+        "level": level,
+        "contains": distance == 0,
+        "distance": distance,
+        "metrics": metrics,
+    }
+
+
+@app.get("/rollup/{level}")
+async def get_rollup(level: str, project: str = None):
+    if level not in ROLLUP_LEVELS:
+        raise HTTPException(
+            status_code=404, detail=f"Unknown rollup level: {level}")
+    project = resolve_project(project)
+    loop = asyncio.get_running_loop()
+    contents = await loop.run_in_executor(pool, read_rollup_sync, level, project)
+    return Response(content=contents, media_type="application/geo+json")
+
+
+@app.get("/regions")
+async def get_regions(project: str = None):
+    project = resolve_project(project)
+    df = select_regions(schema=get_schema(project))
+    return df.to_dict(orient="records")
+
+
+@app.post("/regions")
+async def create_region(payload: Dict[Any, Any]):
+    name = payload.get("name")
+    coordinates = payload.get("coordinates")
+    project = resolve_project(payload.get("project"))
+    if not name or not coordinates:
+        raise HTTPException(
+            status_code=400, detail="A region needs a name and coordinates")
+
+    def create():
+        geometry = gdf_from_coords(coordinates).unary_union
+        region = build_region(name, geometry, project)
+        return save_region(region, schema=get_schema(project))
+
+    loop = asyncio.get_running_loop()
+    region = await loop.run_in_executor(pool, create)
+    project_cache.discard(project, f"region:{name}")
+    return {
+        "name": name,
+        "layers_version": region["layers_version"],
+        "counts": {level: len(ids) for level, ids in region["ids"].items()},
+        "aggregates": region["aggregates"],
+    }
+
+
+@app.get("/regions/{name}")
+async def get_region_info(name: str, project: str = None):
+    project = resolve_project(project)
+    region = await get_region(name, project)
+    return {
+        "name": name,
+        "geometry": shapely.geometry.mapping(shapely.from_wkt(region["geometry"])),
+        "layers_version": region["layers_version"],
+        "ids": region["ids"],
+        "aggregates": region["aggregates"],
+    }
+
+
+@app.delete("/regions/{name}")
+async def remove_region(name: str, project: str = None):
+    project = resolve_project(project)
+    if not delete_region(name, schema=get_schema(project)):
+        raise HTTPException(
+            status_code=404, detail=f"Unknown region: {name}")
+    project_cache.discard(project, f"region:{name}")
+    return {"name": name, "deleted": True}
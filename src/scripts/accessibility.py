@@ -2,7 +2,6 @@ import argparse
 import os
 
 import geopandas as gpd
-import osmnx as ox
 import pandana as pdna
 import pandas as pd
 import numpy as np
@@ -20,6 +19,7 @@ from src.scripts.utils.constants import (
     ACCESSIBILITY_FILE,
     PEDESTRIAN_NETWORK_FILE,
 )
+from src.scripts.utils.osm import get_osm_cache
 import time
 from functools import lru_cache
 
@@ -32,14 +32,7 @@ def load_network(filename, gdf_bounds, radius):
     if os.path.exists(filename):
         network = pdna.Network.from_hdf5(filename)
     else:
-        extended_boundary = (
-            gdf_bounds.to_crs("EPSG:3043")
-            .geometry.buffer(radius)
-            .to_crs("EPSG:4326")
-            .unary_union
-        )
-        G = ox.graph_from_polygon(extended_boundary, network_type="walk")
-        nodes, edges = ox.graph_to_gdfs(G)
+        nodes, edges = get_osm_cache(gdf_bounds, radius).network_gdfs("walk")
         edges = edges.reset_index()
         network = pdna.Network(
             nodes["x"], nodes["y"], edges["u"], edges["v"], edges[["length"]]
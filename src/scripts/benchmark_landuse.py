@@ -0,0 +1,139 @@
+import argparse
+import time
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import shapely
+from tabulate import tabulate
+
+from src.scripts.landuse import cut_out_inner_polygons, overlay_multiple, overlay_multiple_serial
+from src.scripts.utils.synthetic import random_lots
+
+
+def cut_out_inner_polygons_pairwise(gdf):
+    """Previous implementation, compares every pair of rows"""
+    result_geometries = []
+    for i, outer_polygon in gdf.iterrows():
+        cut_polygon = outer_polygon.geometry
+        for j, inner_polygon in gdf.iterrows():
+            if i != j:
+                if cut_polygon.contains(inner_polygon.geometry):
+                    cut_polygon = cut_polygon.difference(
+                        inner_polygon.geometry)
+        result_geometries.append(cut_polygon)
+    gdf["geometry"] = result_geometries
+    return gdf
+
+
+def random_polygons(num_polygons: int, inner_share: float = 0.2, seed: int = 0) -> gpd.GeoDataFrame:
+    """Squares spread over a city-sized extent, a share of them nested inside others"""
+    rng = np.random.default_rng(seed)
+    num_inner = int(num_polygons * inner_share)
+    num_outer = num_polygons - num_inner
+    side = np.sqrt(1 / num_polygons)
+    x, y = rng.random((2, num_outer))
+    sizes = side * rng.uniform(0.5, 2, num_outer)
+    outer = shapely.box(x, y, x + sizes, y + sizes)
+
+    parents = rng.choice(num_outer, num_inner)
+    scale = rng.uniform(0.1, 0.4, num_inner) * sizes[parents]
+    offset_x = x[parents] + rng.uniform(0, 1, num_inner) * \
+        (sizes[parents] - scale)
+    offset_y = y[parents] + rng.uniform(0, 1, num_inner) * \
+        (sizes[parents] - scale)
+    inner = shapely.box(offset_x, offset_y,
+                        offset_x + scale, offset_y + scale)
+
+    geometries = np.concatenate([outer, inner])
+    return gpd.GeoDataFrame(geometry=geometries[rng.permutation(num_polygons)])
+
+
+def benchmark_cut_out(sizes: list, reference_size: int) -> list:
+    report = []
+    gdf = random_polygons(reference_size)
+    start = time.time()
+    expected = cut_out_inner_polygons_pairwise(gdf.copy())
+    pairwise_time = time.time() - start
+    start = time.time()
+    result = cut_out_inner_polygons(gdf.copy())
+    indexed_time = time.time() - start
+    identical = bool(shapely.equals_exact(
+        expected.geometry.to_numpy(), result.geometry.to_numpy(), 0).all())
+    report.append({
+        "polygons": reference_size,
+        "pairwise_s": round(pairwise_time, 3),
+        "pairwise_estimated_s": None,
+        "strtree_s": round(indexed_time, 3),
+        "identical": identical,
+    })
+
+    for size in sizes:
+        gdf = random_polygons(size)
+        start = time.time()
+        cut_out_inner_polygons(gdf)
+        report.append({
+            "polygons": size,
+            # Not run, comparing every pair grows with the square of the rows
+            "pairwise_s": None,
+            "pairwise_estimated_s": round(pairwise_time * (size / reference_size) ** 2),
+            "strtree_s": round(time.time() - start, 3),
+            "identical": None,
+        })
+    return report
+
+
+def benchmark_overlay(num_lots: int, num_polygons: int, num_workers: int, tolerance: float = 1e-9) -> list:
+    gdf_lots = random_lots(num_lots)
+    gdfs = [random_polygons(num_polygons, seed=seed) for seed in range(3)]
+
+    start = time.time()
+    expected = overlay_multiple_serial(gdf_lots, gdfs)
+    report = [{"mode": "serial", "seconds": round(time.time() - start, 3)}]
+    for partition in ["grid", "cvegeo"]:
+        start = time.time()
+        result = overlay_multiple(
+            gdf_lots, gdfs, num_workers=num_workers, partition=partition)
+        elapsed = time.time() - start
+        max_difference = 0
+        for gdf_expected, gdf_result in zip(expected, result):
+            area_expected = gdf_expected.area.groupby(gdf_expected["lot_id"]).sum()
+            area_result = gdf_result.area.groupby(gdf_result["lot_id"]).sum()
+            difference = area_expected.subtract(area_result, fill_value=0).abs()
+            max_difference = max(max_difference, difference.max())
+        report.append({
+            "mode": f"{partition} ({num_workers} workers)",
+            "seconds": round(elapsed, 3),
+            "max_area_difference": max_difference,
+            "matches": bool(max_difference <= tolerance),
+        })
+    return report
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the landuse geometry steps on synthetic polygons")
+    parser.add_argument("-s", "--sizes", nargs="+", type=int, default=[10_000, 100_000],
+                        help="Number of polygons to benchmark")
+    parser.add_argument("-r", "--reference_size", type=int, default=500,
+                        help="Number of polygons compared against the previous implementation")
+    parser.add_argument("-l", "--lots", type=int, default=10_000,
+                        help="Number of lots in the overlay benchmark")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Processes in the overlay benchmark")
+    parser.add_argument("-v", "--view", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    report = benchmark_cut_out(args.sizes, args.reference_size)
+    print(tabulate(report, headers="keys"))
+    report = benchmark_overlay(args.lots, args.lots, args.workers)
+    print(tabulate(report, headers="keys"))
+
+    if args.view:
+        random_polygons(args.reference_size).plot(
+            facecolor="none", edgecolor="black")
+        plt.show()
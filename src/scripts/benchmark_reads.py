@@ -0,0 +1,90 @@
+import argparse
+import glob
+import json
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+# Imported up front so loading the library is not counted as read memory
+import pyarrow  # noqa: F401
+import pyogrio
+from tabulate import tabulate
+
+ID_COLUMNS = ["lot_id", "cvegeo"]
+READ_MODES = {
+    "default": {"use_arrow": False},
+    "arrow": {"use_arrow": True},
+    "arrow_ids": {"use_arrow": True, "ids_only": True},
+}
+
+
+def read_layer(filename: str, use_arrow: bool, ids_only: bool = False) -> dict:
+    """Reads a layer in a fresh process and returns the decode time and peak memory"""
+    columns = None
+    if ids_only:
+        fields = pyogrio.read_info(filename)["fields"]
+        columns = [col for col in ID_COLUMNS if col in fields]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    gdf = pyogrio.read_dataframe(
+        filename, columns=columns, use_arrow=use_arrow)
+    decode_time = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "features": len(gdf),
+        "columns": len(gdf.columns) - 1,
+        "decode_s": round(decode_time, 3),
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": round(peak / 1024, 1),
+        "read_rss_mb": round((peak - baseline) / 1024, 1),
+    }
+
+
+def benchmark_file(filename: str) -> list:
+    report = []
+    for mode, kwargs in READ_MODES.items():
+        # Every read runs in its own process so the peak RSS is not shared
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            result = executor.submit(read_layer, filename, **kwargs).result()
+        report.append({
+            "file": os.path.basename(filename),
+            "size_mb": round(os.path.getsize(filename) / 1024 / 1024, 2),
+            "mode": mode,
+            **result,
+        })
+    return report
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Compare decode time and peak memory of the layer read paths")
+    parser.add_argument("folder", type=str,
+                        help="The folder with the layers")
+    parser.add_argument("-l", "--layers", nargs="+", default=None,
+                        help="The layers to read, by default the largest ones")
+    parser.add_argument("-n", "--num_layers", type=int, default=3,
+                        help="How many of the largest layers to read")
+    parser.add_argument("-v", "--view", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    if args.layers:
+        files = [f"{args.folder}/{layer}.fgb" for layer in args.layers]
+    else:
+        files = sorted(glob.glob(f"{args.folder}/*.fgb"),
+                       key=os.path.getsize, reverse=True)[:args.num_layers]
+
+    report = []
+    for filename in files:
+        report.extend(benchmark_file(filename))
+        if args.view:
+            print(tabulate(report[-len(READ_MODES):], headers="keys"))
+
+    print(tabulate(report, headers="keys"))
+    with open(f"{args.folder}/read_report.json", "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import shapely
+from affine import Affine
+from tabulate import tabulate
+
+from src.scripts.slopes import calculate_slope
+from src.scripts.utils.synthetic import random_lots
+from src.scripts.utils.zonal import zonal_stats_gdf
+
+
+def zonal_mean_pairwise(gdf_lots, values, transform):
+    """Previous implementation, one box per pixel and an intersects scan per lot"""
+    rows, cols = np.nonzero(values)
+    x = transform.c + cols * transform.a
+    y = transform.f + rows * transform.e
+    pixels = gpd.GeoDataFrame({
+        "geometry": shapely.box(x, y + transform.e, x + transform.a, y),
+        "value": values[rows, cols],
+    })
+    means = []
+    for _, lot in gdf_lots.iterrows():
+        intersecting = pixels[pixels.geometry.intersects(lot.geometry)]
+        means.append(intersecting["value"].mean()
+                     if not intersecting.empty else None)
+    return np.array(means, dtype=float)
+
+
+def random_dem(size: int, resolution: float, seed: int = 0) -> tuple:
+    """Smooth terrain made of a few hills, in meters on a projected grid"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    elevation = np.full((size, size), 500.0)
+    for cx, cy, height, width in rng.random((12, 4)):
+        elevation += 800 * height * \
+            np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (0.02 + 0.1 * width))
+    transform = Affine(resolution, 0, 0, 0, -resolution, size * resolution)
+    return elevation, transform
+
+
+def benchmark_zonal(size: int, num_lots: int, resolution: float, reference_size: int, reference_lots: int) -> list:
+    report = []
+    elevation, transform = random_dem(reference_size, resolution)
+    slope = calculate_slope(elevation, transform)
+    gdf_lots = random_lots(reference_lots, reference_size * resolution, shrink=(0.05, 0.3))
+    start = time.time()
+    expected = zonal_mean_pairwise(gdf_lots, slope, transform)
+    pairwise_time = time.time() - start
+    start = time.time()
+    result = zonal_stats_gdf(gdf_lots, slope, transform)["mean"].to_numpy()
+    zonal_time = time.time() - start
+    report.append({
+        "pixels": reference_size ** 2,
+        "lots": reference_lots,
+        "pairwise_s": round(pairwise_time, 3),
+        "pairwise_estimated_s": None,
+        "zonal_s": round(zonal_time, 3),
+        # Pixels only touching a lot were counted before, so the means differ slightly
+        "mean_abs_difference": round(float(np.nanmean(np.abs(expected - result))), 4),
+    })
+
+    elevation, transform = random_dem(size, resolution)
+    slope = calculate_slope(elevation, transform)
+    gdf_lots = random_lots(num_lots, size * resolution, shrink=(0.05, 0.3))
+    start = time.time()
+    zonal_stats_gdf(gdf_lots, slope, transform, percentiles=[10, 50, 90])
+    report.append({
+        "pixels": size ** 2,
+        "lots": num_lots,
+        # Not run, every lot scanned every pixel
+        "pairwise_s": None,
+        "pairwise_estimated_s": round(pairwise_time * (size / reference_size) ** 2 * num_lots / reference_lots),
+        "zonal_s": round(time.time() - start, 3),
+        "mean_abs_difference": None,
+    })
+    return report
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the lot slope statistics on a synthetic city DEM")
+    parser.add_argument("-s", "--size", type=int, default=4000,
+                        help="Side of the DEM in pixels, 4000 at 15 m covers a metropolitan area")
+    parser.add_argument("-l", "--lots", type=int, default=500_000,
+                        help="Number of lots over the DEM")
+    parser.add_argument("-r", "--resolution", type=float, default=15,
+                        help="Size of the pixels in meters")
+    parser.add_argument("--reference_size", type=int, default=200,
+                        help="Side of the DEM compared against the previous implementation")
+    parser.add_argument("--reference_lots", type=int, default=200,
+                        help="Number of lots compared against the previous implementation")
+    parser.add_argument("-v", "--view", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    report = benchmark_zonal(args.size, args.lots, args.resolution,
+                             args.reference_size, args.reference_lots)
+    print(tabulate(report, headers="keys"))
+
+    if args.view:
+        elevation, transform = random_dem(args.reference_size, args.resolution)
+        plt.imshow(calculate_slope(elevation, transform), cmap="viridis")
+        plt.show()
@@ -0,0 +1,153 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.windows import Window, from_bounds
+from tqdm import tqdm
+
+from src.scripts.utils.constants import (
+    BUILDING_HEIGHTS_LOTS_FILE,
+    BUILDING_PRESENCE_THRESHOLD,
+    BUILDING_RASTER_FILE,
+    LANDUSE_LOTS_FILE,
+    LEVEL_HEIGHT,
+)
+from src.scripts.utils.zonal import zonal_stats_gdf
+from src.utils.db import update_columns
+
+HEIGHT_COLUMNS = ["built_fraction", "mean_height",
+                  "p90_height", "estimated_levels"]
+
+
+def lot_windows(gdf_lots: gpd.GeoDataFrame, transform, raster_shape: tuple, window_size: int) -> list:
+    """
+    Groups the lots by the window of the raster their representative point
+    falls in, so every lot is read whole from a single window. Returns
+    (window, lots) pairs, as grown windows of different groups can coincide.
+    """
+    points = gdf_lots.geometry.representative_point()
+    inverse = ~transform
+    cols = inverse.a * points.x + inverse.b * points.y + inverse.c
+    rows = inverse.d * points.x + inverse.e * points.y + inverse.f
+    keys = pd.Series(list(zip(
+        (rows // window_size).astype(int), (cols // window_size).astype(int))), index=gdf_lots.index)
+    height, width = raster_shape
+    full_window = Window(0, 0, width, height)
+    windows = []
+    for _, gdf_window in gdf_lots.groupby(keys):
+        # The window grows to cover the whole lots of the group
+        window = from_bounds(*gdf_window.total_bounds, transform=transform)
+        window = window.round_offsets(op="floor").round_lengths(op="ceil")
+        window = Window(window.col_off, window.row_off,
+                        window.width + 1, window.height + 1)
+        try:
+            windows.append((window.intersection(full_window), gdf_window))
+        except rasterio.errors.WindowError:
+            continue
+    return windows
+
+
+def window_heights(raster_file: str, window: Window, gdf_lots: gpd.GeoDataFrame, threshold: float) -> pd.DataFrame:
+    with rasterio.open(raster_file) as src:
+        presence, heights = src.read([1, 2], window=window)
+        transform = src.window_transform(window)
+    built = presence > threshold
+    built_stats = zonal_stats_gdf(gdf_lots, built.astype(np.float32), transform)
+    height_stats = zonal_stats_gdf(
+        gdf_lots, heights, transform, valid=built, percentiles=[90])
+    return pd.DataFrame({
+        "built_fraction": built_stats["mean"],
+        "mean_height": height_stats["mean"],
+        "p90_height": height_stats["p90"],
+    }, index=gdf_lots.index)
+
+
+def calculate_building_heights(
+    gdf_lots: gpd.GeoDataFrame,
+    raster_file: str,
+    threshold: float = BUILDING_PRESENCE_THRESHOLD,
+    window_size: int = 4096,
+    num_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Built-up fraction, mean and 90th percentile height of the built cells and
+    the estimated levels of each lot, from the presence and height bands of
+    the Open Buildings Temporal raster read window by window.
+    """
+    with rasterio.open(raster_file) as src:
+        gdf_lots = gdf_lots.to_crs(src.crs)
+        windows = lot_windows(gdf_lots, src.transform,
+                              (src.height, src.width), window_size)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        results = list(tqdm(
+            executor.map(lambda item: window_heights(raster_file, *item, threshold), windows),
+            total=len(windows),
+        ))
+    df_heights = pd.concat(results).reindex(gdf_lots.index)
+    df_heights["built_fraction"] = df_heights["built_fraction"].fillna(0)
+    # The tallest part of the lot sets its levels, at least one when it has buildings
+    df_heights["estimated_levels"] = (
+        (df_heights["p90_height"] / LEVEL_HEIGHT).round().clip(lower=1).fillna(0)
+    )
+    return df_heights
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Estimate the building height and levels of the lots")
+    parser.add_argument("input_dir", type=str,
+                        help="The folder all the original data")
+    parser.add_argument("output_dir", type=str,
+                        help="The folder to save the output data")
+    parser.add_argument("-r", "--raster_file", type=str, default=None,
+                        help="The combined presence and height raster, by default the one in the output folder")
+    parser.add_argument("-t", "--threshold", type=float, default=BUILDING_PRESENCE_THRESHOLD,
+                        help="Presence above which a cell counts as built")
+    parser.add_argument("-s", "--window_size", type=int, default=4096,
+                        help="Side of the raster windows in pixels")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Threads processing the windows")
+    parser.add_argument("-d", "--database", action="store_true",
+                        help="Also write the columns to the lots table of the database")
+    parser.add_argument("--schema", type=str, default=None,
+                        help="Schema of the lots table")
+    parser.add_argument("-v", "--view", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    raster_file = args.raster_file or f"{args.output_dir}/{BUILDING_RASTER_FILE}"
+
+    start = time.time()
+    gdf_lots = gpd.read_file(
+        f"{args.output_dir}/{LANDUSE_LOTS_FILE}", engine="pyogrio")
+    df_heights = calculate_building_heights(
+        gdf_lots, raster_file, args.threshold, args.window_size, args.workers)
+    df_heights.insert(0, "lot_id", gdf_lots["lot_id"])
+    df_heights.to_csv(
+        f"{args.output_dir}/{BUILDING_HEIGHTS_LOTS_FILE}", index=False)
+    print(f"Heights of {len(df_heights)} lots computed in {time.time() - start:.2f} seconds")
+    print(df_heights[HEIGHT_COLUMNS].describe())
+
+    if args.database:
+        updated = update_columns(
+            "lots", df_heights, "lot_id", HEIGHT_COLUMNS, schema=args.schema)
+        print(f"{updated} lots updated in the database")
+
+    if args.view:
+        gdf_lots[HEIGHT_COLUMNS] = df_heights[HEIGHT_COLUMNS]
+        fig, ax = plt.subplots(ncols=2, figsize=(30, 15))
+        ax[0].set_axis_off()
+        ax[1].set_axis_off()
+        ax[0].set_title("Fracción construida")
+        ax[1].set_title("Niveles estimados")
+        gdf_lots.plot(ax=ax[0], column="built_fraction", legend=True)
+        gdf_lots.plot(ax=ax[1], column="estimated_levels", legend=True)
+        plt.show()
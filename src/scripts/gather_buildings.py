@@ -1,80 +1,215 @@
-from shapely.ops import unary_union
-from shapely.geometry import shape
-from rasterio.features import shapes
-from rasterio.merge import merge
 import rasterio
+import rasterio.shutil
+import xml.etree.ElementTree as ET
 import zipfile
 import argparse
+import json
+import queue
+import tempfile
+import threading
 
 import os
 import ee
+import fiona
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import requests
 from geopandas import GeoDataFrame
 import osmnx as ox
-import pandas as pd
+import pyogrio
+from pyogrio.errors import DataLayerError, DataSourceError
+import shapely
 from shapely.geometry import box
+from tenacity import (
+    AsyncRetrying,
+    retry,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 
 from src.scripts.utils.constants import BOUNDS_FILE, BUILDING_FILE, BUILDING_CONFIDENCE
+from src.scripts.utils.polygonize import polygonize_raster
 from src.scripts.utils.utils import gdf_to_ee_polygon
 
 import aiohttp
 import asyncio
 import geopandas as gpd
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from scipy.ndimage import gaussian_filter
-
-
-async def fetch_geojson(session, url, i, output_dir):
-    filename = os.path.join(output_dir, f"buildings_chunk_{i}.geojson")
-
-    # Check if file already exists
-    if os.path.exists(filename):
-        print(f"Chunk {i} already exists, skipping.")
+from tqdm import tqdm
+
+GDAL_DTYPES = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+# Block cache of GDAL while writing the combined raster, in MB
+COMBINE_CACHE_MB = 256
+CHUNK_MANIFEST_FILE = "manifest.json"
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_TIMEOUT = 300  # s
+DOWNLOAD_CONCURRENCY = 8
+BUILDING_SCHEMA = {
+    "geometry": "Polygon",
+    "properties": {"confidence": "float", "area_in_meters": "float", "full_plus_code": "str"},
+}
+
+
+def is_retryable(exception):
+    """Rate limits, server errors and dropped connections are worth another attempt"""
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status == 429 or exception.status >= 500
+    return isinstance(exception, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def count_chunk_features(filename):
+    """Features of a downloaded chunk, None when the file is not readable GeoJSON"""
+    try:
+        return pyogrio.read_info(filename)["features"]
+    except (DataSourceError, DataLayerError):
         return None
 
-    start_time = time.time()
-    print(f"Start downloading chunk {i}")
-
-    async with session.get(url) as response:
-        if response.status == 429:
-            print(f"Rate limit reached on chunk {i}. Retrying later.")
-            return None
-        data = await response.text()
 
-        # Save to file after downloading
-        with open(filename, 'w') as f:
-            f.write(data)
-        download_time = time.time() - start_time
-        print(f"Finished downloading chunk {
-              i}. Time taken: {download_time:.2f} seconds")
+async def fetch_geojson(session, semaphore, url, i, output_dir):
+    filename = os.path.join(output_dir, f"buildings_chunk_{i}.geojson")
 
+    # The slot is held while backing off, so a rate limit also lowers the concurrency
+    async with semaphore:
+        start_time = time.time()
+        print(f"Start downloading chunk {i}")
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(DOWNLOAD_ATTEMPTS),
+            wait=wait_exponential_jitter(initial=1, max=60),
+            retry=retry_if_exception(is_retryable),
+            before_sleep=lambda state: print(
+                f"Chunk {i} failed ({state.outcome.exception()}), retrying"),
+            reraise=True,
+        ):
+            with attempt:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+
+    # Save to file after downloading, under its final name only once it reads as GeoJSON
+    with open(f"{filename}.part", "wb") as f:
+        f.write(data)
+    num_features = count_chunk_features(f"{filename}.part")
+    if num_features is None:
+        os.remove(f"{filename}.part")
+        raise ValueError(f"Chunk {i} is not valid GeoJSON")
+    os.replace(f"{filename}.part", filename)
+    download_time = time.time() - start_time
+    print(f"Finished downloading chunk {i}: {num_features} features, {len(data) / 1e6:.1f} MB "
+          f"in {download_time:.2f} seconds ({num_features / download_time:.0f} features/s)")
     return filename
 
 
-async def download_in_parallel(urls, output_dir):
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_geojson(session, url, i, output_dir)
-                 for i, url in enumerate(urls)]
-        return await asyncio.gather(*tasks)
+async def download_in_parallel(urls, output_dir, max_downloads=DOWNLOAD_CONCURRENCY):
+    semaphore = asyncio.Semaphore(max_downloads)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)) as session:
+        tasks = [fetch_geojson(session, semaphore, url, i, output_dir)
+                 for i, url in urls.items()]
+        return await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def prepare_chunk_url(i, feature_list, chunk_size):
     start_time = time.time()
-    chunk = feature_list.slice(i, i + chunk_size)
+    chunk = feature_list.slice(i * chunk_size, (i + 1) * chunk_size)
     chunk_collection = ee.FeatureCollection(chunk)
     download_url = chunk_collection.getDownloadURL(
-        filetype="geojson", filename=f"open_buildings_chunk_{i//chunk_size}"
+        filetype="geojson", filename=f"open_buildings_chunk_{i}"
     )
     prepare_time = time.time() - start_time
-    print(f"Chunk {i//chunk_size +
-          1} prepared. Time taken: {prepare_time:.2f} seconds")
+    print(f"Chunk {i} prepared. Time taken: {prepare_time:.2f} seconds")
     return download_url
 
 
-def process_buildings_in_chunks_parallel(gdf_bounds: GeoDataFrame, chunk_size: int = 10000, output_dir="chunks") -> GeoDataFrame:
+def check_chunks(output_dir, total_features, chunk_size):
+    """
+    Compares the features of every chunk file with the ones expected from the
+    total. Incomplete chunks are removed so the next run downloads them again.
+    """
+    num_chunks = -(-total_features // chunk_size)
+    missing = []
+    num_features = 0
+    for i in range(num_chunks):
+        filename = os.path.join(output_dir, f"buildings_chunk_{i}.geojson")
+        expected = min(chunk_size, total_features - i * chunk_size)
+        # Unreadable chunks count as missing
+        found = (count_chunk_features(filename) or 0) if os.path.exists(filename) else 0
+        num_features += found
+        if found != expected:
+            missing.append(i)
+            if os.path.exists(filename):
+                os.remove(filename)
+    print(f"{num_features} of {total_features} features downloaded")
+    if missing:
+        raise RuntimeError(
+            f"{len(missing)} chunks incomplete ({', '.join(map(str, missing))}), run again to download them")
+
+
+def read_building_chunk(chunk_file, boundary=None, min_confidence=BUILDING_CONFIDENCE):
+    """Buildings of a chunk above the confidence that touch the boundary, as records ready to write"""
+    gdf_chunk = gpd.read_file(chunk_file, engine="pyogrio")
+    if gdf_chunk.empty:
+        return []
+    gdf_chunk = gdf_chunk[gdf_chunk["confidence"] >= min_confidence]
+    if boundary is not None:
+        shapely.prepare(boundary)
+        gdf_chunk = gdf_chunk[shapely.intersects(boundary, gdf_chunk.geometry.values)]
+    properties = gdf_chunk.reindex(columns=list(BUILDING_SCHEMA["properties"]))
+    properties = properties.astype(object).where(properties.notna(), None)
+    return [
+        {"geometry": geometry.__geo_interface__, "properties": row}
+        for geometry, row in zip(gdf_chunk.geometry, properties.to_dict("records"))
+    ]
+
+
+def merge_building_chunks(chunk_files, output_file, gdf_bounds=None, min_confidence=BUILDING_CONFIDENCE, num_workers=None):
+    """
+    Writes the buildings of the downloaded chunks to a single FlatGeobuf.
+    Chunks are parsed and filtered in a process pool and appended as they
+    finish, with only a few of them waiting in memory at a time. The spatial
+    index built when the file is closed stores the features in Hilbert order.
+    """
+    start_time = time.time()
+    num_workers = num_workers or os.cpu_count()
+    boundary = gdf_bounds.to_crs("EPSG:4326").unary_union if gdf_bounds is not None else None
+    num_features = 0
+    with fiona.open(output_file, "w", driver="FlatGeobuf", schema=BUILDING_SCHEMA, crs="EPSG:4326") as dst, \
+            ProcessPoolExecutor(max_workers=num_workers) as executor:
+        progress = tqdm(total=len(chunk_files))
+
+        def write_done(done):
+            nonlocal num_features
+            for future in done:
+                records = future.result()
+                dst.writerecords(records)
+                num_features += len(records)
+                progress.update()
+
+        pending = set()
+        for chunk_file in chunk_files:
+            # Only a few chunks are kept in memory waiting to be written
+            if len(pending) >= 2 * num_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_done(done)
+            pending.add(executor.submit(read_building_chunk, chunk_file, boundary, min_confidence))
+        write_done(wait(pending).done)
+        progress.close()
+    print(f"{num_features} buildings written to {output_file} in {time.time() - start_time:.2f} seconds")
+    return num_features
+
+
+def process_buildings_in_chunks_parallel(gdf_bounds: GeoDataFrame, output_file: str, chunk_size: int = 10000, output_dir="chunks", max_downloads: int = DOWNLOAD_CONCURRENCY) -> int:
 
     os.makedirs(output_dir, exist_ok=True)
     total_start_time = time.time()
@@ -96,60 +231,62 @@ def process_buildings_in_chunks_parallel(gdf_bounds: GeoDataFrame, chunk_size: i
     print(f"Total features: {total_features}. Time to get features: {
           feature_time:.2f} seconds")
 
-    # Prepare download URLs
+    # Small areas are split so every download slot gets a chunk
+    chunk_size = max(1, min(chunk_size, -(-total_features // max_downloads)))
+
+    # Prepare download URLs of the chunks not downloaded yet
+    num_chunks = -(-total_features // chunk_size)
+    pending = [
+        i for i in range(num_chunks)
+        if not os.path.exists(os.path.join(output_dir, f"buildings_chunk_{i}.geojson"))
+    ]
+    print(f"{num_chunks - len(pending)} of {num_chunks} chunks already downloaded")
     prepare_start_time = time.time()
-    urls = []
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(prepare_chunk_url, i, feature_list, chunk_size)
-                   for i in range(0, 200000, chunk_size)]
-        for future in as_completed(futures):
-            urls.append(future.result())
+    with ThreadPoolExecutor(max_downloads) as executor:
+        urls = dict(zip(pending, executor.map(
+            lambda i: prepare_chunk_url(i, feature_list, chunk_size), pending)))
     prepare_time = time.time() - prepare_start_time
     print(f"URLs prepared in parallel. Time taken: {prepare_time:.2f} seconds")
 
-    print("Finished preparing all URLs")
-    # print all urls
-    for url in urls:
-        print(url)
-
     # Download in parallel
     download_start_time = time.time()
     print("Start downloading...")
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(download_in_parallel(urls, output_dir))
+    results = asyncio.run(download_in_parallel(urls, output_dir, max_downloads))
+    for i, result in zip(urls, results):
+        if isinstance(result, Exception):
+            print(f"Chunk {i} failed: {result}")
     download_time = time.time() - download_start_time
     print(f"Finished downloading all chunks. Time taken: {
           download_time:.2f} seconds")
+    check_chunks(output_dir, total_features, chunk_size)
 
-    # Concatenate chunks
-    concat_start_time = time.time()
-    gdfs = []
-    for filename in os.listdir(output_dir):
-        if filename.endswith(".geojson"):
-            gdf_chunk = gpd.read_file(os.path.join(output_dir, filename))
-            gdfs.append(gdf_chunk)
-    gdf_buildings = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True))
-    concat_time = time.time() - concat_start_time
-    print(f"Finished concatenating chunks. Time taken: {
-          concat_time:.2f} seconds")
+    # Merge chunks
+    chunk_files = [os.path.join(output_dir, f"buildings_chunk_{i}.geojson") for i in range(num_chunks)]
+    num_buildings = merge_building_chunks(chunk_files, output_file, gdf_bounds)
 
     total_time = time.time() - total_start_time
     print(f"Total time for process: {total_time:.2f} seconds")
 
-    return gdf_buildings
+    return num_buildings
 
 
+@retry(
+    stop=stop_after_attempt(DOWNLOAD_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    retry=retry_if_exception_type(requests.RequestException),
+    reraise=True,
+)
 def download_chunk(url, chunk_id, output_dir):
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        zip_path = os.path.join(output_dir, f"chunk_{chunk_id}.zip")
-        with open(zip_path, "wb") as zip_file:
-            zip_file.write(response.content)
-        print(f"Chunk {chunk_id} downloaded.")
-        return zip_path
-    else:
-        raise RuntimeError(f"Failed to download chunk {
-                           chunk_id}. HTTP Status: {response.status_code}")
+    """Streams the zip of a chunk to disk, it only gets its final name once complete"""
+    zip_path = os.path.join(output_dir, f"chunk_{chunk_id}.zip")
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(f"{zip_path}.part", "wb") as zip_file:
+            for data in response.iter_content(chunk_size=1024 * 1024):
+                zip_file.write(data)
+    os.replace(f"{zip_path}.part", zip_path)
+    print(f"Chunk {chunk_id} downloaded.")
+    return zip_path
 
 
 def extract_rasters(zip_path, chunk_id, output_dir):
@@ -174,116 +311,232 @@ def extract_rasters(zip_path, chunk_id, output_dir):
     return rasters
 
 
+def build_vrt(band_files, vrt_file):
+    """
+    Writes a virtual mosaic with one band per list of files. Every file is a
+    source placed on the grid of the union of their bounds, so nothing is
+    read until the mosaic is.
+    """
+    with rasterio.open(band_files[0][0]) as src:
+        crs, dtype, nodata = src.crs, src.dtypes[0], src.nodata
+        res_x, res_y = src.res
+    bounds = []
+    for files in band_files:
+        for fp in files:
+            with rasterio.open(fp) as src:
+                bounds.append(src.bounds)
+    left, bottom = min(b.left for b in bounds), min(b.bottom for b in bounds)
+    right, top = max(b.right for b in bounds), max(b.top for b in bounds)
+    width, height = round((right - left) / res_x), round((top - bottom) / res_y)
+
+    dataset = ET.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(dataset, "SRS").text = crs.to_wkt()
+    ET.SubElement(dataset, "GeoTransform").text = f"{left}, {res_x}, 0, {top}, 0, {-res_y}"
+    for band, files in enumerate(band_files, start=1):
+        band_element = ET.SubElement(
+            dataset, "VRTRasterBand", dataType=GDAL_DTYPES[dtype], band=str(band))
+        if nodata is not None:
+            ET.SubElement(band_element, "NoDataValue").text = str(nodata)
+        # Later sources are drawn on top, reversed so the first file wins like in merge
+        for fp in reversed(files):
+            with rasterio.open(fp) as src:
+                source = ET.SubElement(band_element, "ComplexSource")
+                ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = os.path.abspath(fp)
+                ET.SubElement(source, "SourceBand").text = "1"
+                ET.SubElement(source, "SrcRect", xOff="0", yOff="0",
+                              xSize=str(src.width), ySize=str(src.height))
+                ET.SubElement(source, "DstRect",
+                              xOff=str(round((src.bounds.left - left) / res_x)),
+                              yOff=str(round((top - src.bounds.top) / res_y)),
+                              xSize=str(round((src.bounds.right - src.bounds.left) / res_x)),
+                              ySize=str(round((src.bounds.top - src.bounds.bottom) / res_y)))
+                if src.nodata is not None:
+                    ET.SubElement(source, "NODATA").text = str(src.nodata)
+    ET.ElementTree(dataset).write(vrt_file)
+
+
 def combine_rasters(raster_files, combined_output_file):
-    presence_files = raster_files["presence"]
-    height_files = raster_files["height"]
-
-    # Merge presence rasters
-    presence_sources = [rasterio.open(fp) for fp in presence_files]
-    presence_merged, presence_transform = merge(presence_sources)
-    for src in presence_sources:
-        src.close()
-
-    # Merge height rasters
-    height_sources = [rasterio.open(fp) for fp in height_files]
-    height_merged, height_transform = merge(height_sources)
-    for src in height_sources:
-        src.close()
-
-    # Write the combined raster
-    with rasterio.open(
-        combined_output_file,
-        "w",
-        driver="GTiff",
-        height=presence_merged.shape[1],
-        width=presence_merged.shape[2],
-        count=2,  # Two bands: presence and height
-        dtype=presence_merged.dtype,
-        crs=presence_sources[0].crs,
-        transform=presence_transform,
-    ) as dest:
-        dest.write(presence_merged[0], 1)  # Band 1: presence
-        dest.write(height_merged[0], 2)    # Band 2: height
+    """
+    Mosaics the presence and height chunks into a two band Cloud Optimized
+    GeoTIFF. The chunks are joined in a VRT and GDAL copies it block by block,
+    so memory depends on the block size and cache, not on the city size.
+    """
+    vrt_file = f"{os.path.splitext(combined_output_file)[0]}.vrt"
+    build_vrt([raster_files["presence"], raster_files["height"]], vrt_file)
+
+    with rasterio.Env(GDAL_CACHEMAX=COMBINE_CACHE_MB):
+        rasterio.shutil.copy(
+            vrt_file,
+            combined_output_file,
+            driver="COG",
+            compress="DEFLATE",
+            predictor="YES",
+            blocksize=512,
+            overviews="AUTO",
+            overview_resampling="AVERAGE",
+            bigtiff="IF_SAFER",
+            num_threads="ALL_CPUS",
+        )
+    os.remove(vrt_file)
 
     print(f"Combined raster saved as {combined_output_file}")
 
 
-def process_image_collection_to_raster(
-    gdf_bounds, combined_output_file, output_dir="chunks", chunk_size=0.05
-):
-    os.makedirs(output_dir, exist_ok=True)
+@retry(
+    stop=stop_after_attempt(DOWNLOAD_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    reraise=True,
+)
+def prepare_raster_url(chunk_bounds, crs):
+    chunk_gdf = gpd.GeoDataFrame({"geometry": [box(*chunk_bounds)]}, crs=crs)
+    ee_polygon = gdf_to_ee_polygon(chunk_gdf)
+    image = (
+        ee.ImageCollection("GOOGLE/Research/open-buildings-temporal/v1")
+        .filterBounds(ee_polygon)
+        .mean()
+    )
+    return image.getDownloadURL(
+        {"scale": 0.3, "region": ee_polygon, "fileFormat": "GeoTIFF"})
 
-    # Divide bounds into chunks
-    bounds = gdf_bounds.total_bounds  # [minx, miny, maxx, maxy]
-    xmin, ymin, xmax, ymax = bounds
+
+def chunk_plan(gdf_bounds, chunk_size):
+    """Ids and bounds of the chunks of the grid over the bounds that touch them"""
+    xmin, ymin, xmax, ymax = gdf_bounds.total_bounds
     x_steps = int((xmax - xmin) / chunk_size) + 1
     y_steps = int((ymax - ymin) / chunk_size) + 1
-
-    raster_files = {"presence": [], "height": []}
-
+    boundary = gdf_bounds.unary_union
+    chunks = {}
     for i in range(x_steps):
         for j in range(y_steps):
-            chunk_id = f"{i}_{j}"
             chunk_xmin = xmin + i * chunk_size
-            chunk_xmax = min(chunk_xmin + chunk_size, xmax)
             chunk_ymin = ymin + j * chunk_size
-            chunk_ymax = min(chunk_ymin + chunk_size, ymax)
-
-            # Define chunk geometry
-            chunk_geom = box(chunk_xmin, chunk_ymin, chunk_xmax, chunk_ymax)
-            chunk_gdf = gpd.GeoDataFrame(
-                {"geometry": [chunk_geom]}, crs=gdf_bounds.crs)
-            ee_polygon = gdf_to_ee_polygon(chunk_gdf)
-
-            # Generate download URL
+            chunk_bounds = (chunk_xmin, chunk_ymin, min(chunk_xmin + chunk_size, xmax),
+                            min(chunk_ymin + chunk_size, ymax))
+            if box(*chunk_bounds).intersects(boundary):
+                chunks[f"{i}_{j}"] = chunk_bounds
+    return chunks
+
+
+def load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    # Chunks whose rasters were removed are downloaded again
+    return {
+        chunk_id: rasters for chunk_id, rasters in manifest.items()
+        if all(os.path.exists(fp) for fp in rasters.values())
+    }
+
+
+def run_chunk_pipeline(chunks, output_dir, prepare_url, prepare_workers=4, download_workers=4):
+    """
+    Prepares the URL, downloads and extracts every chunk not yet in the
+    manifest of `output_dir`. Each stage has its own threads and the stages
+    are joined by bounded queues, so URLs are not prepared much faster than
+    they are downloaded. Every extracted chunk is saved to the manifest right
+    away, so a rerun only processes the missing ones. Returns the manifest
+    and the chunks that failed after all their retries.
+    """
+    manifest_file = os.path.join(output_dir, CHUNK_MANIFEST_FILE)
+    manifest = load_manifest(manifest_file)
+    pending = [chunk_id for chunk_id in chunks if chunk_id not in manifest]
+    print(f"{len(manifest)} chunks already done, {len(pending)} to process")
+
+    lock = threading.Lock()
+    failures = {}
+    chunk_queue = queue.Queue()
+    url_queue = queue.Queue(maxsize=2 * download_workers)
+    zip_queue = queue.Queue(maxsize=2 * download_workers)
+    for chunk_id in pending:
+        chunk_queue.put((chunk_id,))
+
+    def prepare(chunk_id):
+        url_queue.put((chunk_id, prepare_url(chunks[chunk_id])))
+
+    def download(chunk_id, url):
+        zip_queue.put((chunk_id, download_chunk(url, chunk_id, output_dir)))
+
+    def extract(chunk_id, zip_path):
+        rasters = extract_rasters(zip_path, chunk_id, output_dir)
+        os.remove(zip_path)
+        with lock:
+            manifest[chunk_id] = rasters
+            with open(f"{manifest_file}.tmp", "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(f"{manifest_file}.tmp", manifest_file)
+
+    def worker(source, process):
+        # Each worker stops at a None, one is queued per worker once the previous stage ends
+        while (item := source.get()) is not None:
             try:
-                image = (
-                    ee.ImageCollection(
-                        "GOOGLE/Research/open-buildings-temporal/v1")
-                    .filterBounds(ee_polygon)
-                    .mean()
-                )
-                url = image.getDownloadURL(
-                    {"scale": 0.3, "region": ee_polygon, "fileFormat": "GeoTIFF"})
-                zip_path = download_chunk(url, chunk_id, output_dir)
-                rasters = extract_rasters(zip_path, chunk_id, output_dir)
-                raster_files["presence"].append(rasters["presence"])
-                raster_files["height"].append(rasters["height"])
+                process(*item)
             except Exception as e:
-                print(f"Error processing chunk {chunk_id}: {e}")
-
-    # Combine all rasters into a single file
-    combine_rasters(raster_files, combined_output_file)
+                print(f"Error processing chunk {item[0]}: {e}")
+                with lock:
+                    failures[item[0]] = str(e)
 
+    start_time = time.time()
+    stages = [
+        (chunk_queue, prepare, prepare_workers),
+        (url_queue, download, download_workers),
+        (zip_queue, extract, 1),
+    ]
+    threads = [
+        [threading.Thread(target=worker, args=(source, process))
+         for _ in range(num_workers)]
+        for source, process, num_workers in stages
+    ]
+    for stage_threads in threads:
+        for thread in stage_threads:
+            thread.start()
+    for (source, _, num_workers), stage_threads in zip(stages, threads):
+        for _ in range(num_workers):
+            source.put(None)
+        for thread in stage_threads:
+            thread.join()
+    print(f"{len(pending) - len(failures)} chunks processed in {time.time() - start_time:.2f} seconds")
+    return manifest, failures
 
-def raster_to_gdf(raster, band_index=1, threshold=0.3):
-    band_data = raster.read(band_index)
 
-    # Apply threshold (mask everything below the threshold)
-    mask = band_data > threshold
+def process_image_collection_to_raster(
+    gdf_bounds, combined_output_file, output_dir="chunks", chunk_size=0.05,
+    prepare_workers=4, download_workers=4,
+):
+    os.makedirs(output_dir, exist_ok=True)
 
-    # Transform raster values to shapes
-    print("Transforming raster to polygons...")
-    transform = raster.transform
-    shapes_gen = shapes(band_data, mask=mask, transform=transform)
-
-    # Convert shapes to polygons
-    polygons = []
-    for geom, value in shapes_gen:
-        if value > threshold:  # Ensure the value matches the threshold
-            polygons.append(shape(geom))
-
-    # Combine all polygons into a single geometry
-    combined_geometry = unary_union(polygons)
-    print(f"Generated combined geometry with {len(polygons)} parts.")
-
-    # Create GeoDataFrame
-    gdf = gpd.GeoDataFrame(
-        {"geometry": [combined_geometry]},
-        crs=raster.crs  # Use the CRS from the raster file
+    # Divide bounds into chunks
+    chunks = chunk_plan(gdf_bounds, chunk_size)
+    manifest, failures = run_chunk_pipeline(
+        chunks,
+        output_dir,
+        lambda chunk_bounds: prepare_raster_url(chunk_bounds, gdf_bounds.crs),
+        prepare_workers=prepare_workers,
+        download_workers=download_workers,
     )
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} chunks failed ({', '.join(sorted(failures))}), run again to resume")
 
-    return gdf
+    # Combine all rasters into a single file
+    raster_files = {
+        "presence": [manifest[chunk_id]["presence"] for chunk_id in chunks],
+        "height": [manifest[chunk_id]["height"] for chunk_id in chunks],
+    }
+    combine_rasters(raster_files, combined_output_file)
+
+
+def raster_to_gdf(raster, band_index=1, threshold=0.3, output_file=None):
+    """
+    Polygons of the cells above the threshold, written window by window to
+    `output_file` (a temporary FlatGeobuf by default) and read back.
+    """
+    print("Transforming raster to polygons...")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = output_file or f"{tmp_dir}/polygons.fgb"
+        polygonize_raster(raster.name, output_file,
+                          band_index=band_index, threshold=threshold)
+        return gpd.read_file(output_file, engine="pyogrio")
 
 
 def get_args():
@@ -325,8 +578,8 @@ if __name__ == "__main__":
     # gdf_bounds.plot()
     # plt.show()
     # # gdf_bounds = gpd.read_file(f"data/_primavera/final/culiacan_centro_bounds.fgb")
-    # gdf_buildings = process_buildings_in_chunks_parallel(gdf_bounds, output_dir=args.output_dir + "/chunks")
-    # gdf_buildings.to_file(f"{args.output_dir}/{BUILDING_FILE}")
+    # process_buildings_in_chunks_parallel(gdf_bounds, f"{args.output_dir}/{BUILDING_FILE}", output_dir=args.output_dir + "/chunks")
     # if args.view:
+    #     gdf_buildings = gpd.read_file(f"{args.output_dir}/{BUILDING_FILE}")
     #     gdf_buildings.plot()
     #     plt.show()
@@ -5,14 +5,14 @@ import ee
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import requests
-import rioxarray
 from geopandas import GeoDataFrame
 
-from src.scripts.utils.utils import gdf_to_ee_polygon, to_gdf
+from src.scripts.utils.polygonize import polygonize_raster
+from src.scripts.utils.utils import gdf_to_ee_polygon
 from src.scripts.utils.constants import BOUNDS_FILE, VEGETATION_FILE
 
 
-def process_green_area(gdf_bounds: GeoDataFrame) -> GeoDataFrame:
+def process_green_area(gdf_bounds: GeoDataFrame, output_file: str, num_workers: int = None) -> int:
     ee.Initialize()
     ee_polygon = gdf_to_ee_polygon(gdf_bounds)
     image = ee.Image("JRC/GHSL/P2023A/GHS_BUILT_C/2018")
@@ -26,13 +26,14 @@ def process_green_area(gdf_bounds: GeoDataFrame) -> GeoDataFrame:
             "crs": "EPSG:4326",
         }
     )
-    response = requests.get(download_url)
-    with tempfile.TemporaryFile() as fp:
-        fp.write(response.content)
-        fp.seek(0)
-        raster = rioxarray.open_rasterio(fp)
-        gdf_builtup = to_gdf(raster).dissolve()
-        return gdf_builtup
+    # The raster is streamed to disk and polygonized by windows from there
+    with tempfile.NamedTemporaryFile(suffix=".tif") as fp:
+        with requests.get(download_url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                fp.write(chunk)
+        fp.flush()
+        return polygonize_raster(fp.name, output_file, num_workers=num_workers)
 
 
 def get_args():
@@ -42,6 +43,8 @@ def get_args():
                         help="The folder all the original data")
     parser.add_argument("output_dir", type=str,
                         help="The folder to save the output data")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Processes polygonizing the raster")
     parser.add_argument("-v", "--view", action="store_true")
     return parser.parse_args()
 
@@ -50,8 +53,8 @@ if __name__ == "__main__":
     args = get_args()
     gdf_bounds = gpd.read_file(
         f"{args.input_dir}/{BOUNDS_FILE}", crs="EPSG:4326")
-    gdf_builtup = process_green_area(gdf_bounds)
-    gdf_builtup.to_file(f"{args.output_dir}/{VEGETATION_FILE}")
+    output_file = f"{args.output_dir}/{VEGETATION_FILE}"
+    process_green_area(gdf_bounds, output_file, num_workers=args.workers)
     if args.view:
-        gdf_builtup.plot()
+        gpd.read_file(output_file, engine="pyogrio").plot()
         plt.show()
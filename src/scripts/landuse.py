@@ -1,18 +1,23 @@
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
-import osmnx as ox
+import numpy as np
 import pandas as pd
+import shapely
 from shapely.geometry import Polygon
+from tqdm import tqdm
 
 from src.scripts.utils.constants import (
     BUFFER_PARKING,
     EQUIPMENT_TAGS,
     GDFS_MAPPING,
     PARK_TAGS,
-    PARKING_FILTER,
     PARKING_TAGS,
+    PARKING_GRID_SIZE,
+    PARKING_TILE_SIZE,
     WALK_RADIUS,
     AMENITIES_FILE_MAPPING,
     BOUNDS_FILE,
@@ -22,41 +27,50 @@ from src.scripts.utils.constants import (
     BUILDING_FILE,
     VEGETATION_FILE,
 )
+from src.scripts.utils.cache import cache_key, get_cache_path
+from src.scripts.utils.osm import OsmCache, get_osm_cache
 from src.scripts.utils.utils import load_gdf
 
 
 def cut_out_inner_polygons(gdf):
-    # Create an empty list to store the resulting geometries
-    result_geometries = []
-
-    # Iterate over each polygon in the GeoDataFrame
-    for i, outer_polygon in gdf.iterrows():
-        # Start with the outer polygon
-        cut_polygon = outer_polygon.geometry
-
-        # Iterate again to find inner polygons
-        for j, inner_polygon in gdf.iterrows():
-            if i != j:
-                # Subtract the inner polygon from the outer polygon
-                if cut_polygon.contains(inner_polygon.geometry):
-                    cut_polygon = cut_polygon.difference(
-                        inner_polygon.geometry)
-
-        # Add the resulting geometry to the list
-        result_geometries.append(cut_polygon)
-
-    # Create a new GeoDataFrame with the resulting geometries
+    """
+    Subtracts from every polygon the other polygons it contains. Containment
+    candidates come from a single STRtree query; every polygon then subtracts
+    its candidates in row order, checking them against the already cut
+    polygon, which gives the same result as comparing every pair.
+    """
+    geometries = gdf.geometry.to_numpy()
+    labels = gdf.index.to_numpy()
+    result_geometries = geometries.copy()
+
+    tree = shapely.STRtree(geometries)
+    outer_idx, inner_idx = tree.query(geometries, predicate="contains")
+    order = np.lexsort((inner_idx, outer_idx))
+    outer_idx, inner_idx = outer_idx[order], inner_idx[order]
+    splits = np.flatnonzero(np.diff(outer_idx)) + 1
+
+    for outers, inners in zip(np.split(outer_idx, splits), np.split(inner_idx, splits)):
+        if len(outers) == 0:
+            continue
+        i = outers[0]
+        cut_polygon = geometries[i]
+        for j in inners:
+            if labels[i] != labels[j] and cut_polygon.contains(geometries[j]):
+                cut_polygon = cut_polygon.difference(geometries[j])
+        result_geometries[i] = cut_polygon
+
     gdf["geometry"] = result_geometries
 
     return gdf
 
 
-def overlay_multiple(
+def overlay_multiple_serial(
     gdf_initial: gpd.GeoDataFrame, gdfs: list[gpd.GeoDataFrame]
-) -> gpd.GeoDataFrame:
+) -> list[gpd.GeoDataFrame]:
     previous_gdfs = []
     gdf_residual = gdf_initial.reset_index()
-    cumulative_overlay = gpd.GeoDataFrame(geometry=[])
+    # Earlier classes are kept in a list and only joined when they are subtracted
+    overlaid_gdfs = []
 
     for gdf in gdfs:
         gdf = gdf.explode()
@@ -67,21 +81,245 @@ def overlay_multiple(
         gdf_intersect = gdf_initial.reset_index().overlay(
             gdf_filtered, how="intersection", keep_geom_type=False
         )
-        if not cumulative_overlay.empty:
+        if overlaid_gdfs and not gdf_intersect.empty:
+            cumulative_overlay = gpd.GeoDataFrame(
+                pd.concat(overlaid_gdfs, ignore_index=True), crs=gdf.crs
+            )
             gdf_intersect = gdf_intersect[gdf_intersect.geom_type.isin(
                 ["Polygon", "MultiPolygon"])]
             gdf_intersect = gdf_intersect.overlay(
                 cumulative_overlay, how="difference")
 
-        cumulative_overlay = gpd.GeoDataFrame(
-            pd.concat([cumulative_overlay, gdf], ignore_index=True)
-        )
+        overlaid_gdfs.append(gdf)
         previous_gdfs.append(gdf_intersect)
 
     previous_gdfs.append(gdf_residual)
     return previous_gdfs[::-1]
 
 
+def partition_lots(gdf_lots: gpd.GeoDataFrame, num_partitions: int, partition: str = "grid") -> list[np.ndarray]:
+    """
+    Positions of the lots in each partition, either a grid over the lot
+    centers or their AGEB (first 13 characters of the cvegeo).
+    """
+    if partition == "cvegeo":
+        keys = gdf_lots["cvegeo"].astype(str).str[:13].to_numpy()
+    else:
+        points = shapely.get_coordinates(
+            gdf_lots.geometry.representative_point())
+        minx, miny, maxx, maxy = gdf_lots.total_bounds
+        cells = max(int(np.ceil(np.sqrt(num_partitions))), 1)
+        width = max(maxx - minx, 1e-12) / cells
+        height = max(maxy - miny, 1e-12) / cells
+        col = np.minimum(((points[:, 0] - minx) / width).astype(int), cells - 1)
+        row = np.minimum(((points[:, 1] - miny) / height).astype(int), cells - 1)
+        keys = row * cells + col
+    _, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    splits = np.flatnonzero(np.diff(inverse[order])) + 1
+    return np.split(order, splits)
+
+
+def overlay_multiple(
+    gdf_initial: gpd.GeoDataFrame,
+    gdfs: list[gpd.GeoDataFrame],
+    num_workers: int = None,
+    partition: str = "grid",
+) -> list[gpd.GeoDataFrame]:
+    """
+    Runs `overlay_multiple_serial` on partitions of the lots in a process
+    pool. Every partition only receives the features of each class that
+    touch its lots, and the results per class are concatenated back.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers == 1 or len(gdf_initial) == 0:
+        return overlay_multiple_serial(gdf_initial, gdfs)
+
+    # Several partitions per worker keep the pool busy when some are denser
+    partitions = partition_lots(gdf_initial, 4 * num_workers, partition)
+    trees = [gdf.sindex for gdf in gdfs]
+    tasks = []
+    for positions in partitions:
+        gdf_part = gdf_initial.iloc[positions]
+        part_gdfs = []
+        for gdf, tree in zip(gdfs, trees):
+            indices = np.unique(tree.query(
+                gdf_part.geometry.to_numpy(), predicate="intersects")[1])
+            part_gdfs.append(gdf.iloc[indices])
+        tasks.append((gdf_part, part_gdfs))
+
+    results = [[] for _ in range(len(gdfs) + 1)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(overlay_multiple_serial, *task)
+                   for task in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for i, gdf in enumerate(future.result()):
+                results[i].append(gdf)
+
+    return [
+        gpd.GeoDataFrame(pd.concat(items, ignore_index=True),
+                         crs=gdf_initial.crs)
+        for items in results
+    ]
+
+
+def fragment_areas(geometries: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    Area of every fragment, with fragments of the same key whose interiors
+    overlap counted once: their union is assigned to the first of them.
+    """
+    areas = shapely.area(geometries)
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate="intersects")
+    pairs = (left < right) & (keys[left] == keys[right])
+    left, right = left[pairs], right[pairs]
+    overlapping = shapely.relate_pattern(
+        geometries[left], geometries[right], "T********")
+    order = np.argsort(keys, kind="stable")
+    starts = np.searchsorted(keys[order], np.unique(keys[left[overlapping]]))
+    ends = np.searchsorted(keys[order], keys[order][starts], side="right")
+    for start, end in zip(starts, ends):
+        members = order[start:end]
+        areas[members] = 0
+        areas[members[0]] = shapely.area(
+            shapely.union_all(geometries[members]))
+    return areas
+
+
+def accumulate_landuse_areas(gdf_lots: gpd.GeoDataFrame, gdfs: list[gpd.GeoDataFrame]) -> gpd.GeoDataFrame:
+    """
+    Adds the `*_area` (hectares) and `*_ratio` columns of every class in
+    GDFS_MAPPING to the lots. All the fragments are reprojected to an equal
+    area CRS together and their areas summed per lot and class with a
+    single `np.bincount`.
+    """
+    num_classes = len(GDFS_MAPPING)
+    lot_index = pd.Index(gdf_lots["lot_id"])
+    fragments = gpd.GeoDataFrame(
+        pd.concat(
+            [gdf[["lot_id", "geometry"]].assign(landuse_class=i)
+             for i, gdf in enumerate(gdfs)],
+            ignore_index=True,
+        ),
+        crs=gdfs[0].crs,
+    )
+    positions = lot_index.get_indexer(fragments["lot_id"])
+    fragments = fragments[positions >= 0]
+    positions = positions[positions >= 0]
+
+    keys = positions * num_classes + fragments["landuse_class"].to_numpy()
+    geometries = fragments.to_crs("EPSG:6933").geometry.to_numpy()
+    areas = fragment_areas(geometries, keys) / 10_000
+    totals = np.bincount(keys, weights=areas, minlength=len(
+        gdf_lots) * num_classes).reshape(len(gdf_lots), num_classes)
+
+    gdf_lots = gdf_lots.copy()
+    for i, item in enumerate(GDFS_MAPPING):
+        gdf_lots[f'{item["name"]}_area'] = totals[:, i]
+        gdf_lots[f'{item["name"]}_ratio'] = totals[:, i] / gdf_lots["lot_area"]
+    return gdf_lots
+
+
+def get_parking_features(osm: OsmCache, gdf_bounds: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Service highways and parking areas from OSM inside the bounds"""
+    _, gdf_service_highways = osm.network_gdfs("service")
+    gdf_service_highways = gdf_service_highways.reset_index()
+    gdf_service_highways = gdf_service_highways[
+        gdf_service_highways.intersects(gdf_bounds.unary_union)]
+    gdf_parking_amenities = osm.features(PARKING_TAGS).reset_index()
+    gdf_parking_amenities = gdf_parking_amenities[
+        (gdf_parking_amenities["element_type"] != "node")
+    ]
+    gdf_parking_amenities["geometry"] = gdf_parking_amenities["geometry"].intersection(
+        gdf_bounds.unary_union
+    )
+    return gpd.GeoDataFrame(
+        pd.concat([gdf_service_highways, gdf_parking_amenities],
+                  ignore_index=True),
+        crs="EPSG:4326",
+    )
+
+
+def buffer_tile(geometries: np.ndarray, tile, buffer: float):
+    """Buffered union of the features around a tile, clipped to the tile"""
+    mask = shapely.buffer(shapely.union_all(geometries), buffer)
+    return shapely.intersection(mask, tile)
+
+
+def build_parking_mask(
+    gdf_combined: gpd.GeoDataFrame,
+    buffer: float = BUFFER_PARKING,
+    tile_size: float = PARKING_TILE_SIZE,
+    num_workers: int = None,
+) -> gpd.GeoDataFrame:
+    """
+    Buffers the union of the parking features per tile in a process pool
+    instead of over the whole city. Every tile receives the features up to
+    `buffer` outside of it, so clipping gives the same area as the global
+    buffer, and the pieces are joined on a fine precision grid before
+    filling their holes, so holes crossing a tile seam are filled too.
+    """
+    geometries = gdf_combined.geometry.to_numpy()
+    geometries = geometries[
+        ~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)]
+    if len(geometries) == 0:
+        return gpd.GeoDataFrame(geometry=[], crs=gdf_combined.crs)
+
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    # Neighbouring tiles share the same edge values so their pieces meet exactly
+    edges_x = np.append(
+        np.arange(minx - buffer, maxx + buffer, tile_size), maxx + buffer)
+    edges_y = np.append(
+        np.arange(miny - buffer, maxy + buffer, tile_size), maxy + buffer)
+    i, j = np.meshgrid(np.arange(len(edges_x) - 1),
+                       np.arange(len(edges_y) - 1))
+    i, j = i.ravel(), j.ravel()
+    tiles = shapely.box(edges_x[i], edges_y[j],
+                        edges_x[i + 1], edges_y[j + 1])
+    halos = shapely.box(edges_x[i] - buffer, edges_y[j] - buffer,
+                        edges_x[i + 1] + buffer, edges_y[j + 1] + buffer)
+
+    tree = shapely.STRtree(geometries)
+    tile_idx, geometry_idx = tree.query(halos, predicate="intersects")
+    splits = np.flatnonzero(np.diff(tile_idx)) + 1
+    tasks = [
+        (geometries[indices], tiles[tile[0]], buffer)
+        for tile, indices in zip(np.split(tile_idx, splits), np.split(geometry_idx, splits))
+        if len(tile) > 0
+    ]
+
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers == 1:
+        pieces = [buffer_tile(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            pieces = list(executor.map(buffer_tile, *zip(*tasks)))
+
+    unified_geometry = shapely.union_all(
+        shapely.get_parts(np.array(pieces)), grid_size=PARKING_GRID_SIZE)
+    external_polygons = [
+        Polygon(poly.exterior)
+        for poly in shapely.get_parts(unified_geometry)
+        if isinstance(poly, Polygon)
+    ]
+    return gpd.GeoDataFrame(geometry=external_polygons, crs=gdf_combined.crs)
+
+
+def get_parking_mask(gdf_bounds: gpd.GeoDataFrame, osm: OsmCache, osm_version: str = None, num_workers: int = None) -> gpd.GeoDataFrame:
+    """Parking mask of the bounds, cached on disk by the bounds and the OSM data version"""
+    key = cache_key(gdf_bounds.unary_union, BUFFER_PARKING,
+                    osm_version or osm.version)
+    cache_file = get_cache_path("parking", key, "fgb")
+    if os.path.exists(cache_file):
+        print(f"Loading parking mask from {cache_file}")
+        return gpd.read_file(cache_file, engine="pyogrio")
+
+    gdf_combined = get_parking_features(osm, gdf_bounds)
+    gdf_parking = build_parking_mask(gdf_combined, num_workers=num_workers)
+    gdf_parking.to_file(cache_file, engine="pyogrio")
+    return gdf_parking
+
+
 def get_args():
     parser = argparse.ArgumentParser(
         description="Join establishments with lots")
@@ -89,6 +327,14 @@ def get_args():
                         help="The folder all the original data")
     parser.add_argument("output_dir", type=str,
                         help="The folder to save the output data")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Processes for the overlays, 1 runs them serially")
+    parser.add_argument("-p", "--partition", choices=["grid", "cvegeo"], default="grid",
+                        help="How the lots are split between the processes")
+    parser.add_argument("-o", "--osm_version", type=str, default=None,
+                        help="Version of the OSM data the parking mask is cached for, by default the one of the OSM cache")
+    parser.add_argument("-f", "--landuse_files", action="store_true",
+                        help="Also write the dissolved geometries of every class")
     parser.add_argument("-v", "--view", action="store_true")
     return parser.parse_args()
 
@@ -102,62 +348,29 @@ if __name__ == "__main__":
     gdf_lots = load_gdf(f"{args.output_dir}/{ESTABLISHMENTS_LOTS_FILE}", gdf_bounds)
     gdf_lots["lot_area"] = gdf_lots.to_crs("EPSG:6933").area / 10_000
 
-    # Load the polygons for parking lots
-    G_service_highways = ox.graph_from_polygon(
-        gdf_bounds.unary_union,
-        custom_filter=PARKING_FILTER,
-        network_type="all",
-        retain_all=True,
-    )
-    gdf_service_highways = ox.graph_to_gdfs(
-        G_service_highways, nodes=False
-    ).reset_index()
-    gdf_parking_amenities = ox.geometries_from_polygon(
-        gdf_bounds.unary_union, tags=PARKING_TAGS
-    ).reset_index()
-    gdf_parking_amenities = gdf_parking_amenities[
-        (gdf_parking_amenities["element_type"] != "node")
-    ]
-    gdf_parking_amenities["geometry"] = gdf_parking_amenities["geometry"].intersection(
-        gdf_bounds.unary_union
-    )
-    gdf_combined = gpd.GeoDataFrame(
-        pd.concat([gdf_service_highways, gdf_parking_amenities],
-                  ignore_index=True),
-        crs="EPSG:4326",
-    )
-    unified_geometry = gdf_combined.dissolve().buffer(BUFFER_PARKING).unary_union
-    external_polygons = [Polygon(poly.exterior)
-                         for poly in unified_geometry.geoms]
-    gdf_parking = gpd.GeoDataFrame(geometry=external_polygons, crs="EPSG:4326")
+    osm = get_osm_cache(gdf_bounds)
+    gdf_parking = get_parking_mask(
+        gdf_bounds, osm, args.osm_version, num_workers=args.workers)
 
-    gdf_buildings = load_gdf(f"{args.output_dir}/{BUILDING_FILE}")
-    gdf_vegetation = load_gdf(f"{args.output_dir}/{VEGETATION_FILE}").reset_index(drop=True)
+    gdf_buildings = load_gdf(f"{args.output_dir}/{BUILDING_FILE}", gdf_bounds, columns=[])
+    gdf_vegetation = load_gdf(
+        f"{args.output_dir}/{VEGETATION_FILE}", gdf_bounds, columns=[]).reset_index(drop=True)
     gdf_buildings = gdf_buildings[["geometry"]]
 
     list_gdfs = [gdf_buildings, gdf_parking, gdf_vegetation]
-    gdfs = overlay_multiple(gdf_lots, list_gdfs)
-
-    gdfs[0] = gdfs[0][["lot_id", "geometry", "lot_area"]]
-    gdfs[1] = gdfs[1][["lot_id", "geometry", "lot_area"]]
-    gdfs[2] = gdfs[2][["lot_id", "geometry", "lot_area"]]
-    gdfs[3] = gdfs[3][["lot_id", "geometry", "lot_area"]]
-
-    for gdf, item in zip(gdfs, GDFS_MAPPING):
-        column_area = f'{item["name"]}_area'
-        column_ratio = f'{item["name"]}_ratio'
-        gdf = gdf.dissolve(by="lot_id").reset_index()
-        gdf[column_area] = gdf.to_crs("EPSG:6933").area / 10_000
-        gdf[column_ratio] = gdf[column_area] / gdf["lot_area"]
-        gdf.to_file(f"{args.output_dir}/{LANDUSE_FILE.format(item['name'])}", engine="pyogrio")
-        gdf_lots = gdf_lots.merge(
-            gdf[["lot_id", column_area, column_ratio]],
-            on="lot_id",
-            how="left",
-        )
-        gdf_lots[[column_area, column_ratio]] = gdf_lots[
-            [column_area, column_ratio]
-        ].fillna(0)
+    gdfs = overlay_multiple(
+        gdf_lots, list_gdfs, num_workers=args.workers, partition=args.partition)
+
+    gdf_lots = accumulate_landuse_areas(gdf_lots, gdfs)
+
+    if args.landuse_files:
+        for gdf, item in zip(gdfs, GDFS_MAPPING):
+            column_area = f'{item["name"]}_area'
+            column_ratio = f'{item["name"]}_ratio'
+            gdf = gdf[["lot_id", "geometry"]].dissolve(by="lot_id").reset_index()
+            gdf = gdf.merge(
+                gdf_lots[["lot_id", "lot_area", column_area, column_ratio]], on="lot_id")
+            gdf.to_file(f"{args.output_dir}/{LANDUSE_FILE.format(item['name'])}", engine="pyogrio")
 
     gdf_lots.to_file(f"{args.output_dir}/{LANDUSE_LOTS_FILE}", engine="pyogrio")
 
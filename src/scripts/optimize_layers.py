@@ -0,0 +1,150 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import pyogrio
+import shapely
+from tabulate import tabulate
+
+from src.scripts.utils.constants import LAYER_COLUMNS, LAYER_PRECISION, OPTIMIZE_LAYERS
+
+
+def optimize_layer(gdf: gpd.GeoDataFrame, precision: float, columns: list = None, id_column: str = None) -> gpd.GeoDataFrame:
+    """
+    Keeps only the given attributes, snaps the coordinates to a grid and sorts
+    the features along a Hilbert curve so neighbours are stored next to each other.
+    Features smaller than the grid keep their geometry; features without one
+    can not be written with a spatial index and are dropped and listed.
+    """
+    if columns is not None:
+        gdf = gdf[[col for col in columns if col in gdf.columns] +
+                  [gdf.geometry.name]]
+    geometries = np.asarray(gdf.geometry)
+    missing = shapely.is_missing(geometries) | shapely.is_empty(geometries)
+    if missing.any():
+        ids = gdf[id_column] if id_column in gdf.columns else gdf.index
+        print(f"Dropping {missing.sum()} features without geometry: "
+              f"{', '.join(map(str, np.asarray(ids)[missing]))}")
+    gdf = gdf[~missing].copy()
+    geometries = geometries[~missing]
+    snapped = shapely.set_precision(geometries, precision)
+    collapsed = shapely.is_missing(snapped) | shapely.is_empty(snapped)
+    snapped[collapsed] = geometries[collapsed]
+    gdf.geometry = gpd.GeoSeries(snapped, index=gdf.index, crs=gdf.crs)
+    order = np.argsort(gdf.geometry.hilbert_distance(), kind="stable")
+    return gdf.iloc[order]
+
+
+def contiguous_ranges(bounds: np.ndarray, bbox: tuple) -> tuple:
+    """Features of a bbox and the number of separate runs they take in the file"""
+    minx, miny, maxx, maxy = bbox
+    positions = np.flatnonzero(
+        (bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx)
+        & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny)
+    )
+    if len(positions) == 0:
+        return 0, 0
+    return len(positions), int((np.diff(positions) > 1).sum()) + 1
+
+
+def benchmark_layer(filename: str, bboxes: list) -> dict:
+    """Size, full decode time and mean bbox read time and byte ranges of a layer"""
+    start = time.time()
+    gdf = pyogrio.read_dataframe(filename)
+    decode_time = time.time() - start
+    bounds = shapely.bounds(np.asarray(gdf.geometry))
+
+    read_times, ranges = [], []
+    for bbox in bboxes:
+        start = time.time()
+        pyogrio.read_dataframe(filename, bbox=bbox)
+        read_times.append(time.time() - start)
+        _, runs = contiguous_ranges(bounds, bbox)
+        ranges.append(runs)
+    return {
+        "features": len(gdf),
+        "columns": len(gdf.columns) - 1,
+        "size_mb": round(os.path.getsize(filename) / 1024 / 1024, 2),
+        "decode_s": round(decode_time, 3),
+        "bbox_ms": round(1000 * float(np.mean(read_times)), 2),
+        "bbox_ranges": round(float(np.mean(ranges)), 1),
+    }
+
+
+def sample_bboxes(gdf: gpd.GeoDataFrame, num_bboxes: int, size: float, seed: int = 0) -> list:
+    """Boxes centered on random features, like the selections made in the app"""
+    rng = np.random.default_rng(seed)
+    points = shapely.get_coordinates(
+        gdf.geometry.iloc[rng.choice(len(gdf), num_bboxes)].representative_point())
+    return [(x - size / 2, y - size / 2, x + size / 2, y + size / 2) for x, y in points]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Sort, snap and trim the final layers so bbox reads are cheaper")
+    parser.add_argument("folder", type=str,
+                        help="The folder with the final layers")
+    parser.add_argument("-l", "--layers", nargs="+", default=OPTIMIZE_LAYERS,
+                        help="The layers (or glob patterns) to optimize")
+    parser.add_argument("-p", "--precision", type=float, default=LAYER_PRECISION,
+                        help="Size of the grid the coordinates are snapped to")
+    parser.add_argument("-b", "--bboxes", type=int, default=50,
+                        help="Number of bbox reads in the benchmark")
+    parser.add_argument("-s", "--bbox_size", type=float, default=0.01,
+                        help="Side of the benchmark boxes, in layer units")
+    parser.add_argument("-t", "--trim_columns", action="store_true",
+                        help="Keep only the ids of lots and blocks, /polygon and /features then serve no other attribute")
+    parser.add_argument("-v", "--view", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    layer_files = sorted({
+        filename
+        for pattern in args.layers
+        for filename in glob.glob(f"{args.folder}/{pattern}.fgb")
+    })
+    report = []
+    for layer_file in layer_files:
+        layer = os.path.splitext(os.path.basename(layer_file))[0]
+        gdf = pyogrio.read_dataframe(layer_file)
+        if gdf.empty:
+            continue
+        bboxes = sample_bboxes(gdf, args.bboxes, args.bbox_size)
+        before = benchmark_layer(layer_file, bboxes)
+
+        start = time.time()
+        columns = LAYER_COLUMNS.get(layer) if args.trim_columns else None
+        dropped = []
+        if columns is not None:
+            dropped = [col for col in gdf.columns.drop(gdf.geometry.name) if col not in columns]
+            print(f"Dropping columns of {layer}: {', '.join(dropped) or 'none'}")
+        id_column = LAYER_COLUMNS.get(layer, [None])[0]
+        gdf = optimize_layer(gdf, args.precision, columns, id_column)
+        tmp_file = f"{args.folder}/{layer}.tmp.fgb"
+        pyogrio.write_dataframe(
+            gdf, tmp_file, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+        os.replace(tmp_file, layer_file)
+        print(f"{layer_file} optimized in {time.time() - start:.2f} seconds")
+
+        after = benchmark_layer(layer_file, bboxes)
+        report.append({"layer": layer, "stage": "before", **before})
+        report.append({"layer": layer, "stage": "after", **after, "dropped": dropped})
+
+    print(tabulate(report, headers="keys"))
+    with open(f"{args.folder}/optimize_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.view:
+        for layer_file in layer_files:
+            gdf = pyogrio.read_dataframe(layer_file)
+            gdf["order"] = np.arange(len(gdf))
+            gdf.plot(column="order", cmap="viridis", figsize=(10, 10))
+        plt.show()
@@ -1,8 +1,11 @@
 import argparse
 import os
+from datetime import datetime
 
+import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text, inspect
 from sqlalchemy.types import Float
@@ -10,7 +13,7 @@ import psycopg2
 from tqdm import tqdm
 from sqlalchemy import MetaData, Table
 
-from src.utils.db import get_engine
+from src.utils.db import METRIC_MAPPING, ROLLUP_LEVELS, ROLLUP_METRICS, get_engine, query_lot_counts, query_metrics
 
 
 def get_args():
@@ -22,6 +25,10 @@ def get_args():
                         type=str, help="The file with all the blocks data")
     parser.add_argument("-a", "--accessibility_file", required=False,
                         type=str, help="The file with all the accessibility data")
+    parser.add_argument("-s", "--schema", required=False,
+                        type=str, help="The schema of the project tables")
+    parser.add_argument("-r", "--rollups", action="store_true",
+                        help="Only rebuild the rollups from the loaded tables")
     return parser.parse_args()
 
 
@@ -61,11 +68,11 @@ def clean_and_cast_types(df, mapping):
     return df
 
 
-def process_in_chunks(file, table_name, engine, index_column, mapping, chunk_size=5000):
+def process_in_chunks(file, table_name, engine, index_column, mapping, chunk_size=5000, schema=None):
     # Initialize a chunk iterator
-    metadata = MetaData()
+    metadata = MetaData(schema=schema)
     # drop only if table exists
-    if inspect(engine).has_table(table_name):
+    if inspect(engine).has_table(table_name, schema=schema):
         _Table = Table(table_name, metadata, autoload_with=engine)
         _Table.drop(engine)
     chunks = pd.read_csv(file, chunksize=chunk_size, dtype=mapping)
@@ -83,16 +90,88 @@ def process_in_chunks(file, table_name, engine, index_column, mapping, chunk_siz
         chunk.to_sql(
             table_name,
             engine,
+            schema=schema,
             if_exists="append",
             index_label=index_column
         )
 
     # Query and print the full data from the table
-    data = pd.read_sql_query(f"SELECT * FROM {table_name}", engine)
+    full_name = f"{schema}.{table_name}" if schema else table_name
+    data = pd.read_sql_query(f"SELECT * FROM {full_name}", engine)
     print(data)
     print(data.columns.tolist())
 
 
+def process_rollups(engine, schema=None):
+    """
+    Stores the sum and the count of every metric per municipio, localidad and
+    AGEB, so averages can be rebuilt without going back to the blocks, along
+    with the dissolved geometry of each area. The block averages of lot
+    metrics are weighted by the lots behind them, so the rollup matches the
+    average over the lots; block metrics count every block once.
+    """
+    metrics = {metric: metric for metric in ROLLUP_METRICS}
+    payload = {"group_ages": []}
+    df = query_metrics("blocks", metrics, payload=payload, schema=schema)
+    df = df.melt(id_vars="cvegeo", var_name="metric", value_name="value")
+
+    lot_averages = [
+        metric for metric in ROLLUP_METRICS
+        if METRIC_MAPPING[metric]["level"] == "lots" and METRIC_MAPPING[metric]["reduce"] == "avg"
+    ]
+    df_weights = query_lot_counts(lot_averages, payload=payload, schema=schema)
+    df_weights = df_weights.melt(
+        id_vars="cvegeo", var_name="metric", value_name="weight")
+    df = df.merge(df_weights, on=["cvegeo", "metric"], how="left")
+    df["weight"] = df["weight"].fillna(1).where(df["value"].notna(), 0)
+    df["value"] = df["value"] * df["weight"]
+
+    full_name = f"{schema}.blocks" if schema else "blocks"
+    df_blocks = pd.read_sql_query(
+        f"SELECT cvegeo, geometry FROM {full_name}", engine)
+    geometries = shapely.from_wkt(
+        df_blocks["geometry"].to_numpy(), on_invalid="ignore")
+    gdf_blocks = gpd.GeoDataFrame(
+        df_blocks[["cvegeo"]], geometry=geometries, crs="EPSG:4326")
+
+    rollups = []
+    rollup_geometries = []
+    updated_at = datetime.now()
+    for level, length in ROLLUP_LEVELS.items():
+        df["code"] = df["cvegeo"].str[:length]
+        df_level = df.groupby(["code", "metric"]).agg(
+            sum=("value", "sum"), count=("weight", "sum")).reset_index()
+        df_level["level"] = level
+        rollups.append(df_level)
+
+        gdf_blocks["code"] = gdf_blocks["cvegeo"].str[:length]
+        gdf_level = gdf_blocks.dissolve(
+            by="code", aggfunc={"cvegeo": "count"}).reset_index()
+        rollup_geometries.append(pd.DataFrame({
+            "level": level,
+            "code": gdf_level["code"],
+            "num_blocks": gdf_level["cvegeo"],
+            "geometry": shapely.to_wkt(gdf_level.geometry.to_numpy(), rounding_precision=6),
+            "updated_at": updated_at,
+        }))
+        print(f"{level}: {len(gdf_level)} areas")
+
+    # Empty the tables instead of dropping them to keep the indexes from init.sql
+    for table_name in ["rollups", "rollup_geometries"]:
+        if inspect(engine).has_table(table_name, schema=schema):
+            with engine.begin() as connection:
+                full_name = f"{schema}.{table_name}" if schema else table_name
+                connection.execute(text(f"DELETE FROM {full_name}"))
+                # Tables created before the rollups were versioned
+                columns = {col["name"] for col in inspect(engine).get_columns(table_name, schema=schema)}
+                if table_name == "rollup_geometries" and "updated_at" not in columns:
+                    connection.execute(text(f"ALTER TABLE {full_name} ADD COLUMN updated_at TIMESTAMP"))
+    pd.concat(rollups)[["level", "code", "metric", "sum", "count"]].to_sql(
+        "rollups", engine, schema=schema, if_exists="append", index=False)
+    pd.concat(rollup_geometries).to_sql(
+        "rollup_geometries", engine, schema=schema, if_exists="append", index=False)
+
+
 if __name__ == "__main__":
     args = get_args()
 
@@ -138,6 +217,13 @@ if __name__ == "__main__":
         'density': 'float64',
         'potential_home_units': 'float64',
         'mean_slope': 'float64',
+        'min_slope': 'float64',
+        'max_slope': 'float64',
+        'p90_slope': 'float64',
+        'built_fraction': 'float64',
+        'mean_height': 'float64',
+        'p90_height': 'float64',
+        'estimated_levels': 'float64',
         'geometry': 'object',
     }
     mapping_blocks = {
@@ -224,12 +310,15 @@ if __name__ == "__main__":
 
     if args.lots_file:
         process_in_chunks(args.lots_file, "lots", engine,
-                          index_column="lot_id", mapping=mapping_lots)
+                          index_column="lot_id", mapping=mapping_lots, schema=args.schema)
 
     if args.blocks_file:
         process_in_chunks(args.blocks_file, "blocks", engine,
-                          index_column="cvegeo", mapping=mapping_blocks)
+                          index_column="cvegeo", mapping=mapping_blocks, schema=args.schema)
 
     if args.accessibility_file:
         process_in_chunks(args.accessibility_file, "accessibility_trips",
-                          engine, index_column="origin_id", mapping=mapping_trips)
+                          engine, index_column="origin_id", mapping=mapping_trips, schema=args.schema)
+
+    if args.lots_file or args.blocks_file or args.rollups:
+        process_rollups(engine, schema=args.schema)
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import time
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import pyogrio
+import shapely
+from tabulate import tabulate
+
+from src.utils.lod import LOD_BANDS, LOD_LAYERS
+
+
+def simplify_coverage(geometries: np.ndarray, tolerance: float, precision: float) -> np.ndarray:
+    """
+    Simplifies polygons that share boundaries without opening gaps or overlaps
+    between neighbours. Coordinates are snapped to a grid, the boundaries are
+    noded into edges, every edge is simplified once and the faces built back
+    from the simplified edges are returned to the polygon they came from.
+    """
+    geometries = shapely.set_precision(geometries, precision)
+    edges = shapely.line_merge(shapely.union_all(shapely.boundary(geometries)))
+    edges = shapely.simplify(shapely.get_parts(
+        edges), tolerance, preserve_topology=True)
+    faces = shapely.get_parts(shapely.polygonize(edges))
+
+    tree = shapely.STRtree(geometries)
+    face_idx, owner_idx = tree.query(
+        shapely.point_on_surface(faces), predicate="within")
+    owners = np.full(len(faces), -1)
+    owners[face_idx] = owner_idx
+
+    # Faces that moved outside their polygon go to the one they overlap the most
+    for i in np.flatnonzero(owners == -1):
+        candidates = tree.query(faces[i], predicate="intersects")
+        if len(candidates) == 0:
+            continue
+        overlap = shapely.area(shapely.intersection(
+            geometries[candidates], faces[i]))
+        if overlap.max() > 0.5 * shapely.area(faces[i]):
+            owners[i] = candidates[np.argmax(overlap)]
+
+    assigned = owners >= 0
+    gdf_faces = gpd.GeoDataFrame(
+        {"owner": owners[assigned]}, geometry=faces[assigned])
+    dissolved = gdf_faces.dissolve(by="owner").geometry
+
+    result = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    result[dissolved.index.to_numpy()] = dissolved.to_numpy()
+    return result
+
+
+def simplify_layer(gdf: gpd.GeoDataFrame, tolerance: float, precision: float) -> gpd.GeoDataFrame:
+    geometries = np.asarray(gdf.geometry)
+    if gdf.geom_type.isin(["Polygon", "MultiPolygon"]).all():
+        geometries = simplify_coverage(geometries, tolerance, precision)
+    else:
+        geometries = shapely.set_precision(shapely.simplify(
+            geometries, tolerance, preserve_topology=True), precision)
+    gdf = gdf.copy()
+    gdf.geometry = gpd.GeoSeries(geometries, index=gdf.index, crs=gdf.crs)
+    return gdf[~gdf.geometry.is_empty]
+
+
+def describe_file(filename: str) -> dict:
+    start = time.time()
+    gdf = pyogrio.read_dataframe(filename)
+    decode_time = time.time() - start
+    return {
+        "file": os.path.basename(filename),
+        "features": len(gdf),
+        "vertices": int(shapely.get_num_coordinates(np.asarray(gdf.geometry)).sum()),
+        "size_mb": round(os.path.getsize(filename) / 1024 / 1024, 2),
+        "decode_s": round(decode_time, 3),
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Write simplified variants of the final layers for each zoom band")
+    parser.add_argument("folder", type=str,
+                        help="The folder with the final layers")
+    parser.add_argument("-l", "--layers", nargs="+", default=LOD_LAYERS,
+                        help="The layers to simplify")
+    parser.add_argument("-v", "--view", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+
+    for layer in args.layers:
+        layer_file = f"{args.folder}/{layer}.fgb"
+        gdf = pyogrio.read_dataframe(layer_file)
+        report = [{"lod": "full", **describe_file(layer_file)}]
+
+        for band in LOD_BANDS:
+            start = time.time()
+            gdf_lod = simplify_layer(gdf, band["tolerance"], band["precision"])
+            lod_file = f"{args.folder}/{layer}_{band['name']}.fgb"
+            pyogrio.write_dataframe(gdf_lod, lod_file, driver="FlatGeobuf")
+            print(
+                f"{lod_file} written in {time.time() - start:.2f} seconds")
+            report.append({"lod": band["name"], **describe_file(lod_file)})
+
+        print(tabulate(report, headers="keys"))
+        with open(f"{args.folder}/{layer}_lod.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+        if args.view:
+            fig, ax = plt.subplots(ncols=len(LOD_BANDS) + 1, figsize=(30, 10))
+            gdf.plot(ax=ax[0])
+            for i, band in enumerate(LOD_BANDS):
+                pyogrio.read_dataframe(
+                    f"{args.folder}/{layer}_{band['name']}.fgb").plot(ax=ax[i + 1])
+            plt.show()
@@ -1,24 +1,118 @@
 import argparse
+import time
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import rasterio
 import geopandas as gpd
+import matplotlib.pyplot as plt
 import numpy as np
-import json
-import pyogrio
-import sqlite3
 
 from rasterio.mask import mask
-from shapely.geometry import box
+from rasterio.windows import Window, from_bounds
+from sqlalchemy import create_engine
+from tqdm import tqdm
+
+from src.scripts.utils.zonal import zonal_stats_gdf
+from src.utils.db import get_engine, update_columns
+
+# Metros por grado de latitud, y de longitud en el ecuador
+METERS_PER_DEGREE_LAT = 110_540
+METERS_PER_DEGREE_LON = 111_320
+SLOPE_TILE_SIZE = 256
+
+
+def ground_resolution(transform, num_rows, geographic=False):
+    """Size of the pixels in meters, the x size is per row when the raster is in degrees"""
+    dx, dy = abs(transform.a), abs(transform.e)
+    if not geographic:
+        return np.full((num_rows, 1), dx), dy
+    latitudes = transform.f + (np.arange(num_rows) + 0.5) * transform.e
+    dx = dx * METERS_PER_DEGREE_LON * np.cos(np.radians(latitudes))
+    return dx[:, None], dy * METERS_PER_DEGREE_LAT
+
 
 # Calcular pendiente
-def calculate_slope(elevation_array, transform):
-    dx, dy = np.gradient(elevation_array)  # Calcular gradiente en x e y
-    slope = np.arctan(np.sqrt(dx**2 + dy**2)) * 180 / np.pi  # Convertir a grados
+def calculate_slope(elevation_array, transform, geographic=False):
+    dx, dy = ground_resolution(transform, elevation_array.shape[0], geographic)
+    # Calcular gradiente en y (filas) y x (columnas) en metros
+    gradient_y, gradient_x = np.gradient(elevation_array.astype(np.float64))
+    slope = np.arctan(np.sqrt((gradient_x / dx)**2 + (gradient_y / dy)**2)) * 180 / np.pi  # Convertir a grados
     return slope
 
+
+def slope_window(dem_file, window, geographic=False):
+    """
+    Slope of a window read with a halo of one pixel, so the gradient on its
+    edges uses the same neighbours as on the whole raster.
+    """
+    with rasterio.open(dem_file) as src:
+        halo = Window(window.col_off - 1, window.row_off - 1,
+                      window.width + 2, window.height + 2)
+        halo = halo.intersection(Window(0, 0, src.width, src.height))
+        elevation = src.read(1, window=halo).astype(np.float64)
+        if src.nodata is not None:
+            elevation[elevation == src.nodata] = np.nan
+        slope = calculate_slope(
+            elevation, src.window_transform(halo), geographic)
+    row, col = window.row_off - halo.row_off, window.col_off - halo.col_off
+    return window, slope[row:row + window.height, col:col + window.width].astype(np.float32)
+
+
+def write_slope_raster(dem_file, slope_file, bounds=None, block_size=1024, num_workers=None):
+    """
+    Computes the slope of the DEM window by window in a thread pool and writes
+    it to a tiled, compressed GeoTIFF, so the DEM never has to fit in memory.
+    """
+    with rasterio.open(dem_file) as src:
+        full_window = Window(0, 0, src.width, src.height)
+        window = full_window
+        if bounds is not None:
+            window = from_bounds(*bounds, transform=src.transform)
+            window = window.round_offsets().round_lengths().intersection(full_window)
+        geographic = src.crs is not None and src.crs.is_geographic
+        profile = src.profile.copy()
+        profile.update(
+            driver="GTiff", dtype="float32", count=1, nodata=np.nan,
+            width=window.width, height=window.height,
+            transform=src.window_transform(window),
+            tiled=True, blockxsize=SLOPE_TILE_SIZE, blockysize=SLOPE_TILE_SIZE,
+            compress="deflate", predictor=3, BIGTIFF="IF_SAFER",
+        )
+
+    # Windows aligned to the tiles of the output
+    windows = [
+        Window(window.col_off + col, window.row_off + row,
+               min(block_size, window.width - col), min(block_size, window.height - row))
+        for row in range(0, window.height, block_size)
+        for col in range(0, window.width, block_size)
+    ]
+    num_workers = num_workers or os.cpu_count()
+    with rasterio.open(slope_file, "w", **profile) as dst, ThreadPoolExecutor(num_workers) as executor:
+        progress = tqdm(total=len(windows))
+
+        def write_done(futures):
+            for future in futures:
+                block, slope = future.result()
+                dst.write(slope, 1, window=Window(
+                    block.col_off - window.col_off, block.row_off - window.row_off,
+                    block.width, block.height))
+                progress.update()
+
+        pending = set()
+        for block in windows:
+            # Only a few windows are kept in memory waiting to be written
+            if len(pending) >= 2 * num_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write_done(done)
+            pending.add(executor.submit(slope_window, dem_file, block, geographic))
+        write_done(wait(pending).done)
+        progress.close()
+
+
 def get_args():
     parser = argparse.ArgumentParser(
-        description="Join establishments with lots")
+        description="Compute the slope of each lot from the altitude raster")
     parser.add_argument("bounds_file", type=str,
                         help="Map limits file")
     parser.add_argument(
@@ -28,8 +122,20 @@ def get_args():
         "lots_file", type=str, 
         help="Lots file")
     parser.add_argument(
-        "db_file", type=str, 
-        help="Database file")
+        "db_file", type=str, nargs="?", default=None,
+        help="SQLite database file, by default the Postgres database of the API")
+    parser.add_argument("-s", "--schema", type=str, default=None,
+                        help="Schema of the lots table")
+    parser.add_argument("-k", "--key", type=str, default=None,
+                        help="Column of the lots that identifies them in the table, lot_id or ID by default")
+    parser.add_argument("-p", "--percentiles", nargs="+", type=float, default=[90],
+                        help="Percentiles of the slope saved for each lot, as p<q>_slope columns")
+    parser.add_argument("-o", "--slope_file", type=str, default=None,
+                        help="Write the slope to this GeoTIFF window by window instead of computing it in memory")
+    parser.add_argument("-b", "--block_size", type=int, default=1024,
+                        help="Side of the windows of the slope GeoTIFF in pixels, a multiple of 256 so they match its tiles")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Threads computing the slope windows")
     parser.add_argument("-v", "--view", action="store_true")
     return parser.parse_args()
 
@@ -50,110 +156,52 @@ if __name__ == "__main__":
     # Obtener la geometría del poligono
     geometries = bounds_gdf.geometry.values
 
-    # Recortar el tiff segun poligono
-    with rasterio.open(tiff_path) as src:
-        out_image, out_transform = mask(src, geometries, crop=True)
-        out_meta = src.meta.copy()
-
-    # Calcular la pendiente para punto
-    elevation_array = out_image[0]
-    slope_array = calculate_slope(elevation_array, out_transform)
-
-    # Crear un GeoDataFrame con los polígonos de cada celda y la pendiente calculada
-    rows, cols = np.nonzero(elevation_array)  # Obtener las filas y columnas de los píxeles no nulos
-
-    # Calcular la geometría de cada píxel
-    polygons = []
-    for row, col in zip(rows, cols):
-        x, y = rasterio.transform.xy(out_transform, row, col, offset='ul')  
-        pixel_width, pixel_height = out_transform[0], -out_transform[4] 
-        polygon = box(x, y - pixel_height, x + pixel_width, y)
-        polygons.append(polygon)
-
-    # Crear el GeoDataFrame con los polígonos y sus pendientes
-    slope_gdf = gpd.GeoDataFrame({
-        'geometry': polygons,
-        'slope': slope_array[rows, cols]
-    }, crs=bounds_gdf.crs)
-
-    pyogrio.write_dataframe( slope_gdf, "./temp/slope_gdf.geojson")
+    if args.slope_file:
+        # Calcular la pendiente por ventanas y recortar el tiff de pendiente
+        start = time.time()
+        write_slope_raster(tiff_path, args.slope_file, bounds_gdf.total_bounds,
+                           block_size=args.block_size, num_workers=args.workers)
+        print(f"Slope raster written in {time.time() - start:.2f} seconds")
+        with rasterio.open(args.slope_file) as src:
+            out_image, out_transform = mask(src, geometries, crop=True, nodata=np.nan)
+        slope_array = out_image[0]
+        valid = ~np.isnan(slope_array)
+    else:
+        # Recortar el tiff segun poligono
+        with rasterio.open(tiff_path) as src:
+            nodata = src.nodata if src.nodata is not None else 0
+            geographic = src.crs is not None and src.crs.is_geographic
+            out_image, out_transform = mask(src, geometries, crop=True, nodata=nodata)
+
+        # Calcular la pendiente para punto
+        elevation_array = out_image[0]
+        slope_array = calculate_slope(elevation_array, out_transform, geographic)
+        valid = elevation_array != nodata
 
     ##CALCULAR PENDIENTE DE CADA LOTE
-    slope_gdf_path = './temp/slope_gdf.geojson' 
-    lots_geojson_path = args.lots_file
-
-    slope_gdf = gpd.read_file(slope_gdf_path)
-    lots_gdf = gpd.read_file(lots_geojson_path)
-    lots_gdf = lots_gdf.to_crs(slope_gdf.crs)
-
-    # Crear una nueva columna en el GeoDataFrame de lotes para almacenar la pendiente
-    lots_gdf['mean_slope'] = 0.0
-
-    # Calcular la pendiente media para cada lote
-    for idx, lot in lots_gdf.iterrows():
-        # Obtener la pendiente para los píxeles que intersectan con el lote
-        intersecting_slopes = slope_gdf[slope_gdf.geometry.intersects(lot.geometry)]
-        
-        # Calcular la pendiente media (u otra estadística) de los píxeles dentro del lote
-        if not intersecting_slopes.empty:
-            mean_slope = intersecting_slopes['slope'].mean()
-        else:
-            mean_slope = None  # O algún valor por defecto si no hay intersección
-        
-        # Asignar la pendiente media al lote
-        lots_gdf.at[idx, 'mean_slope'] = mean_slope
-
-    output_path = './temp/lots_with_slope.geojson'
-    lots_gdf.to_file(output_path, driver='GeoJSON')
+    lots_gdf = gpd.read_file(args.lots_file, engine="pyogrio")
+    lots_gdf = lots_gdf.to_crs(bounds_gdf.crs)
+
+    start = time.time()
+    slope_stats = zonal_stats_gdf(
+        lots_gdf, slope_array, out_transform, valid=valid, percentiles=args.percentiles)
+    print(f"Slope of {len(lots_gdf)} lots computed in {time.time() - start:.2f} seconds")
+    # Every statistic is kept as a <stat>_slope column, e.g. mean_slope or p90_slope
+    slope_columns = {
+        stat: f"{stat.replace('.', '_')}_slope" for stat in slope_stats.columns.drop("count")}
+    lots_gdf[list(slope_columns.values())] = slope_stats[list(slope_columns)].to_numpy()
+    print(lots_gdf[list(slope_columns.values())].describe())
+
+    if args.view:
+        lots_gdf.plot(column="mean_slope", cmap="viridis", legend=True, figsize=(15, 15))
+        plt.show()
 
     ##UPDATE DATABASE
-    db_path = args.db_file
-
-    connection = sqlite3.connect(db_path)
-    cursor = connection.cursor()
-
-    # Add a new column 'mean_slope' to the 'lots' table
-    cursor.execute("ALTER TABLE lots ADD COLUMN mean_slope REAL")
-
-    connection.commit()
-
-    # Load the GeoJSON data
-    with open(output_path, 'r') as f:
-        geojson_data = json.load(f)
-
-    # Prepare the list of tuples with lot_id and mean_slope
-    update_values = [
-        (feature['properties']['mean_slope'], feature['properties']['ID'])  # Adjust keys if needed
-        for feature in geojson_data['features']
-    ]
-
-    # Construct the SQL query with CASE statements
-    update_query = """
-        UPDATE lots
-        SET mean_slope = CASE
-    """
-    # Add each CASE condition for updating specific lot_ids
-    index = 0
-    for mean_slope, ID in update_values:
-
-        if( mean_slope == None):
-            mean_slope = 0
-
-        update_query += f"WHEN ID = {ID} THEN { mean_slope } "
-        index += 1
-
-    # Close the CASE statement and add the WHERE clause
-    update_query += "END WHERE ID IN ({})".format(
-        ", ".join(str(ID) for _, ID in update_values)
-    )
-
-    print( update_query )
-
-    # Execute the query
-    cursor.execute(update_query)
-
-    # Commit the changes
-    connection.commit()
-
-    # Close the connection
-    connection.close()
+    # Lots without pixels keep a slope of 0, like before
+    key = args.key or ("lot_id" if "lot_id" in lots_gdf.columns else "ID")
+    engine = create_engine(f"sqlite:///{args.db_file}") if args.db_file else get_engine()
+    start = time.time()
+    updated = update_columns(
+        "lots", lots_gdf[[key, *slope_columns.values()]].fillna(0), key,
+        schema=args.schema, engine=engine)
+    print(f"{updated} lots updated in {time.time() - start:.2f} seconds")
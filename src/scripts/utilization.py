@@ -1,16 +1,17 @@
 import argparse
 import json
 import math
+import os
 import time
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import osmnx as ox
 
+from src.scripts.utils.osm import get_osm_cache
 from src.scripts.utils.utils import normalize, remove_outliers
-from src.scripts.utils.constants import LANDUSE_LOTS_FILE, ACCESSIBILITY_BLOCKS_FILE, BOUNDS_FILE, ZONING_REGULATIONS_FILE, UTILIZATION_LOTS_FILE
+from src.scripts.utils.constants import LANDUSE_LOTS_FILE, ACCESSIBILITY_BLOCKS_FILE, BOUNDS_FILE, ZONING_REGULATIONS_FILE, UTILIZATION_LOTS_FILE, BUILDING_HEIGHTS_LOTS_FILE
 
 
 def gather_overture_data(bbox: tuple) -> gpd.GeoDataFrame:
@@ -64,10 +65,17 @@ if __name__ == "__main__":
     gdf_lots = pd.merge(gdf_lots.drop(columns=[
                         "block_area"]), gdf_blocks[important_block_columns], on="cvegeo", how="left")
     gdf_lots = gpd.GeoDataFrame(gdf_lots, crs="EPSG:4326")
-
-    G = ox.graph_from_polygon(gdf_bounds.buffer(
-        0.001).unary_union, network_type='drive')
-    gdf_edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
+    heights_file = f"{args.output_dir}/{BUILDING_HEIGHTS_LOTS_FILE}"
+    if os.path.exists(heights_file):
+        df_heights = pd.read_csv(heights_file)
+        gdf_lots = gdf_lots.merge(df_heights, on="lot_id", how="left")
+        # Lots without levels in the input take the ones estimated from the building heights
+        gdf_lots["num_levels"] = gdf_lots["num_levels"].fillna(
+            gdf_lots["estimated_levels"])
+
+    _, gdf_edges = get_osm_cache(gdf_bounds).network_gdfs("drive")
+    gdf_edges = gdf_edges[gdf_edges.intersects(
+        gdf_bounds.buffer(0.001).unary_union)]
     gdf_edges['name'] = gdf_edges['name'].apply(
         lambda x: x[0] if isinstance(x, list) else x)
     gdf_edges = gdf_edges[gdf_edges["name"].isin(
@@ -0,0 +1,25 @@
+import hashlib
+import os
+
+import shapely
+
+CACHE_LOCATION = os.getenv("PIPELINE_CACHE_LOCATION", "data/cache")
+
+
+def cache_key(*parts) -> str:
+    """Short hash of the inputs of a cached step, geometries are hashed by their WKB"""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, shapely.Geometry):
+            part = shapely.to_wkb(part, hex=True)
+        digest.update(str(part).encode())
+        digest.update(b"|")
+    return digest.hexdigest()[:16]
+
+
+def get_cache_path(name: str, key: str, extension: str = None, cache_dir: str = None) -> str:
+    """Path of a cached file, or folder when there is no extension"""
+    cache_dir = cache_dir or CACHE_LOCATION
+    os.makedirs(cache_dir, exist_ok=True)
+    path = f"{cache_dir}/{name}_{key}"
+    return f"{path}.{extension}" if extension else path
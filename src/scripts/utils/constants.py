@@ -1,6 +1,9 @@
 from itertools import chain
 
 BUILDING_CONFIDENCE = 0.5
+# Presence above which a cell of the Open Buildings Temporal raster counts as built
+BUILDING_PRESENCE_THRESHOLD = 0.5
+LEVEL_HEIGHT = 3  # m
 PARK_TAGS = {
     'leisure': 'park',
     'landuse': 'recreation_ground'
@@ -22,6 +25,10 @@ PARKING_TAGS = {
     'amenity': 'parking'
 }
 BUFFER_PARKING = 0.00002
+# Side of the tiles the parking mask is built in, in degrees (roughly 2 km)
+PARKING_TILE_SIZE = 0.02
+# Precision the tiled pieces are snapped to when joined, so they merge along the tile seams
+PARKING_GRID_SIZE = 1e-9
 GDFS_MAPPING = [
     {"name": 'unused', "color": 'blue'},
     {"name": 'green', "color": 'lightgreen'},
@@ -330,4 +337,16 @@ PEDESTRIAN_NETWORK_FILE = "pedestrian_network.h5"
 ACCESSIBILITY_FILE = "accessibility_points.fgb"
 ASSIGN_ESTABLISHMENTS_FILE = "assign_establishments.fgb"
 ZONING_REGULATIONS_FILE = "zoning_regulations.json"
-UTILIZATION_LOTS_FILE = "utilization_lots.fgb"
\ No newline at end of file
+UTILIZATION_LOTS_FILE = "utilization_lots.fgb"
+BUILDING_RASTER_FILE = "buildings.tif"
+BUILDING_HEIGHTS_LOTS_FILE = "building_heights_lots.csv"
+# Final layers rewritten by optimize_layers, glob patterns inside the final folder
+OPTIMIZE_LAYERS = ["lots", "blocks", "landuse_*", "amenities"]
+# Grid the coordinates are snapped to, in degrees (1e-6 is roughly 0.1 m)
+LAYER_PRECISION = 0.000001
+# Attributes kept in each final layer, the metrics are read from the database.
+# Layers that are not listed keep all their columns.
+LAYER_COLUMNS = {
+    "lots": ["lot_id", "cvegeo"],
+    "blocks": ["cvegeo"],
+}
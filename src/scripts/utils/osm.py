@@ -0,0 +1,237 @@
+import json
+import os
+import re
+import time
+from datetime import date
+from typing import Optional
+
+import geopandas as gpd
+import networkx as nx
+import osmnx as ox
+import pandas as pd
+
+from src.scripts.utils.cache import cache_key, get_cache_path
+from src.scripts.utils.constants import (
+    EQUIPMENT_TAGS,
+    PARK_TAGS,
+    PARKING_FILTER,
+    PARKING_TAGS,
+    WALK_RADIUS,
+)
+
+try:
+    import pyrosm
+except ImportError:
+    pyrosm = None
+
+# Same filters osmnx applies for each network type, evaluated over one pull
+# of every highway so all the networks come from the same data
+NETWORK_FILTERS = {
+    "walk": (
+        '["highway"]["area"!~"yes"]["access"!~"private"]'
+        '["highway"!~"abandoned|bus_guideway|construction|cycleway|motor|no|planned|platform|proposed|raceway|razed"]'
+        '["foot"!~"no"]["service"!~"private"]'
+    ),
+    "drive": (
+        '["highway"]["area"!~"yes"]["access"!~"private"]'
+        '["highway"!~"abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|escalator|footway|no|path|pedestrian|planned|platform|proposed|raceway|razed|service|steps|track"]'
+        '["motor_vehicle"!~"no"]["motorcar"!~"no"]'
+        '["service"!~"alley|driveway|emergency_access|parking|parking_aisle|private"]'
+    ),
+    "service": PARKING_FILTER,
+}
+NETWORK_TAGS = ["highway", "area", "access", "foot", "service",
+                "motor_vehicle", "motorcar", "name", "oneway", "maxspeed"]
+PYROSM_NETWORK_TYPES = {"walk": "walking", "drive": "driving", "service": "all"}
+# Networks reduced to their largest component, like osmnx does without retain_all
+CONNECTED_NETWORKS = ["walk", "drive"]
+OSM_TAGS = {}
+for tags in [PARKING_TAGS, PARK_TAGS, EQUIPMENT_TAGS]:
+    for tag, values in tags.items():
+        if values is True or OSM_TAGS.get(tag) is True:
+            OSM_TAGS[tag] = True
+            continue
+        values = values if isinstance(values, list) else [values]
+        OSM_TAGS[tag] = sorted(set(OSM_TAGS.get(tag, [])) | set(values))
+META_FILE = "meta.json"
+# Bumped when the layers of the cache change, so older caches are rebuilt
+CACHE_FORMAT = 2
+
+
+def match_filter(df: pd.DataFrame, osm_filter: str) -> pd.Series:
+    """Rows of a tag table that pass an Overpass style filter like '["highway"~"service"]'"""
+    mask = pd.Series(True, index=df.index)
+    for tag, operator, pattern in re.findall(r'\["([^"]+)"(?:(!?~)"([^"]*)")?\]', osm_filter):
+        values = df[tag] if tag in df.columns else pd.Series(
+            None, index=df.index, dtype=object)
+        values = values.apply(
+            lambda x: "|".join(map(str, x)) if isinstance(x, list) else x)
+        if not operator:
+            mask &= values.notna()
+            continue
+        found = values.astype(str).str.contains(pattern) & values.notna()
+        mask &= ~found if operator == "!~" else found
+    return mask
+
+
+def _to_json(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    return json.dumps(value, default=str)
+
+
+def _is_text(series: pd.Series) -> bool:
+    return series.name != "geometry" and (
+        series.dtype == object or pd.api.types.is_string_dtype(series.dtype))
+
+
+def _encode(gdf: pd.DataFrame) -> pd.DataFrame:
+    """Object columns mix lists, strings and numbers, they are stored as JSON text"""
+    gdf = gdf.copy()
+    for column in gdf.columns:
+        if _is_text(gdf[column]):
+            gdf[column] = gdf[column].apply(_to_json)
+    return gdf
+
+
+def _decode(gdf: pd.DataFrame) -> pd.DataFrame:
+    for column in gdf.columns:
+        if _is_text(gdf[column]):
+            gdf[column] = gdf[column].apply(
+                lambda x: json.loads(x) if isinstance(x, str) else x)
+    return gdf
+
+
+def _network_from_overpass(polygon) -> dict:
+    """Pulls every highway once and derives each network from its tags"""
+    ox.settings.useful_tags_way = sorted(
+        set(ox.settings.useful_tags_way) | set(NETWORK_TAGS))
+    G = ox.graph_from_polygon(
+        polygon, custom_filter='["highway"]', retain_all=True, simplify=False)
+    edges = ox.graph_to_gdfs(G, nodes=False)
+    networks = {}
+    for network_type, osm_filter in NETWORK_FILTERS.items():
+        keys = edges.index[match_filter(edges, osm_filter)]
+        G_network = G.edge_subgraph(keys).copy()
+        G_network.remove_nodes_from(list(nx.isolates(G_network)))
+        if network_type in CONNECTED_NETWORKS and len(G_network) > 0:
+            G_network = ox.truncate.largest_component(G_network, strongly=False)
+        if len(G_network) > 0:
+            G_network = ox.simplify_graph(G_network)
+        networks[network_type] = G_network
+    return networks
+
+
+def _network_from_pbf(osm) -> dict:
+    networks = {}
+    for network_type, pyrosm_type in PYROSM_NETWORK_TYPES.items():
+        nodes, edges = osm.get_network(
+            network_type=pyrosm_type, nodes=True, extra_attributes=NETWORK_TAGS)
+        if network_type == "service":
+            edges = edges[match_filter(edges, NETWORK_FILTERS["service"])]
+        G_network = osm.to_graph(
+            nodes, edges, graph_type="networkx", retain_all=True)
+        if network_type in CONNECTED_NETWORKS and len(G_network) > 0:
+            G_network = ox.truncate.largest_component(G_network, strongly=False)
+        networks[network_type] = G_network
+    return networks
+
+
+def build_osm_cache(polygon, folder: str, pbf_file: Optional[str] = None):
+    """
+    Downloads (or reads from a .osm.pbf extract) the walk, drive and service
+    networks and the tagged features used in the pipeline and stores them as
+    GeoParquet files in `folder`.
+    """
+    start = time.time()
+    if pbf_file:
+        if pyrosm is None:
+            raise ImportError("pyrosm is required to read .osm.pbf extracts")
+        osm = pyrosm.OSM(pbf_file, bounding_box=polygon)
+        networks = _network_from_pbf(osm)
+        gdf_features = osm.get_data_by_custom_criteria(
+            custom_filter=OSM_TAGS, keep_nodes=True, keep_ways=True, keep_relations=True)
+        gdf_features = gdf_features.rename(
+            columns={"osm_type": "element_type", "id": "osmid"})
+        version = f"pbf-{os.path.basename(pbf_file)}-{int(os.path.getmtime(pbf_file))}"
+    else:
+        networks = _network_from_overpass(polygon)
+        gdf_features = ox.features_from_polygon(
+            polygon, tags=OSM_TAGS).reset_index()
+        version = f"overpass-{date.today().isoformat()}"
+
+    os.makedirs(folder, exist_ok=True)
+    for network_type, G in networks.items():
+        nodes, edges = ox.graph_to_gdfs(G)
+        _encode(nodes.reset_index()).to_parquet(
+            f"{folder}/{network_type}_nodes.parquet")
+        _encode(edges.reset_index()).to_parquet(
+            f"{folder}/{network_type}_edges.parquet")
+    columns = [col for col in ["element_type", "osmid", *OSM_TAGS, "geometry"]
+               if col in gdf_features.columns]
+    _encode(gdf_features[columns]).to_parquet(f"{folder}/features.parquet")
+    with open(f"{folder}/{META_FILE}", "w") as f:
+        json.dump({"version": version, "pbf_file": pbf_file}, f)
+    print(f"OSM cache {folder} built in {time.time() - start:.2f} seconds")
+
+
+class OsmCache:
+    """
+    OSM layers of an area shared by every stage of the pipeline. They are
+    built once per polygon and source and then read from disk, offline.
+    """
+
+    def __init__(self, polygon, pbf_file: Optional[str] = None, cache_dir: Optional[str] = None, refresh: bool = False):
+        pbf_file = pbf_file or os.getenv("OSM_PBF_FILE")
+        source = f"overpass-v{CACHE_FORMAT}"
+        if pbf_file:
+            source = f"{os.path.basename(pbf_file)}-{int(os.path.getmtime(pbf_file))}-v{CACHE_FORMAT}"
+        self.folder = get_cache_path(
+            "osm", cache_key(polygon, source), cache_dir=cache_dir)
+        if refresh or not os.path.exists(f"{self.folder}/{META_FILE}"):
+            build_osm_cache(polygon, self.folder, pbf_file)
+        with open(f"{self.folder}/{META_FILE}", "r") as f:
+            self.meta = json.load(f)
+
+    @property
+    def version(self) -> str:
+        return self.meta["version"]
+
+    def network_gdfs(self, network_type: str) -> tuple:
+        nodes = _decode(gpd.read_parquet(
+            f"{self.folder}/{network_type}_nodes.parquet")).set_index("osmid")
+        edges = _decode(gpd.read_parquet(
+            f"{self.folder}/{network_type}_edges.parquet")).set_index(["u", "v", "key"])
+        return nodes, edges
+
+    def graph(self, network_type: str) -> nx.MultiDiGraph:
+        nodes, edges = self.network_gdfs(network_type)
+        return ox.graph_from_gdfs(nodes, edges)
+
+    def features(self, tags: dict) -> gpd.GeoDataFrame:
+        """
+        Features with any of the given tags, with the same shape as
+        `ox.features_from_polygon`. A tag set to True matches any value.
+        """
+        gdf = _decode(gpd.read_parquet(f"{self.folder}/features.parquet"))
+        mask = pd.Series(False, index=gdf.index)
+        for tag, values in tags.items():
+            if tag not in gdf.columns:
+                continue
+            if values is True:
+                mask |= gdf[tag].notna()
+                continue
+            values = values if isinstance(values, list) else [values]
+            mask |= gdf[tag].isin(values)
+        return gdf[mask].set_index(["element_type", "osmid"])
+
+
+def get_osm_cache(gdf_bounds: gpd.GeoDataFrame, radius: float = WALK_RADIUS, **kwargs) -> OsmCache:
+    """
+    Cache over the bounds plus `radius` meters, the widest area any stage
+    needs, so every stage reads the same layers and clips them to its own area.
+    """
+    utm_crs = gdf_bounds.estimate_utm_crs()
+    polygon = gdf_bounds.to_crs(utm_crs).buffer(
+        radius).to_crs("EPSG:4326").unary_union
+    return OsmCache(polygon, **kwargs)
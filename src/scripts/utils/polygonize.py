@@ -0,0 +1,162 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+import fiona
+import numpy as np
+import rasterio
+import shapely
+from affine import Affine
+from rasterio.features import shapes
+from rasterio.windows import Window
+from tqdm import tqdm
+
+POLYGONIZE_TILE_SIZE = 2048
+
+
+def split_seams(geometries: np.ndarray, block: Window, raster_shape: tuple) -> tuple:
+    """
+    Splits polygons into the finished ones and the ones that touch an inner
+    edge of the block, which still have to be merged with the neighbouring blocks.
+    """
+    bounds = shapely.bounds(geometries)
+    height, width = raster_shape
+    on_seam = (
+        ((bounds[:, 0] <= block.col_off) & (block.col_off > 0))
+        | ((bounds[:, 2] >= block.col_off + block.width) & (block.col_off + block.width < width))
+        | ((bounds[:, 1] <= block.row_off) & (block.row_off > 0))
+        | ((bounds[:, 3] >= block.row_off + block.height) & (block.row_off + block.height < height))
+    )
+    return shapely.to_wkb(geometries[~on_seam]).tolist(), shapely.to_wkb(geometries[on_seam]).tolist()
+
+
+def polygonize_window(raster_file: str, window: Window, band_index: int = 1, threshold: float = 0, raster_shape: tuple = None) -> tuple:
+    """
+    Polygons of the cells above the threshold in a window. The shapes of the
+    mask are already the union of its cells within the window. Coordinates are
+    kept in pixels of the whole raster, so the edges of neighbouring windows
+    match exactly.
+    """
+    with rasterio.open(raster_file) as src:
+        band_data = src.read(band_index, window=window)
+        raster_shape = raster_shape or (src.height, src.width)
+    mask = band_data > threshold
+    if not mask.any():
+        return [], []
+    transform = Affine.translation(window.col_off, window.row_off)
+    polygons = np.array([
+        shapely.geometry.shape(geom)
+        for geom, _ in shapes(mask.astype(np.uint8), mask=mask, transform=transform)
+    ])
+    return split_seams(polygons, window, raster_shape)
+
+
+def merge_block(parts: list, block: Window, raster_shape: tuple) -> tuple:
+    """Unions the seam polygons of the blocks inside a larger block and splits them again"""
+    geometries = shapely.get_parts(shapely.union_all(shapely.from_wkb(parts)))
+    return split_seams(geometries, block, raster_shape)
+
+
+def block_window(row: int, col: int, size: int, raster_shape: tuple) -> Window:
+    height, width = raster_shape
+    row_off, col_off = row * size, col * size
+    return Window(col_off, row_off, min(size, width - col_off), min(size, height - row_off))
+
+
+def bounded_map(executor, tasks, max_pending: int):
+    """
+    Runs (key, function, *args) tasks in the executor and yields (key, result)
+    as they finish, with at most `max_pending` of them submitted at a time so
+    finished results do not pile up in memory.
+    """
+    pending = {}
+    for key, function, *args in tasks:
+        if len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+        pending[executor.submit(function, *args)] = key
+    for future in as_completed(pending):
+        yield pending[future], future.result()
+
+
+def polygonize_raster(
+    raster_file: str,
+    output_file: str,
+    band_index: int = 1,
+    threshold: float = 0,
+    tile_size: int = POLYGONIZE_TILE_SIZE,
+    num_workers: int = None,
+) -> int:
+    """
+    Writes the polygons of the cells above the threshold to a FlatGeobuf,
+    reading the raster tile by tile. Each tile is polygonized on its own and
+    the polygons crossing the tile seams are merged level by level, joining 2x2
+    blocks at a time in a process pool. Only a few tiles are in flight at a
+    time and finished polygons are written as soon as they are known, so
+    neither the raster nor the result is held in memory.
+    """
+    start = time.time()
+    num_workers = num_workers or os.cpu_count()
+    with rasterio.open(raster_file) as src:
+        raster_shape = (src.height, src.width)
+        transform, crs = src.transform, src.crs
+    num_rows = -(-raster_shape[0] // tile_size)
+    num_cols = -(-raster_shape[1] // tile_size)
+
+    def to_crs(coords):
+        # From pixels to the coordinates of the raster
+        x, y = coords[:, 0], coords[:, 1]
+        return np.column_stack([
+            transform.a * x + transform.b * y + transform.c,
+            transform.d * x + transform.e * y + transform.f,
+        ])
+
+    schema = {"geometry": "Polygon", "properties": {}}
+    num_features = 0
+
+    with fiona.open(output_file, "w", driver="FlatGeobuf", schema=schema, crs=crs.to_wkt() if crs else None) as dst, \
+            ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        def write(parts):
+            nonlocal num_features
+            geometries = shapely.transform(shapely.from_wkb(parts), to_crs)
+            dst.writerecords(
+                {"geometry": geometry.__geo_interface__, "properties": {}}
+                for geometry in geometries
+            )
+            num_features += len(geometries)
+
+        # Tiles are polygonized and merged on their own
+        tasks = (
+            ((row, col), polygonize_window, raster_file,
+             block_window(row, col, tile_size, raster_shape), band_index, threshold, raster_shape)
+            for row in range(num_rows) for col in range(num_cols)
+        )
+        seams = {}
+        for key, (finished, seam) in tqdm(
+                bounded_map(executor, tasks, 2 * num_workers), total=num_rows * num_cols):
+            seams[key] = seam
+            write(finished)
+
+        # Then the seams are merged joining 2x2 blocks per level
+        size = tile_size
+        while num_rows > 1 or num_cols > 1:
+            size *= 2
+            num_rows, num_cols = -(-num_rows // 2), -(-num_cols // 2)
+            groups = {}
+            for (row, col), parts in seams.items():
+                groups.setdefault((row // 2, col // 2), []).extend(parts)
+            tasks = (
+                (key, merge_block, parts, block_window(*key, size, raster_shape), raster_shape)
+                for key, parts in groups.items() if parts
+            )
+            seams = {}
+            for key, (finished, seam) in bounded_map(executor, tasks, 2 * num_workers):
+                seams[key] = seam
+                write(finished)
+        for parts in seams.values():
+            write(parts)
+
+    print(f"{num_features} polygons written to {output_file} in {time.time() - start:.2f} seconds")
+    return num_features
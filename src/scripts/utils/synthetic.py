@@ -0,0 +1,27 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+
+def random_lots(num_lots: int, extent: float = 1, shrink: tuple = (0, 0), seed: int = 0) -> gpd.GeoDataFrame:
+    """
+    Square lots on a grid over the extent, grouped in blocks of one row of
+    lots. Each lot is shrunk on every side by a random share of its cell in
+    `shrink`, so lots do not need to touch.
+    """
+    rng = np.random.default_rng(seed)
+    cells = int(np.ceil(np.sqrt(num_lots)))
+    side = extent / cells
+    cols, rows = np.meshgrid(np.arange(cells), np.arange(cells))
+    cols, rows = cols.ravel()[:num_lots], rows.ravel()[:num_lots]
+    margin = side * rng.uniform(*shrink, num_lots)
+    return gpd.GeoDataFrame(
+        {
+            "lot_id": np.arange(num_lots),
+            "cvegeo": [f"25006000100{row:02d}{row:03d}" for row in rows],
+        },
+        geometry=shapely.box(
+            cols * side + margin, rows * side + margin,
+            (cols + 1) * side - margin, (rows + 1) * side - margin,
+        ),
+    )
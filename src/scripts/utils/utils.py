@@ -6,7 +6,10 @@ from typing import Optional
 import numpy as np
 import osmnx as ox
 import pandas as pd
+import pyogrio
 import pyproj
+import rasterio.features
+import shapely
 from pyproj import Transformer
 from dotenv import load_dotenv
 from geopandas import GeoDataFrame
@@ -41,19 +44,35 @@ def row2point(row, res_xy):
 
 
 def to_gdf(raster):
-    """Transform a raster to a GeoDataFrame"""
-    raster_geotable = raster.to_series(
-    ).reset_index().rename(columns={0: "Value"})
-    # Keep only cells with information
-    raster_geotable = raster_geotable.query("Value > 0")
-    # Build polygons for selected cells
-    polygons = raster_geotable.apply(
-        row2cell, res_xy=raster.rio.resolution(), axis=1)
-    # Convert to GeoSeries
-    features = polygons.pipe(gpd.GeoSeries, crs=raster.rio.crs)
-    gdf = GeoDataFrame.from_features(features, crs=raster.rio.crs)
-    # gdf = gdf.dissolve()
-    return gdf
+    """Transform a raster to a GeoDataFrame with one box per cell with information"""
+    values = np.asarray(raster.values)
+    # Keep only cells with information, in the same order as raster.to_series()
+    positions = np.nonzero(values > 0)
+    x = np.asarray(raster.x)[positions[-1]]
+    y = np.asarray(raster.y)[positions[-2]]
+    # XY Coordinates are centered on the pixel
+    res_x, res_y = raster.rio.resolution()
+    polygons = shapely.box(x - res_x / 2, y + res_y / 2,
+                           x + res_x / 2, y - res_y / 2)
+    return GeoDataFrame(geometry=polygons, crs=raster.rio.crs)
+
+
+def to_gdf_shapes(raster, connectivity=4):
+    """
+    Transform a raster to a GeoDataFrame with one polygon per connected region
+    of cells with information. Dissolved, it covers the same area as `to_gdf`
+    without building a polygon per cell.
+    """
+    values = np.asarray(raster.values)
+    values = values[0] if values.ndim == 3 else values
+    mask = values > 0
+    polygons = [
+        shapely.geometry.shape(shape)
+        for shape, _ in rasterio.features.shapes(
+            mask.astype(np.uint8), mask=mask, connectivity=connectivity,
+            transform=raster.rio.transform())
+    ]
+    return GeoDataFrame(geometry=polygons, crs=raster.rio.crs)
 
 
 def normalized_limit(x, min, max):
@@ -167,11 +186,25 @@ def convert_distance(distance, crs_src="EPSG:3857", crs_dst="EPSG:4326") -> floa
     return distance_in_degrees
 
 
-def load_gdf(file: str, gdf_bounds: Optional[gpd.GeoDataFrame]=None) -> gpd.GeoDataFrame:
-    if gdf_bounds is None:
-        return gpd.read_file(file, engine="pyogrio").to_crs("EPSG:4326")
-    gdf = gpd.read_file(file, engine="pyogrio").to_crs("EPSG:4326")
-    gdf = gdf[gdf.intersects(gdf_bounds.unary_union)]
+def load_gdf(file: str, gdf_bounds: Optional[gpd.GeoDataFrame]=None, columns: Optional[list]=None, crs: str="EPSG:4326") -> gpd.GeoDataFrame:
+    """
+    Reads a layer in `crs`. With `gdf_bounds` only the features in its bbox are
+    read (computed in the CRS of the file) and then filtered with a spatial
+    index query against the bounds, before anything is reprojected.
+    """
+    source_crs = pyogrio.read_info(file)["crs"]
+    bbox = None
+    if gdf_bounds is not None:
+        if source_crs is not None:
+            gdf_bounds = gdf_bounds.to_crs(source_crs)
+        bbox = tuple(gdf_bounds.total_bounds)
+    gdf = pyogrio.read_dataframe(file, bbox=bbox, columns=columns, use_arrow=True)
+
+    if gdf_bounds is not None and not gdf.empty:
+        indices = gdf.sindex.query(gdf_bounds.unary_union, predicate="intersects")
+        gdf = gdf.iloc[np.sort(indices)]
+    if gdf.crs is not None and not gdf.crs.equals(crs):
+        gdf = gdf.to_crs(crs)
     return gdf
 
 
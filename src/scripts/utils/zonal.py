@@ -0,0 +1,107 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio.features
+from affine import Affine
+
+def rasterize_zones(geometries: gpd.GeoSeries, transform: Affine, shape: tuple, all_touched: bool = False) -> np.ndarray:
+    """
+    Burns the geometries onto the raster grid. Pixels get the position of
+    the geometry they belong to plus one, 0 is left for pixels of no zone.
+    """
+    zones = np.zeros(shape, dtype=np.int32)
+    shapes = [
+        (geometry, i + 1)
+        for i, geometry in enumerate(geometries)
+        if geometry is not None and not geometry.is_empty
+    ]
+    if shapes:
+        rasterio.features.rasterize(
+            shapes, out=zones, transform=transform, all_touched=all_touched)
+    return zones
+
+
+def centroid_pixels(geometries: gpd.GeoSeries, transform: Affine, shape: tuple) -> tuple:
+    """Row and column of the pixel under each centroid, -1 when it falls outside the grid"""
+    points = geometries.representative_point()
+    inverse = ~transform
+    x, y = points.x.to_numpy(), points.y.to_numpy()
+    cols = inverse.a * x + inverse.b * y + inverse.c
+    rows = inverse.d * x + inverse.e * y + inverse.f
+    rows, cols = np.floor(rows).astype(int), np.floor(cols).astype(int)
+    outside = (rows < 0) | (rows >= shape[0]) | (cols < 0) | (cols >= shape[1])
+    rows[outside], cols[outside] = -1, -1
+    return rows, cols
+
+
+def zonal_stats(values: np.ndarray, zones: np.ndarray, num_zones: int, valid: np.ndarray = None, percentiles: tuple = ()) -> pd.DataFrame:
+    """
+    Count, mean, min, max and percentiles of the values of each zone. Pixels
+    are sorted by zone and value once, so every statistic is an offset into
+    the sorted array instead of a pass per zone.
+    """
+    selected = zones > 0
+    if valid is not None:
+        selected &= valid
+    labels = zones[selected] - 1
+    pixel_values = values[selected].astype(np.float64)
+    order = np.lexsort((pixel_values, labels))
+    labels, pixel_values = labels[order], pixel_values[order]
+
+    counts = np.bincount(labels, minlength=num_zones)
+    sums = np.bincount(labels, weights=pixel_values, minlength=num_zones)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    has_pixels = counts > 0
+
+    stats = pd.DataFrame({"count": counts})
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats["mean"] = np.where(has_pixels, sums / counts, np.nan)
+    stats["min"] = _take(pixel_values, starts, has_pixels)
+    stats["max"] = _take(pixel_values, starts + counts - 1, has_pixels)
+    for q in percentiles:
+        # Linear interpolation between the closest ranks, like np.percentile
+        rank = starts + (counts - 1).clip(0) * q / 100
+        lower, upper = np.floor(rank).astype(int), np.ceil(rank).astype(int)
+        low = _take(pixel_values, lower, has_pixels)
+        high = _take(pixel_values, upper, has_pixels)
+        stats[f"p{q:g}"] = low + (high - low) * (rank - lower)
+    return stats
+
+
+def _take(array: np.ndarray, positions: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    result = np.full(len(positions), np.nan)
+    result[mask] = array[positions[mask]]
+    return result
+
+
+def zonal_stats_gdf(
+    gdf: gpd.GeoDataFrame,
+    values: np.ndarray,
+    transform: Affine,
+    valid: np.ndarray = None,
+    percentiles: tuple = (),
+    all_touched: bool = False,
+) -> pd.DataFrame:
+    """
+    Statistics of the raster values inside each geometry, indexed like `gdf`.
+    Geometries too small to hold the center of any pixel take the pixel
+    under their centroid.
+    """
+    zones = rasterize_zones(gdf.geometry, transform,
+                            values.shape, all_touched=all_touched)
+    stats = zonal_stats(values, zones, len(gdf), valid, percentiles)
+
+    missing = np.flatnonzero(stats["count"].to_numpy() == 0)
+    if len(missing) > 0:
+        rows, cols = centroid_pixels(
+            gdf.geometry.iloc[missing], transform, values.shape)
+        inside = rows >= 0
+        if valid is not None:
+            inside[inside] &= valid[rows[inside], cols[inside]]
+        missing, rows, cols = missing[inside], rows[inside], cols[inside]
+        pixel_values = values[rows, cols].astype(np.float64)
+        stats.loc[missing, "count"] = 1
+        for column in stats.columns.drop("count"):
+            stats.loc[missing, column] = pixel_values
+    stats.index = gdf.index
+    return stats
@@ -1,6 +1,10 @@
+import io
+import json
 import os
-from typing import List, Dict
-from sqlalchemy import create_engine, func, Table, MetaData, case, select, desc
+from datetime import datetime
+from typing import List, Dict, Optional
+from sqlalchemy import create_engine, func, Table, MetaData, case, select, desc, inspect, text
+from sqlalchemy.types import BigInteger, Boolean, Float, Text
 from sqlalchemy.sql import literal_column
 from sqlalchemy.orm import Session, aliased
 from functools import lru_cache
@@ -281,6 +285,19 @@ METRIC_MAPPING = {
 }
 
 
+# Prefix length of the cvegeo (ENT + MUN + LOC + AGEB + MZA) for each rollup level
+ROLLUP_LEVELS = {
+    "municipio": 5,
+    "localidad": 9,
+    "ageb": 13,
+}
+# Metrics that depend on the request can not be precomputed
+ROLLUP_METRICS = [
+    metric for metric in METRIC_MAPPING
+    if metric not in ["per_female_group_ages", "per_male_group_ages", "per_group_ages"]
+]
+
+
 def get_metric(metric: str, Lots, Blocks):
     if metric in METRIC_MAPPING:
         return METRIC_MAPPING[metric]
@@ -312,20 +329,21 @@ def get_engine():
     return create_engine(connection_string)
 
 
-def get_metrics_info(metrics: List[str]):
-    engine = get_engine()
-    metadata = MetaData()
-    Blocks = Table('blocks', metadata, autoload_with=engine)
-    Lots = Table('lots', metadata, autoload_with=engine)
+def get_table(name: str, schema: str = None) -> Table:
+    return Table(name, MetaData(schema=schema), autoload_with=get_engine())
+
+
+def get_metrics_info(metrics: List[str], schema: str = None):
+    Blocks = get_table('blocks', schema)
+    Lots = get_table('lots', schema)
     return [get_metric(metric, Lots, Blocks) for metric in metrics]
 
 
-def query_metrics(level: str, metrics: Dict[str, str], ids: List[str] = None, payload: Dict[str, str] = None):
+def query_metrics(level: str, metrics: Dict[str, str], ids: List[str] = None, payload: Dict[str, str] = None, schema: str = None):
     # TODO: Refactor code since it is too unnecessarily complex
     engine = get_engine()
-    metadata = MetaData()
-    Blocks = Table('blocks', metadata, autoload_with=engine)
-    Lots = Table('lots', metadata, autoload_with=engine)
+    Blocks = get_table('blocks', schema)
+    Lots = get_table('lots', schema)
 
     with Session(engine) as session:
         # Aliases for easy access to both tables
@@ -401,17 +419,26 @@ def query_metrics(level: str, metrics: Dict[str, str], ids: List[str] = None, pa
         return df
 
 
+def query_lot_counts(metrics: List[str], payload: Dict[str, str] = None, schema: str = None) -> pd.DataFrame:
+    """Number of lots with a value of each lot metric in every block"""
+    Blocks = get_table('blocks', schema)
+    Lots = get_table('lots', schema)
+    with Session(get_engine()) as session:
+        query = session.query(Lots.c.cvegeo.label("cvegeo"))
+        for metric in metrics:
+            _metric = get_metric(metric, Lots, Blocks)["query"](Lots, payload)
+            query = query.add_columns(func.count(_metric).label(metric))
+        query = query.group_by(Lots.c.cvegeo)
+        return pd.read_sql(query.statement, session.bind)
+
+
 def select_minutes(
-    level: str, ids: List[str], amenities: List[str]
+    level: str, ids: List[str], amenities: List[str], schema: str = None
 ):
     engine = get_engine()
-    metadata = MetaData()
-    Blocks = Table('blocks', metadata, autoload_with=engine)
-    Blocks = aliased(Blocks)
-    Lots = Table('lots', metadata, autoload_with=engine)
-    Lots = aliased(Lots)
-    AccessibilityTrips = Table(
-        'accessibility_trips', metadata, autoload_with=engine)
+    Blocks = aliased(get_table('blocks', schema))
+    Lots = aliased(get_table('lots', schema))
+    AccessibilityTrips = get_table('accessibility_trips', schema)
     with Session(engine) as session:
         query = session.query(
             func.min(AccessibilityTrips.c.amenity).label("amenity"),
@@ -435,13 +462,11 @@ def select_minutes(
         return df
 
 
-def select_furthest_amenity(level: str, ids: List[str], amenities: List[str]):
+def select_furthest_amenity(level: str, ids: List[str], amenities: List[str], schema: str = None):
     engine = get_engine()
-    metadata = MetaData()
-    Blocks = Table('blocks', metadata, autoload_with=engine)
-    Lots = Table('lots', metadata, autoload_with=engine)
-    AccessibilityTrips = Table(
-        'accessibility_trips', metadata, autoload_with=engine)
+    Blocks = get_table('blocks', schema)
+    Lots = get_table('lots', schema)
+    AccessibilityTrips = get_table('accessibility_trips', schema)
 
     with Session(engine) as session:
         # Aliased table for ranking rows within each origin_id
@@ -497,15 +522,12 @@ def select_furthest_amenity(level: str, ids: List[str], amenities: List[str]):
 
 
 def select_accessibility_score(
-    level: str, ids: List[str], amenities: List[str]
+    level: str, ids: List[str], amenities: List[str], schema: str = None
 ):
     engine = get_engine()  # Ensure this function is defined to get the engine
-    metadata = MetaData()
-    Blocks = Table('blocks', metadata, autoload_with=engine)
-    Blocks = aliased(Blocks)
-    Lots = Table('lots', metadata, autoload_with=engine)
-    AccessibilityTrips = Table(
-        'accessibility_trips', metadata, autoload_with=engine)
+    Blocks = aliased(get_table('blocks', schema))
+    Lots = get_table('lots', schema)
+    AccessibilityTrips = get_table('accessibility_trips', schema)
 
     with Session(engine) as session:
         # Step 1: Precompute Rj values for each destination_id as a subquery
@@ -574,3 +596,160 @@ def select_accessibility_score(
                 len(intermediate_df["amenity"].unique())
 
         return final_df
+
+
+def select_rollups(level: str, schema: str = None) -> pd.DataFrame:
+    """Metrics of every area of a rollup level, reduced from their additive sums and counts"""
+    engine = get_engine()
+    Rollups = get_table('rollups', schema)
+    RollupGeometries = get_table('rollup_geometries', schema)
+
+    with Session(engine) as session:
+        query = session.query(Rollups).filter(Rollups.c.level == level)
+        df = pd.read_sql(query.statement, session.bind)
+        query = session.query(
+            RollupGeometries.c.code,
+            RollupGeometries.c.num_blocks,
+            RollupGeometries.c.geometry,
+        ).filter(RollupGeometries.c.level == level)
+        df_geometries = pd.read_sql(query.statement, session.bind)
+
+    reduce = df["metric"].map(
+        lambda metric: METRIC_MAPPING[metric]["reduce"])
+    df["value"] = df["sum"].where(
+        reduce == "sum", df["sum"] / df["count"].replace(0, float("nan")))
+    df = df.pivot(index="code", columns="metric", values="value")
+    return df_geometries.merge(df, left_on="code", right_index=True, how="left")
+
+
+def select_rollups_updated_at(level: str, schema: str = None) -> Optional[datetime]:
+    """When populate_db last rebuilt the rollups of a level"""
+    RollupGeometries = get_table('rollup_geometries', schema)
+    with get_engine().connect() as connection:
+        return connection.execute(
+            select(func.max(RollupGeometries.c.updated_at)).where(RollupGeometries.c.level == level)).scalar()
+
+
+def select_region(name: str, schema: str = None) -> Optional[Dict]:
+    Regions = get_table('regions', schema)
+    with get_engine().connect() as connection:
+        row = connection.execute(
+            select(Regions).where(Regions.c.name == name)).mappings().first()
+    if row is None:
+        return None
+    region = dict(row)
+    region["ids"] = json.loads(region["ids"])
+    region["aggregates"] = json.loads(region["aggregates"])
+    return region
+
+
+def select_region_updated_at(name: str, schema: str = None) -> Optional[datetime]:
+    Regions = get_table('regions', schema)
+    with get_engine().connect() as connection:
+        return connection.execute(
+            select(Regions.c.updated_at).where(Regions.c.name == name)).scalar()
+
+
+def select_regions(schema: str = None) -> pd.DataFrame:
+    Regions = get_table('regions', schema)
+    query = select(Regions.c.name, Regions.c.layers_version,
+                   Regions.c.updated_at).order_by(Regions.c.name)
+    with get_engine().connect() as connection:
+        return pd.read_sql(query, connection)
+
+
+def save_region(region: Dict, schema: str = None) -> Dict:
+    """Inserts or replaces a region, ids and aggregates are stored as JSON"""
+    Regions = get_table('regions', schema)
+    region = {**region, "updated_at": datetime.now()}
+    values = {
+        **region,
+        "ids": json.dumps(region["ids"]),
+        "aggregates": json.dumps(region["aggregates"], default=lambda value: value.item()),
+    }
+    with get_engine().begin() as connection:
+        connection.execute(Regions.delete().where(
+            Regions.c.name == region["name"]))
+        connection.execute(Regions.insert().values(**values))
+    return region
+
+
+def delete_region(name: str, schema: str = None) -> bool:
+    Regions = get_table('regions', schema)
+    with get_engine().begin() as connection:
+        result = connection.execute(
+            Regions.delete().where(Regions.c.name == name))
+    return result.rowcount > 0
+
+
+def _column_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return Boolean()
+    if pd.api.types.is_integer_dtype(dtype):
+        return BigInteger()
+    if pd.api.types.is_float_dtype(dtype):
+        return Float()
+    return Text()
+
+
+def update_columns(table_name: str, df: pd.DataFrame, key: str, columns: List[str] = None, schema: str = None, engine=None) -> int:
+    """
+    Sets `columns` of the rows of a table from a dataframe joined on `key`,
+    adding the columns that do not exist yet. In Postgres the values are
+    copied to a temporary table and applied with a single UPDATE ... FROM;
+    other databases get one parametrized UPDATE per row, which expects an
+    index on `key` outside of SQLite.
+    """
+    engine = engine or get_engine()
+    columns = columns or [col for col in df.columns if col != key]
+    quote = engine.dialect.identifier_preparer.quote
+    full_name = f"{quote(schema)}.{quote(table_name)}" if schema else quote(table_name)
+
+    existing = {col["name"] for col in inspect(engine).get_columns(table_name, schema=schema)}
+    with engine.begin() as connection:
+        for column in columns:
+            if column not in existing:
+                column_type = _column_type(df[column].dtype).compile(dialect=engine.dialect)
+                connection.execute(text(
+                    f"ALTER TABLE {full_name} ADD COLUMN {quote(column)} {column_type}"))
+
+    df = df[[key, *columns]]
+    if engine.dialect.name == "postgresql":
+        assignments = ", ".join(f"{quote(col)} = u.{quote(col)}" for col in columns)
+        names = ", ".join(quote(col) for col in [key, *columns])
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TEMP TABLE _updates ON COMMIT DROP AS SELECT {names} FROM {full_name} WITH NO DATA")
+                cursor.copy_expert(
+                    f"COPY _updates ({names}) FROM STDIN WITH (FORMAT csv)", buffer)
+                cursor.execute(
+                    f"UPDATE {full_name} AS t SET {assignments} FROM _updates AS u WHERE t.{quote(key)} = u.{quote(key)}")
+                rowcount = cursor.rowcount
+            connection.commit()
+        finally:
+            connection.close()
+        return rowcount
+
+    assignments = ", ".join(f"{quote(col)} = :value_{i}" for i, col in enumerate(columns))
+    query = text(
+        f"UPDATE {full_name} SET {assignments} WHERE {quote(key)} = :key")
+    values = df.astype(object).where(df.notna(), None)
+    parameters = [
+        {"key": row[0], **{f"value_{i}": value for i, value in enumerate(row[1:])}}
+        for row in values.itertuples(index=False, name=None)
+    ]
+    with engine.begin() as connection:
+        if engine.dialect.name == "sqlite":
+            # Without an index on the key every row of the batch scans the table,
+            # in SQLite the schema qualifies the index and not the table
+            index_name = quote(f"ix_{table_name}_{key}")
+            index_name = f"{quote(schema)}.{index_name}" if schema else index_name
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON {quote(table_name)} ({quote(key)})"))
+        result = connection.execute(query, parameters)
+    return result.rowcount
@@ -0,0 +1,282 @@
+import math
+import os
+import struct
+from typing import Dict, List
+
+import numpy as np
+import pyogrio
+
+MAGIC_BYTES = b"fgb\x03fgb\x00"
+NODE_ITEM_DTYPE = np.dtype([("bounds", "<f8", (4,)), ("offset", "<u8")])
+NODE_ITEM_SIZE = NODE_ITEM_DTYPE.itemsize
+# Position of the fields in the FlatGeobuf header table
+FEATURES_COUNT_FIELD = 8
+INDEX_NODE_SIZE_FIELD = 9
+# Header fields that point to strings, vectors or tables, and the size of the scalar ones
+HEADER_OFFSET_FIELDS = {0, 1, 7, 10, 11, 12, 13}
+HEADER_SCALAR_SIZES = {2: 1, 3: 1, 4: 1, 5: 1, 6: 1,
+                       FEATURES_COUNT_FIELD: 8, INDEX_NODE_SIZE_FIELD: 2}
+
+
+class FlatGeobufError(Exception):
+    """The layer file can not be indexed or read as FlatGeobuf"""
+
+
+def level_bounds(num_items: int, node_size: int) -> List[tuple]:
+    """Start and end node of every level of a packed R-tree, leaves first"""
+    n = num_items
+    level_num_nodes = [n]
+    while True:
+        n = math.ceil(n / node_size)
+        level_num_nodes.append(n)
+        if n == 1:
+            break
+    offset = sum(level_num_nodes)
+    bounds = []
+    for size in level_num_nodes:
+        offset -= size
+        bounds.append((offset, offset + size))
+    return bounds
+
+
+def packed_rtree_size(num_items: int, node_size: int) -> int:
+    node_size = min(max(node_size, 2), 65535)
+    return level_bounds(num_items, node_size)[0][1] * NODE_ITEM_SIZE
+
+
+def build_packed_rtree(bounds: np.ndarray, offsets: np.ndarray, node_size: int) -> bytes:
+    """
+    Packed R-tree over features that are already sorted (FlatGeobuf keeps them
+    in Hilbert order), stored root first with the leaves at the end.
+    """
+    levels = level_bounds(len(bounds), node_size)
+    num_nodes = levels[0][1]
+    nodes = np.zeros(num_nodes, dtype=NODE_ITEM_DTYPE)
+    start, end = levels[0]
+    nodes["bounds"][start:end] = bounds
+    nodes["offset"][start:end] = offsets
+    for (start, end), (parent_start, _) in zip(levels[:-1], levels[1:]):
+        for i, pos in enumerate(range(start, end, node_size)):
+            children = nodes["bounds"][pos:min(pos + node_size, end)]
+            parent = nodes[parent_start + i]
+            parent["bounds"][:2] = children[:, :2].min(axis=0)
+            parent["bounds"][2:] = children[:, 2:].max(axis=0)
+            parent["offset"] = pos
+    return nodes.tobytes()
+
+
+def _field_position(header: bytes, field: int):
+    """Absolute position of a scalar field in the header table, None if it has the default value"""
+    table = struct.unpack_from("<I", header, 0)[0]
+    vtable = table - struct.unpack_from("<i", header, table)[0]
+    vtable_size = struct.unpack_from("<H", header, vtable)[0]
+    if 4 + 2 * field >= vtable_size:
+        return None
+    offset = struct.unpack_from("<H", header, vtable + 4 + 2 * field)[0]
+    return table + offset if offset else None
+
+
+def _align(position: int, alignment: int = 8) -> int:
+    return -(-position // alignment) * alignment
+
+
+def rebuild_header(header: bytes, features_count: int, index_node_size: int) -> bytes:
+    """
+    Header with the given feature count and index node size. Fields left at
+    their default have no slot in the original table, so a new table with
+    every field is placed in front of the original buffer and its strings,
+    vectors and tables are pointed to where they now are.
+    """
+    table = struct.unpack_from("<I", header, 0)[0]
+    vtable = table - struct.unpack_from("<i", header, table)[0]
+    num_fields = (struct.unpack_from("<H", header, vtable)[0] - 4) // 2
+    fields = {}
+    for field in range(num_fields):
+        position = _field_position(header, field)
+        if position is not None:
+            fields[field] = position
+    num_fields = max([INDEX_NODE_SIZE_FIELD, *fields]) + 1
+
+    # Largest fields first keeps every field aligned in a table aligned to 8
+    sizes = {field: 4 if field in HEADER_OFFSET_FIELDS else HEADER_SCALAR_SIZES[field]
+             for field in set(fields) | {FEATURES_COUNT_FIELD, INDEX_NODE_SIZE_FIELD}}
+    layout, table_size = {}, 8
+    for field in sorted(sizes, key=lambda field: -sizes[field]):
+        table_size = _align(table_size, sizes[field])
+        layout[field] = table_size
+        table_size += sizes[field]
+    new_vtable = 4
+    new_table = _align(new_vtable + 4 + 2 * num_fields)
+    shift = _align(new_table + table_size)
+
+    result = bytearray(shift) + header
+    struct.pack_into("<I", result, 0, new_table)
+    struct.pack_into("<HH", result, new_vtable, 4 + 2 * num_fields, table_size)
+    struct.pack_into("<i", result, new_table, new_table - new_vtable)
+    values = {FEATURES_COUNT_FIELD: ("<Q", features_count),
+              INDEX_NODE_SIZE_FIELD: ("<H", index_node_size)}
+    for field, offset in layout.items():
+        struct.pack_into("<H", result, new_vtable + 4 + 2 * field, offset)
+        position = new_table + offset
+        if field in values:
+            struct.pack_into(values[field][0], result, position, values[field][1])
+        elif field in HEADER_OFFSET_FIELDS:
+            target = fields[field] + struct.unpack_from("<I", header, fields[field])[0]
+            struct.pack_into("<I", result, position, target + shift - position)
+        else:
+            result[position:position + sizes[field]] = header[fields[field]:fields[field] + sizes[field]]
+    return bytes(result)
+
+
+def read_header(filepath: str) -> Dict:
+    with open(filepath, "rb") as f:
+        magic = f.read(8)
+        if magic[:3] != MAGIC_BYTES[:3]:
+            raise FlatGeobufError(f"{filepath} is not a FlatGeobuf file")
+        header_size = struct.unpack("<I", f.read(4))[0]
+        header = f.read(header_size)
+
+    position = _field_position(header, FEATURES_COUNT_FIELD)
+    features_count = struct.unpack_from(
+        "<Q", header, position)[0] if position else 0
+    position = _field_position(header, INDEX_NODE_SIZE_FIELD)
+    index_node_size = struct.unpack_from(
+        "<H", header, position)[0] if position else 16
+
+    index_offset = 8 + 4 + header_size
+    features_offset = index_offset
+    if features_count > 0 and index_node_size > 0:
+        features_offset += packed_rtree_size(features_count, index_node_size)
+    return {
+        "magic": magic,
+        "header": header,
+        "features_count": features_count,
+        "index_node_size": index_node_size,
+        "index_offset": index_offset,
+        "features_offset": features_offset,
+    }
+
+
+def feature_offsets(filepath: str) -> tuple:
+    """Byte offset and size (including the size prefix) of every feature in file order"""
+    info = read_header(filepath)
+    file_size = os.path.getsize(filepath)
+    offsets, sizes = [], []
+    with open(filepath, "rb") as f:
+        offset = info["features_offset"]
+        f.seek(offset)
+        while offset < file_size:
+            size = struct.unpack("<I", f.read(4))[0] + 4
+            offsets.append(offset)
+            sizes.append(size)
+            offset += size
+            f.seek(offset)
+    return np.array(offsets, dtype=np.int64), np.array(sizes, dtype=np.int64)
+
+
+def feature_bounds(filepath: str, offsets: np.ndarray) -> np.ndarray:
+    """Bounds of every feature in file order, taken from the leaves of the spatial index"""
+    info = read_header(filepath)
+    count, node_size = info["features_count"], info["index_node_size"]
+    if count == 0 or node_size == 0:
+        return np.zeros((0, 4))
+    leaves_start, _ = level_bounds(count, node_size)[0]
+    leaves = np.fromfile(
+        filepath,
+        dtype=NODE_ITEM_DTYPE,
+        count=count,
+        offset=info["index_offset"] + leaves_start * NODE_ITEM_SIZE,
+    )
+    order = np.argsort(leaves["offset"])
+    relative_offsets = offsets - info["features_offset"]
+    if not np.array_equal(leaves["offset"][order], relative_offsets):
+        raise FlatGeobufError(f"Spatial index of {filepath} does not match its features")
+    return leaves["bounds"][order]
+
+
+def get_index_path(filepath: str, id_column: str) -> str:
+    return f"{os.path.splitext(filepath)[0]}.{id_column}.idx.npz"
+
+
+def build_offset_index(filepath: str, id_column: str) -> str:
+    """
+    Writes next to the layer a sorted id -> (offset, size) index, so a list of
+    features can be read with direct seeks instead of a scan or a spatial query.
+    """
+    offsets, sizes = feature_offsets(filepath)
+    # Features are read back in the order they are stored in the file
+    df = pyogrio.read_dataframe(
+        filepath, columns=[id_column], read_geometry=False)
+    if len(df) != len(offsets):
+        raise FlatGeobufError(
+            f"Found {len(offsets)} features in {filepath} but read {len(df)}")
+    ids = df[id_column].astype(str).to_numpy(dtype=str)
+    bounds = feature_bounds(filepath, offsets)
+    order = np.argsort(ids, kind="stable")
+    index_path = get_index_path(filepath, id_column)
+    with open(index_path, "wb") as f:
+        np.savez(
+            f,
+            ids=ids[order],
+            offsets=offsets[order],
+            sizes=sizes[order],
+            bounds=bounds[order] if len(bounds) else bounds,
+        )
+    return index_path
+
+
+class OffsetIndex:
+    def __init__(self, filepath: str, id_column: str):
+        index_path = get_index_path(filepath, id_column)
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(filepath):
+            build_offset_index(filepath, id_column)
+        with np.load(index_path) as data:
+            self.ids = data["ids"]
+            self.offsets = data["offsets"]
+            self.sizes = data["sizes"]
+            self.bounds = data["bounds"]
+        self.filepath = filepath
+        self.info = read_header(filepath)
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.offsets.nbytes + self.sizes.nbytes + self.bounds.nbytes
+
+    def lookup(self, ids: List[str]) -> np.ndarray:
+        """Positions in the index of the requested ids that exist in the layer"""
+        ids = np.asarray(ids, dtype=str)
+        positions = np.searchsorted(self.ids, ids)
+        positions = np.clip(positions, 0, max(len(self.ids) - 1, 0))
+        found = self.ids[positions] == ids if len(self.ids) else np.zeros(
+            len(ids), dtype=bool)
+        return np.unique(positions[found])
+
+    def read(self, ids: List[str]) -> bytes:
+        """
+        Builds a FlatGeobuf with only the requested features, read with direct
+        seeks. The header is rebuilt with the new feature count and, when the
+        layer has a spatial index, a new one is packed from the leaf bounds.
+        """
+        positions = self.lookup(ids)
+        if len(positions) == 0:
+            raise ValueError("None of the requested features exist")
+        # Reading in file order keeps the seeks moving forward and the Hilbert order
+        positions = positions[np.argsort(self.offsets[positions])]
+
+        # Layers written without a count have no spatial index either
+        has_index = self.info["features_count"] > 0 and self.info["index_node_size"] > 0
+        index_node_size = self.info["index_node_size"] if has_index else 0
+        header = rebuild_header(
+            self.info["header"], len(positions), index_node_size)
+        chunks = [self.info["magic"], struct.pack("<I", len(header)), header]
+        if has_index:
+            sizes = self.sizes[positions]
+            offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+            chunks.append(build_packed_rtree(
+                self.bounds[positions], offsets, self.info["index_node_size"]))
+
+        with open(self.filepath, "rb") as f:
+            for position in positions:
+                f.seek(self.offsets[position])
+                chunks.append(f.read(self.sizes[position]))
+        return b"".join(chunks)
@@ -5,6 +5,8 @@ import json
 from urllib.parse import urlparse
 import shutil
 
+from src.utils.projects import get_project
+
 TTL = 3600 * 15 * 24  # seconds
 BASE_LOCATION = os.getenv("BASE_FILE_LOCATION", "./temp")
 TIMESTAMP_FILE = f"{BASE_LOCATION}/file_timestamps.json"
@@ -19,11 +21,13 @@ def save_timestamps(timestamps):
     with open(TIMESTAMP_FILE, 'w') as file:
         json.dump(timestamps, file)
 
-def get_file(url):
-    # Parse the URL to get the file name
+def get_local_path(url):
+    # Keep the folder of the url so files from different projects do not collide
     parsed_url = urlparse(url)
-    file_name = os.path.basename(parsed_url.path)
-    file_path = f"{BASE_LOCATION}/{file_name}"
+    return f"{BASE_LOCATION}/{parsed_url.path.removeprefix('./').lstrip('/')}"
+
+def get_file(url):
+    file_path = get_local_path(url)
 
     timestamps = load_timestamps()
 
@@ -42,24 +46,20 @@ def get_file(url):
     return file_path
 
 BLOB_URL = "https://reimaginaurbanostorage.blob.core.windows.net"
-def get_blob_url(file_name: str) -> str:
+def get_blob_url(file_name: str, project: str = None) -> str:
+    config = get_project(project)
     if os.getenv("ENVIRONMENT") == "local":
-        return f"data/_primavera/final/{file_name}"
+        return f"{config['local_dir']}/{file_name}"
     access_token = os.getenv("BLOB_TOKEN")
-    return f"{BLOB_URL}/culiacan/{file_name}?{access_token}"
+    return f"{BLOB_URL}/{config['blob_prefix']}/{file_name}?{access_token}"
 
 def download_file(url):
+    file_path = get_local_path(url)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
     if os.getenv("ENVIRONMENT") == "local":
-        filename = os.path.basename(urlparse(url).path)
-        if not os.path.exists(f"{BASE_LOCATION}/{filename}"):
-            shutil.copy(url, BASE_LOCATION)
+        if not os.path.exists(file_path):
+            shutil.copy(url, file_path)
         return url
-    os.makedirs(BASE_LOCATION, exist_ok=True)
-
-    # Parse the URL to get the file name
-    parsed_url = urlparse(url)
-    file_name = os.path.basename(parsed_url.path)
-    file_path = f"{BASE_LOCATION}/{file_name}"
 
     # Download the file
     response = requests.get(url)
@@ -0,0 +1,23 @@
+from typing import Optional
+
+LOD_LAYERS = ["lots", "blocks"]
+# Simplified variants of a layer, from the coarsest to the finest. Each one is
+# served up to `max_zoom`; above the last band the original layer is used.
+# Tolerance and precision grid are in degrees (1e-5 is roughly 1 m).
+LOD_BANDS = [
+    {"name": "lod0", "max_zoom": 12, "tolerance": 0.0001, "precision": 0.00002},
+    {"name": "lod1", "max_zoom": 14, "tolerance": 0.00003, "precision": 0.000005},
+    {"name": "lod2", "max_zoom": 16, "tolerance": 0.00001, "precision": 0.000001},
+]
+
+
+def get_lod_layer(layer: str, zoom: Optional[float] = None, tolerance: Optional[float] = None) -> str:
+    """Name of the layer variant to serve for a zoom level or a maximum tolerance"""
+    if layer not in LOD_LAYERS:
+        return layer
+    for band in LOD_BANDS:
+        if zoom is not None and zoom <= band["max_zoom"]:
+            return f"{layer}_{band['name']}"
+        if zoom is None and tolerance is not None and band["tolerance"] <= tolerance:
+            return f"{layer}_{band['name']}"
+    return layer
@@ -0,0 +1,132 @@
+import json
+import os
+from collections import Counter
+from threading import RLock
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_PROJECT = os.getenv("DEFAULT_PROJECT", "culiacan")
+PROJECTS_FILE = os.getenv("PROJECTS_FILE")
+PROJECT_MEMORY_BUDGET = int(
+    os.getenv("PROJECT_MEMORY_BUDGET_MB", "2048")) * 1024 * 1024
+
+# Every project maps to the blob container (or local folder) with its layers,
+# the database schema with its tables and the layers that can be served.
+# When `layers` is missing any layer in the container can be requested.
+# `areas` lists the sub-areas whose bounds are stored as <area>_bounds.fgb.
+PROJECTS = {
+    "culiacan": {
+        "blob_prefix": "culiacan",
+        "local_dir": "data/_primavera/final",
+        "schema": None,
+        "bounds": "primavera_bounds.fgb",
+        "areas": ["primavera"],
+    },
+}
+if PROJECTS_FILE and os.path.exists(PROJECTS_FILE):
+    with open(PROJECTS_FILE, "r") as file:
+        PROJECTS.update(json.load(file))
+
+
+def get_project(project: Optional[str] = None) -> Dict[str, Any]:
+    project = project or DEFAULT_PROJECT
+    if project not in PROJECTS:
+        raise ValueError(f"Unknown project: {project}")
+    return PROJECTS[project]
+
+
+def get_area_project(area: str) -> Optional[str]:
+    """Project that declares `area` as one of its sub-areas"""
+    for project, config in PROJECTS.items():
+        if area in config.get("areas", []):
+            return project
+    return None
+
+
+def has_layer(project: Optional[str], layer: str) -> bool:
+    layers = get_project(project).get("layers")
+    return layers is None or layer in layers
+
+
+class ProjectCache:
+    """
+    Keeps warm objects (layer stores, spatial indexes, rollups) grouped by
+    project under a single memory budget. When the budget is exceeded whole
+    projects are dropped, starting with the ones that received the fewest
+    requests, so the busiest cities stay loaded.
+    """
+
+    def __init__(self, budget: int = PROJECT_MEMORY_BUDGET):
+        self.budget = budget
+        self.entries: Dict[str, Dict[str, tuple]] = {}
+        self.hits = Counter()
+        self.lock = RLock()
+
+    def size(self, project: Optional[str] = None) -> int:
+        projects = [project] if project else list(self.entries)
+        return sum(
+            entry[2]
+            for item in projects
+            for entry in self.entries.get(item, {}).values()
+        )
+
+    def get(
+        self,
+        project: str,
+        key: str,
+        loader: Callable[[], Any],
+        version: Any = None,
+        sizeof: Callable[[Any], int] = lambda _: 0,
+    ) -> Any:
+        with self.lock:
+            self.hits[project] += 1
+            entry = self.entries.get(project, {}).get(key)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+
+        value = loader()
+        with self.lock:
+            self.entries.setdefault(project, {})[key] = (
+                version, value, sizeof(value))
+            self.evict(keep=project)
+        return value
+
+    def evict(self, keep: Optional[str] = None):
+        with self.lock:
+            evicted = False
+            while self.size() > self.budget:
+                candidates = [item for item in self.entries if item != keep]
+                if not candidates:
+                    break
+                coldest = min(candidates, key=lambda item: self.hits[item])
+                print(f"Evicting project {coldest} from cache")
+                del self.entries[coldest]
+                evicted = True
+            if evicted:
+                # Age the counters so past traffic does not keep a project hot forever
+                for item in list(self.hits):
+                    self.hits[item] //= 2
+
+    def discard(self, project: str, key: str):
+        with self.lock:
+            self.entries.get(project, {}).pop(key, None)
+
+    def clear(self, project: Optional[str] = None):
+        with self.lock:
+            if project:
+                self.entries.pop(project, None)
+            else:
+                self.entries.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {
+                project: {
+                    "entries": len(entries),
+                    "bytes": self.size(project),
+                    "hits": self.hits[project],
+                }
+                for project, entries in self.entries.items()
+            }
+
+
+project_cache = ProjectCache()
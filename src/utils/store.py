@@ -0,0 +1,218 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyogrio
+import shapely
+
+from src.utils.files import BASE_LOCATION
+
+STORE_LOCATION = os.getenv("LAYER_STORE_LOCATION", f"{BASE_LOCATION}/store")
+META_FILE = "meta.json"
+IDS_FILE = "ids.npy"
+BOUNDS_FILE = "bounds.npy"
+OFFSETS_FILE = "offsets.npy"
+WKB_FILE = "geometry.wkb"
+
+
+def _to_array(values: pd.Series) -> np.ndarray:
+    """Converts a column to a fixed width array so it can be memory mapped"""
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy()
+    return values.fillna("").astype(str).to_numpy(dtype=str)
+
+
+def _store_version(filepath: str) -> str:
+    stat = os.stat(filepath)
+    return f"{int(stat.st_mtime)}-{stat.st_size}"
+
+
+def build_layer_store(filepath: str, store_dir: str, id_column: str, columns: Optional[List[str]] = None):
+    """
+    Decodes a layer once and writes its ids, bounds, packed WKB geometries and
+    attribute columns as flat files that can be memory mapped by every worker.
+    """
+    meta, table = pyogrio.read_arrow(filepath, columns=columns)
+    geometry_name = meta["geometry_name"] or "wkb_geometry"
+    # The WKB column already is the concatenated geometries plus their offsets
+    wkb = table[geometry_name].combine_chunks()
+    offset_type = np.int64 if pa.types.is_large_binary(wkb.type) else np.int32
+    offsets = np.frombuffer(wkb.buffers()[1], dtype=offset_type)[
+        wkb.offset:wkb.offset + len(wkb) + 1].astype(np.int64)
+    data = wkb.buffers()[2]
+    geometries = shapely.from_wkb(wkb.to_numpy(zero_copy_only=False))
+    df = table.drop_columns([geometry_name]).to_pandas()
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(store_dir))
+    try:
+        np.save(os.path.join(tmp_dir, IDS_FILE),
+                _to_array(df[id_column].astype(str)))
+        np.save(os.path.join(tmp_dir, BOUNDS_FILE),
+                shapely.bounds(geometries))
+        np.save(os.path.join(tmp_dir, OFFSETS_FILE), offsets - offsets[0])
+        with open(os.path.join(tmp_dir, WKB_FILE), "wb") as file:
+            if data is not None:
+                file.write(memoryview(data)[offsets[0]:offsets[-1]])
+
+        attributes = list(df.columns)
+        for column in attributes:
+            np.save(os.path.join(tmp_dir, f"{column}.npy"),
+                    _to_array(df[column]))
+        with open(os.path.join(tmp_dir, META_FILE), "w") as file:
+            json.dump({
+                "count": len(df),
+                "id_column": id_column,
+                "columns": attributes,
+                "crs": meta["crs"],
+            }, file)
+        os.rename(tmp_dir, store_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+class LayerStore:
+    """
+    Read-only view over a layer written by `build_layer_store`. Every array is
+    memory mapped, so the pages are shared between all the processes that open
+    the same store and nothing is decoded until it is requested.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE), "r") as file:
+            self.meta = json.load(file)
+        self.ids = self._load(IDS_FILE)
+        self.bounds = self._load(BOUNDS_FILE)
+        self.offsets = self._load(OFFSETS_FILE)
+        wkb_path = os.path.join(store_dir, WKB_FILE)
+        if os.path.getsize(wkb_path) > 0:
+            self.wkb = np.memmap(wkb_path, dtype=np.uint8, mode="r")
+        else:
+            self.wkb = np.zeros(0, dtype=np.uint8)
+        self.columns: Dict[str, np.ndarray] = {
+            column: self._load(f"{column}.npy") for column in self.meta["columns"]
+        }
+
+    def _load(self, filename: str) -> np.ndarray:
+        return np.load(os.path.join(self.store_dir, filename), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.ids, self.bounds, self.offsets,
+                  self.wkb, *self.columns.values()]
+        return sum(array.nbytes for array in arrays)
+
+    def geometries(self, indices: Optional[np.ndarray] = None) -> np.ndarray:
+        if indices is None:
+            indices = np.arange(len(self))
+        starts = self.offsets[indices]
+        ends = self.offsets[np.asarray(indices) + 1]
+        wkb = [self.wkb[start:end].tobytes()
+               for start, end in zip(starts, ends)]
+        return shapely.from_wkb(np.array(wkb, dtype=object))
+
+    def query_bbox(self, bbox) -> np.ndarray:
+        minx, miny, maxx, maxy = bbox
+        mask = (
+            (self.bounds[:, 0] <= maxx)
+            & (self.bounds[:, 2] >= minx)
+            & (self.bounds[:, 1] <= maxy)
+            & (self.bounds[:, 3] >= miny)
+        )
+        return np.flatnonzero(mask)
+
+    def select(self, geometry) -> np.ndarray:
+        """Indices of the features that intersect the given geometry"""
+        candidates = self.query_bbox(geometry.bounds)
+        if len(candidates) == 0:
+            return candidates
+        shapely.prepare(geometry)
+        mask = shapely.intersects(geometry, self.geometries(candidates))
+        return candidates[mask]
+
+    def column(self, column: str, indices: Optional[np.ndarray] = None) -> np.ndarray:
+        values = self.columns[column]
+        return values if indices is None else values[indices]
+
+
+class LayerIndex:
+    """
+    STRtree over every geometry of a store, kept resident so point lookups
+    only cost a tree query.
+    """
+
+    def __init__(self, store: LayerStore):
+        self.store = store
+        self.geometries = store.geometries()
+        self.tree = shapely.STRtree(self.geometries)
+
+    @property
+    def nbytes(self) -> int:
+        # Decoded geometries take roughly twice their WKB size, plus the tree nodes
+        return 2 * self.store.wkb.nbytes + 64 * len(self.store)
+
+    def lookup(self, x: float, y: float) -> Optional[tuple]:
+        """
+        Index of the feature that contains the point, or the nearest one, and
+        its distance. None when the layer has no features.
+        """
+        if len(self.geometries) == 0:
+            return None
+        point = shapely.Point(x, y)
+        hits = self.tree.query(point, predicate="intersects")
+        if len(hits) > 0:
+            # Overlapping features resolve to the smallest one
+            return hits[np.argmin(shapely.area(self.geometries[hits]))], 0.0
+        indices, distances = self.tree.query_nearest(
+            point, return_distance=True)
+        return indices[0], float(distances[0])
+
+
+def get_store_dir(filepath: str, columns: Optional[List[str]] = None) -> str:
+    """Versioned folder of the store for a layer file and a set of its columns"""
+    # The folder hash keeps layers with the same name from different projects apart
+    folder = os.path.dirname(os.path.abspath(filepath))
+    # Stores of the same file with different columns live side by side
+    columns_key = "all" if columns is None else hashlib.sha1(
+        ",".join(sorted(columns)).encode()).hexdigest()[:8]
+    name = "{}-{}-{}".format(
+        os.path.splitext(os.path.basename(filepath))[0],
+        hashlib.sha1(folder.encode()).hexdigest()[:8],
+        columns_key,
+    )
+    return f"{STORE_LOCATION}/{name}-{_store_version(filepath)}"
+
+
+def get_layer_store(filepath: str, id_column: str, columns: Optional[List[str]] = None) -> LayerStore:
+    """
+    Opens the store for a layer file, building it first if it does not exist
+    or the file changed. A lock file makes sure only one worker builds it while
+    the rest wait and then map the same files.
+    """
+    os.makedirs(STORE_LOCATION, exist_ok=True)
+    store_dir = get_store_dir(filepath, columns)
+    name = os.path.basename(store_dir).rsplit("-", 2)[0]
+    if not os.path.exists(store_dir):
+        with open(f"{STORE_LOCATION}/{name}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(store_dir):
+                print(f"Building layer store {store_dir}")
+                build_layer_store(filepath, store_dir, id_column, columns)
+                # Older versions can go, open maps keep their pages alive
+                for item in os.listdir(STORE_LOCATION):
+                    path = f"{STORE_LOCATION}/{item}"
+                    if item.startswith(f"{name}-") and path != store_dir:
+                        shutil.rmtree(path, ignore_errors=True)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return LayerStore(store_dir)
@@ -0,0 +1,63 @@
+import io
+import struct
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import pytest
+from shapely.geometry import box
+
+from src.utils.fgb import FEATURES_COUNT_FIELD, OffsetIndex, _field_position, read_header
+
+
+def write_lots(filepath, **layer_options):
+    gdf = gpd.GeoDataFrame(
+        {"lot_id": [f"lot_{i}" for i in range(50)], "area": np.arange(50.0)},
+        geometry=[box(i, i % 7, i + 1, i % 7 + 1) for i in range(50)],
+        crs="EPSG:4326",
+    )
+    pyogrio.write_dataframe(gdf, filepath, driver="FlatGeobuf", layer_options=layer_options)
+
+
+def drop_features_count(filepath):
+    """Leaves the feature count at its default, as streaming writers do"""
+    with open(filepath, "rb") as f:
+        data = bytearray(f.read())
+    table = 12 + struct.unpack_from("<I", data, 12)[0]
+    vtable = table - struct.unpack_from("<i", data, table)[0]
+    struct.pack_into("<H", data, vtable + 4 + 2 * FEATURES_COUNT_FIELD, 0)
+    with open(filepath, "wb") as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize("spatial_index", ["YES", "NO"])
+def test_offset_index_reads_requested_features(tmp_path, spatial_index):
+    filepath = str(tmp_path / "lots.fgb")
+    write_lots(filepath, SPATIAL_INDEX=spatial_index)
+
+    contents = OffsetIndex(filepath, "lot_id").read(["lot_3", "lot_10", "lot_49", "missing"])
+    assert pyogrio.read_info(io.BytesIO(contents))["features"] == 3
+    gdf = pyogrio.read_dataframe(io.BytesIO(contents))
+    assert sorted(gdf["lot_id"]) == ["lot_10", "lot_3", "lot_49"]
+    assert len(pyogrio.read_dataframe(io.BytesIO(contents), bbox=(9.5, 0, 11, 10))) == 1
+
+
+def test_offset_index_writes_the_count_left_out_of_the_header(tmp_path):
+    filepath = str(tmp_path / "lots.fgb")
+    write_lots(filepath, SPATIAL_INDEX="NO")
+    drop_features_count(filepath)
+    assert _field_position(read_header(filepath)["header"], FEATURES_COUNT_FIELD) is None
+
+    contents = OffsetIndex(filepath, "lot_id").read(["lot_3", "lot_10"])
+    assert pyogrio.read_info(io.BytesIO(contents))["features"] == 2
+    gdf = pyogrio.read_dataframe(io.BytesIO(contents))
+    assert sorted(gdf["lot_id"]) == ["lot_10", "lot_3"]
+    assert gdf.crs == "EPSG:4326"
+    assert gdf["area"].tolist() == [3.0, 10.0]
+
+
+def test_offset_index_fails_without_matching_ids(tmp_path):
+    filepath = str(tmp_path / "lots.fgb")
+    write_lots(filepath)
+    with pytest.raises(ValueError, match="None of the requested features"):
+        OffsetIndex(filepath, "lot_id").read(["missing"])
@@ -0,0 +1,168 @@
+import asyncio
+import io
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+from tenacity import wait_none
+
+from src.scripts import gather_buildings
+from src.scripts.gather_buildings import (
+    CHUNK_MANIFEST_FILE,
+    DOWNLOAD_ATTEMPTS,
+    check_chunks,
+    download_chunk,
+    download_in_parallel,
+    process_image_collection_to_raster,
+    run_chunk_pipeline,
+)
+
+
+def chunk_zip(name):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as z:
+        z.writestr(f"{name}.building_presence.tif", b"presence")
+        z.writestr(f"{name}.building_height.tif", b"height")
+    return data.getvalue()
+
+
+class ChunkServer(ThreadingHTTPServer):
+    """
+    Stand-in for the download server, it fails the first `failures[name]`
+    requests of each chunk and answers `bodies[name]` instead of a zip if set.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ChunkHandler)
+        self.failures = {}
+        self.bodies = {}
+        self.hits = {}
+        self.lock = threading.Lock()
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_port}/{name}"
+
+
+class ChunkHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        name = self.path.strip("/")
+        with self.server.lock:
+            self.server.hits[name] = self.server.hits.get(name, 0) + 1
+            failing = self.server.hits[name] <= self.server.failures.get(name, 0)
+        if failing:
+            self.send_response(503)
+            self.end_headers()
+            return
+        data = self.server.bodies.get(name) or chunk_zip(name)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(download_chunk.retry, "wait", wait_none())
+    server = ChunkServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_run_chunk_pipeline_retries_and_resumes(tmp_path, server):
+    chunks = {f"{i}_0": f"ok_{i}" for i in range(6)}
+    chunks["flaky"] = "flaky"
+    chunks["down"] = "down"
+    server.failures = {"flaky": 1, "down": DOWNLOAD_ATTEMPTS}
+
+    manifest, failures = run_chunk_pipeline(
+        chunks, str(tmp_path), server.url, prepare_workers=2, download_workers=3)
+
+    # The transient error is retried, the permanent one is reported after every attempt
+    assert server.hits["flaky"] == 2
+    assert server.hits["down"] == DOWNLOAD_ATTEMPTS
+    assert list(failures) == ["down"]
+    assert set(manifest) == set(chunks) - {"down"}
+    with open(tmp_path / CHUNK_MANIFEST_FILE) as f:
+        assert json.load(f) == manifest
+    for rasters in manifest.values():
+        assert set(rasters) == {"presence", "height"}
+        assert all(os.path.exists(fp) for fp in rasters.values())
+    # Zips are removed once extracted and no partial download is left behind
+    assert not [name for name in os.listdir(tmp_path) if name.endswith((".zip", ".part"))]
+
+    # A rerun only processes the chunks missing from the manifest
+    server.hits.clear()
+    server.failures = {}
+    manifest, failures = run_chunk_pipeline(
+        chunks, str(tmp_path), server.url, prepare_workers=2, download_workers=3)
+    assert failures == {}
+    assert server.hits == {"down": 1}
+    assert set(manifest) == set(chunks)
+
+
+def test_run_chunk_pipeline_redownloads_removed_rasters(tmp_path, server):
+    chunks = {"0_0": "first", "1_0": "second"}
+    manifest, _ = run_chunk_pipeline(chunks, str(tmp_path), server.url)
+    os.remove(manifest["1_0"]["height"])
+
+    server.hits.clear()
+    manifest, failures = run_chunk_pipeline(chunks, str(tmp_path), server.url)
+    assert failures == {}
+    assert server.hits == {"second": 1}
+    assert os.path.exists(manifest["1_0"]["height"])
+
+
+def test_download_chunk_keeps_partial_file_out_of_place(tmp_path, server):
+    server.failures = {"broken": DOWNLOAD_ATTEMPTS}
+    with pytest.raises(Exception):
+        download_chunk(server.url("broken"), "broken", str(tmp_path))
+    assert not os.path.exists(tmp_path / "chunk_broken.zip")
+
+
+def test_process_image_collection_to_raster_fails_until_every_chunk_is_done(tmp_path, server, monkeypatch):
+    combined = []
+    monkeypatch.setattr(gather_buildings, "prepare_raster_url",
+                        lambda chunk_bounds, crs: server.url(f"chunk_{chunk_bounds[0]:.1f}"))
+    monkeypatch.setattr(gather_buildings, "combine_rasters",
+                        lambda raster_files, output_file: combined.append(raster_files))
+    gdf_bounds = gpd.GeoDataFrame(geometry=[box(0, 0, 0.25, 0.05)], crs="EPSG:4326")
+    server.failures = {"chunk_0.1": DOWNLOAD_ATTEMPTS}
+
+    with pytest.raises(RuntimeError, match="1 chunks failed"):
+        process_image_collection_to_raster(
+            gdf_bounds, str(tmp_path / "buildings.tif"), output_dir=str(tmp_path), chunk_size=0.1)
+    assert combined == []
+
+    server.failures = {}
+    process_image_collection_to_raster(
+        gdf_bounds, str(tmp_path / "buildings.tif"), output_dir=str(tmp_path), chunk_size=0.1)
+    assert len(combined[0]["presence"]) == len(combined[0]["height"]) == 3
+
+
+def test_fetch_geojson_rejects_invalid_chunks(tmp_path, server):
+    server.bodies = {"invalid": b"<html>Service temporarily unavailable</html>"}
+    results = asyncio.run(download_in_parallel({0: server.url("invalid")}, str(tmp_path)))
+    assert isinstance(results[0], ValueError)
+    # Nothing is left under the chunk name, so the next run downloads it again
+    assert os.listdir(tmp_path) == []
+
+
+def test_check_chunks_removes_unreadable_chunks(tmp_path):
+    gpd.GeoDataFrame(geometry=[box(0, 0, 1, 1), box(1, 1, 2, 2)], crs="EPSG:4326").to_file(
+        tmp_path / "buildings_chunk_0.geojson", driver="GeoJSON")
+    (tmp_path / "buildings_chunk_1.geojson").write_text('{"type": "FeatureCollection", "feat')
+
+    with pytest.raises(RuntimeError, match=r"1 chunks incomplete \(1\), run again"):
+        check_chunks(str(tmp_path), total_features=3, chunk_size=2)
+    assert os.listdir(tmp_path) == ["buildings_chunk_0.geojson"]
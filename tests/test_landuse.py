@@ -0,0 +1,43 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from src.scripts.landuse import build_parking_mask
+
+
+def parking_features():
+    """Square loops of service roads plus a few parking lots, the loops leave holes to fill"""
+    rng = np.random.default_rng(0)
+    geometries = []
+    for x in np.arange(0, 0.05, 0.007):
+        for y in np.arange(0, 0.05, 0.007):
+            size = rng.uniform(0.002, 0.005)
+            geometries.append(shapely.box(x, y, x + size, y + size).exterior)
+            if rng.random() < 0.3:
+                geometries.append(shapely.box(x + 0.005, y, x + 0.0065, y + 0.001))
+    return gpd.GeoDataFrame(geometry=geometries, crs="EPSG:4326")
+
+
+def global_parking_mask(gdf, buffer):
+    mask = shapely.buffer(shapely.union_all(gdf.geometry.to_numpy()), buffer)
+    return [Polygon(poly.exterior) for poly in shapely.get_parts(mask)]
+
+
+def test_build_parking_mask_matches_global_buffer_across_tile_seams():
+    gdf = parking_features()
+    buffer = 0.0002
+    expected = global_parking_mask(gdf, buffer)
+
+    # Tiles smaller than the loops so most holes cross a seam
+    gdf_mask = build_parking_mask(gdf, buffer=buffer, tile_size=0.0013, num_workers=1)
+
+    assert len(gdf_mask) == len(expected)
+    expected_area = shapely.area(shapely.union_all(expected))
+    assert abs(gdf_mask.geometry.area.sum() - expected_area) / expected_area < 1e-6
+    assert all(len(poly.interiors) == 0 for poly in gdf_mask.geometry)
+
+
+def test_build_parking_mask_without_features():
+    gdf = gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    assert build_parking_mask(gdf, num_workers=1).empty
@@ -0,0 +1,33 @@
+import geopandas as gpd
+import pyogrio
+from shapely.geometry import Polygon, box
+
+from src.scripts.optimize_layers import optimize_layer
+
+
+def test_optimize_layer_keeps_features_smaller_than_the_grid(tmp_path):
+    gdf = gpd.GeoDataFrame(
+        {"lot_id": [1, 2, 3], "cvegeo": ["a", "a", "b"], "area": [1.0, 2.0, 3.0]},
+        geometry=[box(0, 0, 1, 1), box(2, 2, 2 + 1e-8, 2 + 1e-8), box(0.5, 3, 1, 4)],
+        crs="EPSG:4326",
+    )
+    gdf_optimized = optimize_layer(gdf, 1e-6, columns=["lot_id", "cvegeo"], id_column="lot_id")
+
+    assert len(gdf_optimized) == len(gdf)
+    assert sorted(gdf_optimized["lot_id"]) == [1, 2, 3]
+    assert list(gdf_optimized.columns) == ["lot_id", "cvegeo", "geometry"]
+    assert not gdf_optimized.geometry.is_empty.any()
+    pyogrio.write_dataframe(gdf_optimized, tmp_path / "lots.fgb", driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    assert len(pyogrio.read_dataframe(tmp_path / "lots.fgb")) == len(gdf)
+
+
+def test_optimize_layer_lists_features_without_geometry(capsys):
+    gdf = gpd.GeoDataFrame(
+        {"cvegeo": ["a", "b", "c"]},
+        geometry=[box(0, 0, 1, 1), None, Polygon()],
+        crs="EPSG:4326",
+    )
+    gdf_optimized = optimize_layer(gdf, 1e-6, id_column="cvegeo")
+
+    assert list(gdf_optimized["cvegeo"]) == ["a"]
+    assert "Dropping 2 features without geometry: b, c" in capsys.readouterr().out